@@ -5,24 +5,50 @@ import os
 import numpy as np
 import pandas as pd
 import pyAgrum as gum
-from invest.decision import investment_portfolio, prepare_data_for_learning
+from invest.decision import investment_portfolio, holding_period_sweep, noise_replica_portfolios, \
+    threshold_grid_sweep, prepare_data_for_learning, companies_dict
 from invest.preprocessing.dataloader import load_data
 from invest.networks.value_evaluation import ValueNetwork
 from invest.networks.quality_evaluation import QualityNetwork
 from invest.networks.invest_recommendation import InvestmentRecommendationNetwork
-from invest.cpt_learning_algorithms import learn_cpt_mdl, learn_cpt_bic, learn_cpt_mle
+from invest.cpt_learning_algorithms import learn_cpt_mdl, learn_cpt_bic, learn_cpt_mle, bootstrap_cpts
+from invest.structure_learning import FamilyScoreCache, learn_structure, apply_structure, learnable_nodes, \
+    export_structure
+from invest.evaluation.results import RESULTS_FILE, append_result, completed_tasks, config_key, load_result_rows, \
+    results_from_rows
 
 VERSION = 1.4
 
-def walk_forward_validation(df, start_year, end_year, learning_method, args):
-    results = {
-        "JGIND": {"CR": [], "AAR": [], "TR": [], "SR": []},
-        "JCSEV": {"CR": [], "AAR": [], "TR": [], "SR": []}
-    }
+# Evidence variables of each network used to measure decision flip rates under CPT resampling
+DECISION_EVIDENCE = {
+    "Value": ["PERelative_ShareMarket", "PERelative_ShareSector", "ForwardPE_CurrentVsHistory"],
+    "Quality": ["ROEvsCOE", "RelDE", "CAGRvsInflation", "SystematicRisk"],
+    "Investment Recommendation": ["Value", "Quality"]
+}
+
+def walk_forward_validation(df, start_year, end_year, learning_method, args, checkpoint=None):
+    results = {sector: {"CR": [], "AAR": [], "TR": [], "SR": []} for sector in args.sectors}
+    results.update({
+        "learning": [],
+        "structure": [],
+        "holdingPeriods": [],
+        "noise": [],
+        "thresholdGrid": [],
+        "missing": []
+    })
     
     learn_func = get_learning_function(learning_method)
+    previous_bns = {}
+    completed = checkpoint["completed"] if checkpoint is not None else {}
     
     for train_end in range(start_year, end_year):
+        if all((train_end, sector) in completed for sector in args.sectors):
+            print(f"\nSkipping train_end year {train_end}: results already stored")
+            for sector in args.sectors:
+                restore_task(results, completed, train_end, sector,
+                             resumed_blocks(args, learning_method) + resumed_blocks(args, learning_method, sector))
+            continue
+
         print(f"\nProcessing train_end year: {train_end}")
         train_df = df[df['Date'] < f"{train_end}-01-01"]
         test_df = df[(df['Date'] >= f"{train_end}-01-01") & (df['Date'] < f"{train_end+1}-01-01")]
@@ -45,14 +71,44 @@ def walk_forward_validation(df, start_year, end_year, learning_method, args):
                 print(f"Learning data shape: {learning_data.shape}")
                 print(f"Learning data columns: {learning_data.columns}")
                 print(f"Learning data sample:\n{learning_data.head()}")
+
+                if args.structure_learning != "none":
+                    # One score cache per dataset, shared by the three networks
+                    cache = FamilyScoreCache(learning_data)
+                    for network_name, network in [("Value", value_net), ("Quality", quality_net), ("Investment Recommendation", invest_net)]:
+                        arcs, structure_report = learn_structure(network, learning_data, args.structure_learning,
+                                                                 args.max_parents, args.structure_max_time,
+                                                                 cache=cache)
+                        apply_structure(network, arcs, learnable_nodes(network, learning_data))
+                        results["structure"].append({"trainEnd": train_end, "network": network_name, "arcs": arcs,
+                                                     **structure_report})
+                        print(f"{network_name} Network structure: {arcs} | score {structure_report['score']:.2f} | "
+                              f"cache hits {structure_report['cacheHits']} | misses {structure_report['cacheMisses']}")
                 
                 for network_name, network in [("Value", value_net), ("Quality", quality_net), ("Investment Recommendation", invest_net)]:
                     print(f"\nLearning {network_name} Network CPTs...")
                     try:
-                        learned_bn = learn_func(learning_data, network.model)
+                        init_bn = previous_bns.get(network_name) if args.em_warm_start else None
+                        learned_bn, report = learn_func(learning_data, network.model, return_report=True,
+                                                        epsilon=args.em_epsilon, max_iter=args.em_max_iter,
+                                                        max_time=args.em_max_time, init_bn=init_bn)
+                        results["learning"].append({"trainEnd": train_end, "network": network_name, **report})
+                        print(f"{network_name} Network EM: {report['status']} | iterations {report['iterations']} | "
+                              f"log-likelihood {report['logLikelihood']} | {report['scoreMethod']} score "
+                              f"{report['score']} | {report['wallTime']:.2f}s")
                         if learned_bn:
                             network.update_cpts(learned_bn)
+                            previous_bns[network_name] = learned_bn
                             print(f"{network_name} Network CPTs updated successfully.")
+                            if args.cpt_bootstrap > 0:
+                                bootstrap = bootstrap_cpts(learning_data, network, n_boot=args.cpt_bootstrap,
+                                                           evidences=decision_evidences(network_name, learning_data))
+                                results["learning"][-1]["bootstrap"] = {
+                                    "flipRate": bootstrap["flipRate"],
+                                    "cpts": {name: {k: v for k, v in entry.items() if k != "samples"}
+                                             for name, entry in bootstrap["cpts"].items()}
+                                }
+                                print(f"{network_name} Network decision flip rate: {bootstrap['flipRate']}")
                         else:
                             print(f"No CPTs learned for {network_name} Network. Using original CPTs.")
                     except Exception as e:
@@ -60,17 +116,75 @@ def walk_forward_validation(df, start_year, end_year, learning_method, args):
                         print(f"Using original CPTs for {network_name} Network.")
                 
                 print("CPT learning process completed.")
+
+                if args.structure_learning != "none" and args.structure_export is not None:
+                    # The learned structures are exported with the CPTs learned for them
+                    for entry in [e for e in results["structure"] if e["trainEnd"] == train_end]:
+                        network = {"Value": value_net, "Quality": quality_net,
+                                   "Investment Recommendation": invest_net}[entry["network"]]
+                        name = f"{learning_method}_{train_end}_{entry['network'].replace(' ', '')}"
+                        entry["modelFile"], entry["arcsFile"] = export_structure(
+                            network, entry["arcs"], args.structure_export, name,
+                            {"method": learning_method, "trainEnd": train_end, "network": entry["network"]})
+                        print(f"{entry['network']} Network structure exported to {entry['modelFile']}")
         
-        # Run investment portfolio for both sectors
-        for sector in ["JGIND", "JCSEV"]:
+        # Run investment portfolio for every sector; the yearly Stores of all sectors are shared between them
+        for sector in args.sectors:
+            if (train_end, sector) in completed:
+                print(f"\nSkipping sector {sector}: results already stored")
+                restore_task(results, completed, train_end, sector, resumed_blocks(args, learning_method, sector))
+                continue
+
             print(f"\nProcessing sector: {sector}")
             try:
-                portfolio = investment_portfolio(test_df, args, sector, value_net, quality_net, invest_net, True)
+                if args.holding_periods:
+                    # Decisions are made once and every holding period is evaluated from them
+                    sweep = holding_period_sweep(test_df, args, sector, value_net, quality_net, invest_net,
+                                                 [args.holding_period] + args.holding_periods, True)
+                    for holding_period, sweep_portfolio in sweep["holdingPeriods"].items():
+                        results["holdingPeriods"].append({
+                            "trainEnd": train_end, "sector": sector, "holdingPeriod": holding_period,
+                            "CR": sweep_portfolio["ip"]["compoundReturn"],
+                            "AAR": sweep_portfolio["ip"]["averageAnnualReturn"],
+                            "TR": sweep_portfolio["ip"]["treynor"],
+                            "SR": sweep_portfolio["ip"]["sharpe"]})
+                    portfolio = sweep["holdingPeriods"][args.holding_period]
+                else:
+                    portfolio = investment_portfolio(test_df, args, sector, value_net, quality_net, invest_net, True)
+
+                if args.margin_of_safety_grid or args.beta_grid:
+                    grid = threshold_grid_sweep(test_df, args, sector, value_net, quality_net, invest_net,
+                                                args.margin_of_safety_grid or [args.margin_of_safety],
+                                                args.beta_grid or [args.beta], True)
+                    results["thresholdGrid"].append({
+                        "trainEnd": train_end, "sector": sector,
+                        "marginsOfSafety": grid["marginsOfSafety"], "betas": grid["betas"],
+                        "CR": grid["compoundReturn"].tolist(),
+                        "AAR": grid["averageAnnualReturn"].tolist(),
+                        "TR": grid["treynor"].tolist(),
+                        "SR": grid["sharpe"].tolist()})
+
+                if args.noise_replicas > 0:
+                    replicas = noise_replica_portfolios(test_df, args, sector, value_net, quality_net, invest_net,
+                                                        args.noise_replicas, args.noise_seed, True)
+                    results["noise"].append({
+                        "trainEnd": train_end, "sector": sector,
+                        "CR": replicas["compoundReturn"].tolist(),
+                        "AAR": replicas["averageAnnualReturn"].tolist(),
+                        "TR": replicas["treynor"].tolist(),
+                        "SR": replicas["sharpe"].tolist()})
                 
                 results[sector]["CR"].append(portfolio["ip"]["compoundReturn"])
                 results[sector]["AAR"].append(portfolio["ip"]["averageAnnualReturn"])
                 results[sector]["TR"].append(portfolio["ip"]["treynor"])
                 results[sector]["SR"].append(portfolio["ip"]["sharpe"])
+
+                # Failed tasks are not stored so that a rerun retries them
+                if checkpoint is not None:
+                    append_result({"config": checkpoint["config"], "method": learning_method, "trainEnd": train_end,
+                                   "sector": sector, "CR": portfolio["ip"]["compoundReturn"],
+                                   "AAR": portfolio["ip"]["averageAnnualReturn"], "TR": portfolio["ip"]["treynor"],
+                                   "SR": portfolio["ip"]["sharpe"]}, checkpoint["file"])
             except Exception as e:
                 print(f"Error in investment portfolio calculation for {sector} in year {train_end}: {str(e)}")
                 results[sector]["CR"].append(0)
@@ -79,15 +193,66 @@ def walk_forward_validation(df, start_year, end_year, learning_method, args):
                 results[sector]["SR"].append(0)
         
         print("\nIntermediate Results:")
-        for sector in ["JGIND", "JCSEV"]:
+        for sector in args.sectors:
             print(f"{sector}:")
             print(f"CR: {results[sector]['CR']}")
             print(f"AAR: {results[sector]['AAR']}")
             print(f"TR: {results[sector]['TR']}")
             print(f"SR: {results[sector]['SR']}")
+
+    if results["missing"]:
+        blocks = sorted({block for entry in results["missing"] for block in entry["blocks"]})
+        print(f"\nWarning: {len(results['missing'])} tasks were restored from the results file without their "
+              f"{', '.join(blocks)} results, which are only computed when a task runs")
+
+    if results["learning"]:
+        print("\nEM Iterations:")
+        for network_name in ["Value", "Quality", "Investment Recommendation"]:
+            reports = [r for r in results["learning"] if r["network"] == network_name]
+            warm = [r["iterations"] for r in reports if r["warmStart"]]
+            cold = [r["iterations"] for r in reports if not r["warmStart"]]
+            print(f"{network_name}: total {sum(warm) + sum(cold)} | cold-start steps {cold} | "
+                  f"warm-start steps {warm}")
+            if warm and cold:
+                # Estimated against the mean cost of the cold-started steps of this run
+                print(f"{network_name}: ~{np.mean(cold) * len(warm) - sum(warm):.0f} iterations saved by warm start")
     
     return results
 
+def resumed_blocks(args, learning_method, sector=None):
+    """
+    Returns the result blocks a task restored from the results file does not have: those of its train_end
+    year without a sector, those of the sector otherwise
+    """
+    if sector is None:
+        blocks = {"learning": learning_method != "original",
+                  "structure": learning_method != "original" and args.structure_learning != "none"}
+    else:
+        blocks = {"holdingPeriods": bool(args.holding_periods),
+                  "thresholdGrid": bool(args.margin_of_safety_grid or args.beta_grid),
+                  "noise": args.noise_replicas > 0}
+    return [block for block, applies in blocks.items() if applies]
+
+def restore_task(results, completed, train_end, sector, missing):
+    """
+    Appends the stored CR, AAR, TR and SR of a completed task to the results, and records the result blocks
+    that are missing for it
+    """
+    for key in ["CR", "AAR", "TR", "SR"]:
+        results[sector][key].append(completed[(train_end, sector)][key])
+    if missing:
+        results["missing"].append({"trainEnd": train_end, "sector": sector, "blocks": missing})
+
+def decision_evidences(network_name, learning_data):
+    """
+    Returns the distinct evidence combinations observed in the learning data for a network
+    """
+    columns = [c for c in DECISION_EVIDENCE[network_name] if c in learning_data.columns]
+    rows = learning_data[columns].dropna().drop_duplicates().astype(str)
+    if network_name == "Investment Recommendation":
+        return list(rows.itertuples(index=False, name=None)) if len(columns) == 2 else []
+    return rows.to_dict('records')
+
 def get_learning_function(method):
     if method == "mdl":
         return learn_cpt_mdl
@@ -101,11 +266,18 @@ def get_learning_function(method):
 def run_experiments(df, args):
     methods = ["mdl", "bic", "mle"]
     results = {method: {} for method in methods}
+    config = config_key(args)
+    rows = load_result_rows(args.results_file, config) if args.resume else load_result_rows(None)
+    if args.results_file is not None:
+        print(f"Results file: {args.results_file} | configuration {config} | {len(rows)} stored task results")
     
     for method in methods:
         print(f"\nRunning experiment for {method.upper()} method")
+        checkpoint = None
+        if args.results_file is not None:
+            checkpoint = {"file": args.results_file, "config": config, "completed": completed_tasks(rows, method)}
         try:
-            results[method] = walk_forward_validation(df, args.start, args.end, method, args)
+            results[method] = walk_forward_validation(df, args.start, args.end, method, args, checkpoint)
             print(f"Experiment for {method.upper()} completed successfully")
         except Exception as e:
             print(f"Error occurred during {method.upper()} experiment: {e}")
@@ -113,7 +285,7 @@ def run_experiments(df, args):
         
         # Print intermediate results
         if results[method] is not None:
-            for sector in ["JGIND", "JCSEV"]:
+            for sector in args.sectors:
                 print(f"\nIntermediate results for {sector} using {method.upper()} method:")
                 print(f"CR: {results[method][sector]['CR']}")
                 print(f"AAR: {results[method][sector]['AAR']}")
@@ -122,11 +294,11 @@ def run_experiments(df, args):
     
     return results
 
-def summarize_results(results):
+def summarize_results(results, sectors):
     summary = {}
     for method, sector_results in results.items():
         summary[method] = {}
-        for sector in ["JGIND", "JCSEV"]:
+        for sector in sectors:
             summary[method][sector] = {
                 "CR": np.mean(sector_results[sector]["CR"]),
                 "AAR": np.mean(sector_results[sector]["AAR"]),
@@ -135,8 +307,8 @@ def summarize_results(results):
             }
     return summary
 
-def print_results_table(summary):
-    for sector in ["JGIND", "JCSEV"]:
+def print_results_table(summary, sectors):
+    for sector in sectors:
         print(f"\n{sector} Sector Results:")
         print("Method\t\tCR\t\tAAR\t\tTR\t\tSR")
         print("-" * 60)
@@ -149,12 +321,16 @@ def print_results_table(summary):
 
 def main():
     start = time.time()
-    df = load_data()
-    results = run_experiments(df, args)
+    if args.summarize_only:
+        # Summarizes whatever has been stored so far, e.g. while another run is still going
+        results = results_from_rows(load_result_rows(args.results_file, config_key(args)), args.sectors)
+    else:
+        df = load_data()
+        results = run_experiments(df, args)
     
     try:
-        summary = summarize_results(results)
-        print_results_table(summary)
+        summary = summarize_results(results, args.sectors)
+        print_results_table(summary, args.sectors)
     except Exception as e:
         print(f"Error in summarizing results: {str(e)}")
     
@@ -163,6 +339,39 @@ def main():
     minutes, seconds = divmod(rem, 60)
     print(f"\nTotal Experiment Time: {int(hours):02d}:{int(minutes):02d}:{seconds:05.2f}")
 
+def parse_holding_periods(v):
+    """
+    Parses a comma separated list ("0,3,-1") or a start:stop[:step] range ("0:12:3") of holding periods
+    """
+    try:
+        if ':' in v:
+            return list(range(*[int(p) for p in v.split(':')]))
+        return [int(p) for p in v.split(',') if p.strip()]
+    except (TypeError, ValueError):
+        raise argparse.ArgumentTypeError('List or range of holding periods expected.')
+
+def parse_grid(v):
+    """
+    Parses a comma separated list ("0.8,1.0,1.4") or an evenly spaced start:stop:num grid ("0:2:20") of values
+    """
+    try:
+        if ':' in v:
+            start, stop, num = v.split(':')
+            return np.linspace(float(start), float(stop), int(num)).tolist()
+        return [float(p) for p in v.split(',') if p.strip()]
+    except (TypeError, ValueError):
+        raise argparse.ArgumentTypeError('List or start:stop:num grid of values expected.')
+
+def parse_sectors(v):
+    """
+    Parses a comma separated list of sector codes of the universe ("JCSEV,JGIND")
+    """
+    sectors = [p.strip() for p in v.split(',') if p.strip()]
+    unknown = [sector for sector in sectors if sector not in companies_dict]
+    if unknown:
+        raise argparse.ArgumentTypeError(f'Unknown sectors {unknown}, expected some of {list(companies_dict)}.')
+    return sectors
+
 def str2bool(v):
     if isinstance(v, bool):
         return v
@@ -180,14 +389,47 @@ if __name__ == '__main__':
     parser.add_argument("--end", type=int, default=2018)
     parser.add_argument("--margin_of_safety", type=float, default=1.4)
     parser.add_argument("--beta", type=float, default=0.6)
+    parser.add_argument("--margin_of_safety_grid", type=parse_grid, default=None)
+    parser.add_argument("--beta_grid", type=parse_grid, default=None)
     parser.add_argument("--extension", type=str2bool, default=False)
     parser.add_argument("--noise", type=str2bool, default=False)
+    parser.add_argument("--noise_seed", type=int, default=None)
+    parser.add_argument("--noise_replicas", type=int, default=0)
     parser.add_argument("--ablation", type=str2bool, default=False)
     parser.add_argument("--network", type=str, default='v')
     parser.add_argument("--gnn", type=str2bool, default=False)
     parser.add_argument("--holding_period", type=int, default=-1)
+    parser.add_argument("--holding_periods", type=parse_holding_periods, default=None)
     parser.add_argument("--horizon", type=int, default=10)
+    parser.add_argument("--significance_resamples", type=int, default=0,
+                        help="Block bootstrap resamples of the period returns testing IP against its benchmark")
+    parser.add_argument("--significance_block_size", type=int, default=None)
+    parser.add_argument("--significance_seed", type=int, default=0)
+    parser.add_argument("--em_epsilon", type=float, default=1e-4)
+    parser.add_argument("--em_max_iter", type=int, default=None)
+    parser.add_argument("--em_max_time", type=float, default=None)
+    parser.add_argument("--em_warm_start", type=str2bool, default=False)
+    parser.add_argument("--cpt_bootstrap", type=int, default=0)
+    parser.add_argument("--structure_learning", type=str, default="none", choices=["none", "hill_climbing", "tabu"])
+    parser.add_argument("--max_parents", type=int, default=2)
+    parser.add_argument("--structure_max_time", type=float, default=None)
+    parser.add_argument("--structure_export", type=str, default=None,
+                        help="Folder to write each learned structure to, as a BIFXML diagram and a JSON arc list")
+    parser.add_argument("--results_file", type=str, default=RESULTS_FILE)
+    parser.add_argument("--resume", type=str2bool, default=False,
+                        help="Restore the CR, AAR, TR and SR of tasks already in the results file instead of "
+                             "rerunning them")
+    parser.add_argument("--summarize_only", type=str2bool, default=False)
+    parser.add_argument("--sectors", type=parse_sectors, default=None)
+    parser.add_argument("--workers", type=int, default=1,
+                        help="Processes computing the sector partitions of the Store, 1 computes them in process")
+    parser.add_argument("--price_matrix", type=str, default=None,
+                        help="Wide price matrix built by clean.py to slice backtest prices from, e.g. data/INVEST_prices")
     args = parser.parse_args()
+    if args.resume and args.em_warm_start:
+        # The CPTs learned in skipped train_end years are not stored, so warm starts would differ on resume
+        parser.error("--resume cannot be combined with --em_warm_start")
+    args.sectors = args.sectors or list(companies_dict)
 
     print(art.text2art("INVEST"))
     print("Insaaf Dhansay & Kialan Pillay")
@@ -1,3 +1,6 @@
+import numpy as np
+
+
 # Negative Earnings - Rule 1
 def negative_earnings(forward_earnings):
     """
@@ -266,4 +269,36 @@ def systematic_risk_classification(share_beta):
     if share_beta == 1:
         return "EqualTo"
     if share_beta > 1:
-        return "greater"
\ No newline at end of file
+        return "greater"
+
+def classify_margin(excess, margin_of_safety, states, above_first=False):
+    """
+    Returns the discrete states of many relative values for many margins of safety at once, with the same
+    comparisons as the rules above. Values that fall in no state, e.g. NaN, give None
+
+    Parameters
+    ----------
+    excess : numpy.ndarray
+        Relative values minus one, e.g. current PE / historic PE - 1
+    margin_of_safety : numpy.ndarray
+        Margins of safety, broadcast against excess
+    states : tuple
+        States for values below, within and above the margin of safety
+    above_first : bool
+        Whether the above state takes precedence over the below state, as in the ROE, CAGR and Debt/Equity rules
+
+    Returns
+    -------
+    numpy.ndarray
+    """
+    excess = np.asarray(excess, dtype=np.float64)
+    margin_of_safety = np.asarray(margin_of_safety, dtype=np.float64)
+    below_state, equal_state, above_state = [np.array(state, dtype=object) for state in states]
+    with np.errstate(invalid="ignore"):
+        below = excess <= -margin_of_safety
+        above = excess >= margin_of_safety
+        equal = (margin_of_safety > excess) & (excess > -margin_of_safety)
+    state = np.where(equal, equal_state, None)
+    if above_first:
+        return np.where(above, above_state, np.where(below, below_state, state))
+    return np.where(below, below_state, np.where(above, above_state, state))
@@ -1,20 +1,58 @@
+import time
+
 import pyAgrum as gum
 import numpy as np
 import pandas as pd
 
-def learn_cpt_generic(data, bn, score_method):
+SCORE_METHODS = ['MDL', 'BIC', 'MLE']
+
+
+def learn_cpt_generic(data, bn, score_method, epsilon=1e-4, max_iter=None, max_time=None, init_bn=None,
+                      return_report=False):
+    """
+    Learns the CPTs of a network from data using the EM algorithm. EM maximises the likelihood whatever the
+    scoring method, which only decides the score the learned network is reported with
+
+    Parameters
+    ----------
+    data : pandas.DataFrame
+        Categorical learning data
+    bn : pyAgrum.BayesNet or pyAgrum.InfluenceDiagram
+        Network supplying the structure to learn parameters for
+    score_method : str
+        Scoring method (MDL, BIC or MLE)
+    epsilon : float, optional
+        EM stops when the sum of squared changes of the parameters drops below epsilon
+    max_iter : int, optional
+        Maximum number of EM iterations
+    max_time : float, optional
+        Time budget for EM in seconds
+    init_bn : pyAgrum.BayesNet, optional
+        Previously learned network whose CPTs seed EM (warm start)
+    return_report : bool, optional
+        Whether to also return the learning report
+
+    Returns
+    -------
+    pyAgrum.BayesNet or tuple
+        Learned network, and the learning report if return_report is set
+    """
+    start_time = time.time()
+    report = {"iterations": 0, "logLikelihood": None, "score": None, "scoreMethod": score_method, "wallTime": 0.0,
+              "status": "error", "message": "", "warmStart": init_bn is not None}
+
     # Create a new BN with the same structure as the original
     learned_bn = gum.BayesNet()
-    
+
     # Copy the structure from the original BN
     for node in bn.nodes():
         var = bn.variable(node)
         learned_bn.add(var)
     for arc in bn.arcs():
         learned_bn.addArc(arc[0], arc[1])
-    
+
     # Prepare data
-    new_data = pd.DataFrame()
+    new_data = pd.DataFrame(index=data.index)
     for node in learned_bn.nodes():
         var_name = learned_bn.variable(node).name()
         if var_name in data.columns:
@@ -23,35 +61,363 @@ def learn_cpt_generic(data, bn, score_method):
             print(f"Warning: Variable {var_name} not found in data. Adding with default values.")
             new_data[var_name] = 0
 
-    # Create a learner
-    learner = gum.BNLearner(new_data)
-
-    # Set the scoring method
-    if score_method == 'MDL':
-        learner.useScoreLog2Likelihood()
-    elif score_method == 'BIC':
-        learner.useScoreBIC()
-    elif score_method == 'MLE':
-        pass  # MLE is the default for parameter learning
-    else:
-        print(f"Unknown score method: {score_method}. Using default MLE.")
-
-    # Use EM algorithm for parameter learning
-    learner.useEM(epsilon=1e-4)
+    if score_method not in SCORE_METHODS:
+        raise ValueError(f"Unknown score method: {score_method}. Expected one of {SCORE_METHODS}")
 
     try:
-        # Learn parameters
-        learned_params = learner.learnParameters(learned_bn)
-        return learned_params
+        # Cold and warm starts run the same EM, from the template CPTs or from the previous network's
+        seed_cpts(learned_bn, init_bn, bn)
+        learned_params, iterations, message = expectation_maximization(learned_bn, new_data, epsilon, max_iter,
+                                                                       max_time)
+        report["iterations"] = iterations
+        report["message"] = message
+        report["status"] = em_status(message)
+        report["logLikelihood"] = log_likelihood(learned_params, new_data)
+        report["score"] = network_score(learned_params, new_data, score_method, report["logLikelihood"])
     except Exception as e:
         print(f"Error during parameter learning: {str(e)}")
-        return None
+        learned_params = None
+        report["message"] = str(e)
+    report["wallTime"] = time.time() - start_time
+
+    if return_report:
+        return learned_params, report
+    return learned_params
+
+
+def em_status(message):
+    """
+    Returns the convergence status encoded in a pyAgrum approximation scheme message
+
+    Parameters
+    ----------
+    message : str
+        Approximation scheme message
+
+    Returns
+    -------
+    str
+    """
+    if "max iteration" in message:
+        return "maxIter"
+    elif "timeout" in message:
+        return "maxTime"
+    return "converged"
+
+
+def log_likelihood(bn, data):
+    """
+    Returns the natural log-likelihood of the complete rows of the data under the network
+
+    Parameters
+    ----------
+    bn : pyAgrum.BayesNet
+        Network with learned CPTs
+    data : pandas.DataFrame
+        Integer encoded data, missing values encoded as -1
+
+    Returns
+    -------
+    float
+    """
+    names = [bn.variable(node).name() for node in bn.nodes()]
+    codes = data[names].to_numpy()
+    codes = codes[(codes >= 0).all(axis=1)]
+    columns = {name: i for i, name in enumerate(names)}
+
+    ll = 0.0
+    for node in bn.nodes():
+        cpt = bn.cpt(node)
+        p = cpt.toarray()[tuple(codes[:, columns[name]] for name in cpt_axes(cpt))]
+        ll += np.sum(np.log(p))
+    return float(ll)
+
+
+def network_score(bn, data, score_method, ll=None):
+    """
+    Returns the score of a network on the complete rows of the data: the natural log-likelihood (MLE), the
+    log-likelihood penalised by half the free parameters times the log of the rows (BIC), or the same in bits
+    (MDL), the negative description length of the data and parameters
+
+    Parameters
+    ----------
+    bn : pyAgrum.BayesNet
+        Network with learned CPTs
+    data : pandas.DataFrame
+        Integer encoded data, missing values encoded as -1
+    score_method : str
+        Scoring method (MDL, BIC or MLE)
+    ll : float, optional
+        Log-likelihood from log_likelihood(), computed if not given
+
+    Returns
+    -------
+    float
+    """
+    if ll is None:
+        ll = log_likelihood(bn, data)
+    if score_method == 'MLE':
+        return ll
+    names = [bn.variable(node).name() for node in bn.nodes()]
+    rows = int((data[names].to_numpy() >= 0).all(axis=1).sum())
+    parameters = sum((bn.variable(node).domainSize() - 1) * bn.cpt(node).domainSize()
+                     // bn.variable(node).domainSize() for node in bn.nodes())
+    penalty = 0.5 * parameters * np.log(max(rows, 1))
+    if score_method == 'BIC':
+        return float(ll - penalty)
+    return float((ll - penalty) / np.log(2))
+
+
+def cpt_axes(cpt):
+    """
+    Returns the variable names of a CPT in the axis order of its toarray() representation
+
+    Parameters
+    ----------
+    cpt : pyAgrum.Potential
+        Conditional probability table
+
+    Returns
+    -------
+    list
+    """
+    # toarray() orders the axes in reverse of the potential's variable sequence
+    return [cpt.variable(i).name() for i in range(cpt.nbrDim())][::-1]
+
+
+def seed_cpts(learned_bn, init_bn, bn):
+    """
+    Fills the CPTs of a network from a previously learned network, falling back to the
+    template network's CPTs for variables the previous network does not contain with the same parents,
+    and for all of them without a previous network
 
-def learn_cpt_mdl(data, bn):
-    return learn_cpt_generic(data, bn, 'MDL')
+    Parameters
+    ----------
+    learned_bn : pyAgrum.BayesNet
+        Network to seed
+    init_bn : pyAgrum.BayesNet or None
+        Previously learned network
+    bn : pyAgrum.BayesNet or pyAgrum.InfluenceDiagram
+        Template network
+    """
+    for node in learned_bn.nodes():
+        var_name = learned_bn.variable(node).name()
+        # A previous CPT only fits if the node kept the same parents
+        if init_bn is not None and var_name in init_bn.names() and \
+                set(cpt_axes(init_bn.cpt(init_bn.idFromName(var_name)))) == set(cpt_axes(learned_bn.cpt(node))):
+            learned_bn.cpt(node).fillWith(init_bn.cpt(init_bn.idFromName(var_name)))
+        elif isinstance(bn, gum.InfluenceDiagram) and not bn.isChanceNode(bn.idFromName(var_name)):
+            learned_bn.cpt(node).fillWith(1).normalizeAsCPT()
+        else:
+            learned_bn.cpt(node).fillWith(bn.cpt(bn.idFromName(var_name)))
+
+
+def expectation_maximization(bn, data, epsilon=1e-4, max_iter=None, max_time=None):
+    """
+    Learns the CPTs of a network with a count-based EM algorithm that starts from the CPTs
+    already held by the network. The joint distribution is enumerated, so this is meant for
+    networks as small as the INVEST networks.
+
+    Parameters
+    ----------
+    bn : pyAgrum.BayesNet
+        Network whose CPTs initialise EM; updated in place
+    data : pandas.DataFrame
+        Integer encoded data, missing values encoded as -1
+    epsilon : float, optional
+        EM stops when the sum of squared changes of the parameters drops below epsilon
+    max_iter : int, optional
+        Maximum number of EM iterations
+    max_time : float, optional
+        Time budget for EM in seconds
+
+    Returns
+    -------
+    tuple
+        Learned network, number of iterations and stopping message
+    """
+    start_time = time.time()
+    nodes = list(bn.nodes())
+    names = [bn.variable(node).name() for node in nodes]
+    cards = [bn.variable(node).domainSize() for node in nodes]
+    patterns, counts = np.unique(data[names].to_numpy(), axis=0, return_counts=True)
+    selections = [tuple(int(c) if c >= 0 else slice(None) for c in pattern) for pattern in patterns]
+
+    # Each CPT is held as an array broadcastable against the joint table over all variables
+    families = {}
+    for node in nodes:
+        cpt = bn.cpt(node)
+        positions = [names.index(name) for name in cpt_axes(cpt)]
+        order = np.argsort(positions)
+        shape = [cards[i] if i in positions else 1 for i in range(len(names))]
+        others = tuple(i for i in range(len(names)) if i not in positions)
+        families[node] = [cpt.toarray().transpose(order).reshape(shape), order, others]
+    children = {node: names.index(bn.variable(node).name()) for node in nodes}
+
+    iterations = 0
+    while True:
+        joint = np.ones(cards)
+        for table, _, _ in families.values():
+            joint = joint * table
+
+        # E-step: spread each distinct data pattern over the joint cells it is compatible with
+        expected = np.zeros(cards)
+        for selection, count in zip(selections, counts):
+            cells = joint[selection]
+            total = cells.sum()
+            if total > 0:
+                expected[selection] += count * cells / total
+
+        # M-step: re-estimate each CPT from the expected family counts
+        change = 0.0
+        for node, family in families.items():
+            table, _, others = family
+            family_counts = expected.sum(axis=others, keepdims=True)
+            norm = family_counts.sum(axis=children[node], keepdims=True)
+            updated = np.where(norm > 0, family_counts / np.where(norm > 0, norm, 1), table)
+            change += float(np.sum((updated - table) ** 2))
+            family[0] = updated
+        iterations += 1
+
+        if change < epsilon:
+            message = f"stopped with epsilon={epsilon}"
+            break
+        if max_iter is not None and iterations >= max_iter:
+            message = f"stopped with max iteration={max_iter}"
+            break
+        if max_time is not None and time.time() - start_time >= max_time:
+            message = f"stopped with timeout={max_time}"
+            break
+
+    for node, (table, order, others) in families.items():
+        bn.cpt(node)[:] = np.squeeze(table, axis=others).transpose(np.argsort(order))
+    return bn, iterations, message
+
+
+def learn_cpt_mdl(data, bn, **kwargs):
+    return learn_cpt_generic(data, bn, 'MDL', **kwargs)
+
+def learn_cpt_bic(data, bn, **kwargs):
+    return learn_cpt_generic(data, bn, 'BIC', **kwargs)
 
-def learn_cpt_bic(data, bn):
-    return learn_cpt_generic(data, bn, 'BIC')
+def learn_cpt_mle(data, bn, **kwargs):
+    return learn_cpt_generic(data, bn, 'MLE', **kwargs)
 
-def learn_cpt_mle(data, bn):
-    return learn_cpt_generic(data, bn, 'MLE')
\ No newline at end of file
+
+def bootstrap_cpts(data, network, n_boot=200, quantiles=(0.025, 0.5, 0.975), evidences=None, seed=None):
+    """
+    Bootstraps the CPTs of a network's chance nodes from count-based learning. The data is
+    resampled by drawing multinomial weights over its distinct rows for all replicates at once,
+    so every replicate's family counts come out of a single matrix product. The replicates are
+    centred on the network's current CPTs, e.g. those installed from EM, by their deviation from
+    the count estimate of the full data.
+
+    Parameters
+    ----------
+    data : pandas.DataFrame
+        Categorical learning data
+    network : ValueNetwork or QualityNetwork or InvestmentRecommendationNetwork
+        Network whose CPTs are bootstrapped
+    n_boot : int, optional
+        Number of bootstrap replicates
+    quantiles : tuple, optional
+        Quantiles reported for each CPT cell
+    evidences : list, optional
+        Evidence passed to network.make_decision to measure the decision flip rate; tuples are
+        unpacked as positional arguments
+    seed : int, optional
+        Seed of the random number generator
+
+    Returns
+    -------
+    dict
+    """
+    model = network.model
+    rng = np.random.default_rng(seed)
+    nodes = [node for node in model.nodes() if model.isChanceNode(node) and
+             all(name in data.columns for name in cpt_axes(model.cpt(node)))]
+    names = sorted({name for node in nodes for name in cpt_axes(model.cpt(node))})
+    codes = np.column_stack([data[name].cat.codes.to_numpy() for name in names])
+    patterns, counts = np.unique(codes, axis=0, return_counts=True)
+    weights = rng.multinomial(len(codes), counts / counts.sum(), size=n_boot)
+
+    cpts = {}
+    for node in nodes:
+        cpt = model.cpt(node)
+        axes = cpt_axes(cpt)
+        shape = cpt.toarray().shape
+        columns = [names.index(name) for name in axes]
+        child = axes.index(model.variable(node).name())
+        valid = (patterns[:, columns] >= 0).all(axis=1)
+        cells = np.ravel_multi_index(tuple(patterns[valid][:, columns].T), shape)
+        indicator = np.zeros((valid.sum(), int(np.prod(shape))))
+        indicator[np.arange(len(cells)), cells] = 1
+
+        # Point estimate and all replicates from the same indicator matrix
+        family_counts = np.vstack([counts[valid], weights[:, valid]]) @ indicator
+        family_counts = family_counts.reshape((n_boot + 1,) + shape)
+        norm = family_counts.sum(axis=child + 1, keepdims=True)
+        # Parent configurations never observed keep the network's current CPT
+        current = cpt.toarray()
+        tables = np.where(norm > 0, family_counts / np.where(norm > 0, norm, 1), current)
+
+        # The replicates vary around the count estimate; they are shifted onto the network's current
+        # (learned) CPT so the bands describe the CPTs the network decides with
+        samples = np.clip(current + tables[1:] - tables[0], 0, None)
+        norm = samples.sum(axis=child + 1, keepdims=True)
+        samples = np.where(norm > 0, samples / np.where(norm > 0, norm, 1), current)
+        cpts[model.variable(node).name()] = {
+            "axes": axes,
+            "estimate": current,
+            "countEstimate": tables[0],
+            "quantiles": np.quantile(samples, quantiles, axis=0),
+            "samples": samples,
+        }
+
+    result = {"cpts": cpts, "quantiles": list(quantiles), "flipRate": None, "flipRates": None}
+    if evidences:
+        result["flipRates"] = decision_flip_rates(network, cpts, evidences)
+        result["flipRate"] = float(np.mean(result["flipRates"]))
+    return result
+
+
+def decision_flip_rates(network, cpts, evidences):
+    """
+    Returns, for each evidence, the fraction of bootstrap replicates whose decision differs from
+    the decision under the network's current CPTs. The network's CPTs are restored afterwards.
+
+    Parameters
+    ----------
+    network : ValueNetwork or QualityNetwork or InvestmentRecommendationNetwork
+        Network whose decisions are evaluated
+    cpts : dict
+        Bootstrapped CPTs as returned in bootstrap_cpts()["cpts"]
+    evidences : list
+        Evidence passed to network.make_decision
+
+    Returns
+    -------
+    list
+    """
+    model = network.model
+    original = {name: model.cpt(model.idFromName(name)).toarray() for name in cpts}
+
+    def set_cpts(key):
+        for name, entry in cpts.items():
+            model.cpt(model.idFromName(name))[:] = entry["samples"][key]
+
+    def decide(evidence):
+        return network.make_decision(*evidence) if isinstance(evidence, tuple) else network.make_decision(evidence)
+
+    # The baseline decisions are those of the CPTs the network holds before any replicate is installed
+    baseline = [decide(evidence) for evidence in evidences]
+    try:
+        n_boot = len(next(iter(cpts.values()))["samples"]) if cpts else 0
+        flips = np.zeros(len(evidences))
+        for b in range(n_boot):
+            set_cpts(b)
+            flips += [decide(evidence) != base for evidence, base in zip(evidences, baseline)]
+    finally:
+        for name, table in original.items():
+            model.cpt(model.idFromName(name))[:] = table
+    return (flips / max(n_boot, 1)).tolist()
@@ -1,15 +1,61 @@
-import json
+from collections import OrderedDict
+
 import pandas as pd
 import pyAgrum as gum
+import invest.evaluation.backtest as backtest
 import invest.evaluation.validation as validation
-from invest.preprocessing.simulation import simulate
+import invest.metrics.portfolio as portfolio_metrics
+from invest.metrics.significance import bootstrap_significance
+from invest.preprocessing.dataloader import load_clean_data, load_price_matrix, load_universe
+from invest.preprocessing.simulation import column_statistics, replica_frames, simulate, simulate_replicas
 from invest.store import Store
 import numpy as np
 
-companies_jcsev = json.load(open('data/jcsev.json'))['names']
-companies_jgind = json.load(open('data/jgind.json'))['names']
-companies = companies_jcsev + companies_jgind
-companies_dict = {"JCSEV": companies_jcsev, "JGIND": companies_jgind}
+universe = load_universe()
+companies_dict = {code: sector["names"] for code, sector in universe["sectors"].items()}
+companies = list(dict.fromkeys(company for names in companies_dict.values() for company in names))
+
+# Stores of recent (data, year, thresholds), shared by the sectors evaluated on the same data
+STORE_CACHE_SIZE = 8
+store_cache = OrderedDict()
+
+
+def benchmark_code(index_code):
+    """
+    Returns the benchmark index of a sector
+    """
+    return universe["sectors"][index_code]["benchmark"]
+
+
+def year_store(df, params, year):
+    """
+    Returns the Store of all sectors of the universe for a year, computed once and shared by the sectors
+    evaluated on the same data and thresholds. The sector partitions are processed on params.workers
+    processes
+
+    Parameters
+    ----------
+    df : pandas.DataFrame
+        Company data
+    params : argparse.Namespace
+        Experiment parameters
+    year : int
+        Year to evaluate
+
+    Returns
+    -------
+    Store
+    """
+    key = (id(df), year, params.margin_of_safety, params.beta)
+    # The cached data frame is kept alive, so its id is not reused while the entry exists
+    if key in store_cache and store_cache[key][0] is df:
+        store_cache.move_to_end(key)
+        return store_cache[key][1]
+    store = Store(df, companies_dict, params.margin_of_safety, params.beta, year, False, params.workers)
+    store_cache[key] = (df, store)
+    if len(store_cache) > STORE_CACHE_SIZE:
+        store_cache.popitem(last=False)
+    return store
 
 
 def prepare_data_for_learning(df, value_net, quality_net, invest_net):
@@ -18,7 +64,7 @@ def prepare_data_for_learning(df, value_net, quality_net, invest_net):
     
     try:
         max_year = df['Date'].dt.year.max()
-        store = Store(df, companies, companies_jcsev, companies_jgind, 1.4, 0.6, max_year, False)
+        store = Store(df, companies_dict, 1.4, 0.6, max_year, False)
         store.process()
         
         learning_data = store.df_shares.copy()
@@ -70,57 +116,13 @@ def investment_portfolio(df_, params, index_code, value_net, quality_net, invest
     print(f"Total rows in data: {len(df_)}")
     
     if params.noise:
-        df = simulate(df_)
+        df = simulate(df_, seed=params.noise_seed)
     else:
         df = df_
 
-    prices_initial = {}
-    prices_current = {}
-    betas = {}
-    investable_shares = {}
-
-    for year in range(params.start, params.end):
-        print(f"\nProcessing year {year}")
-        year_data = df[(df['Date'] >= pd.Timestamp(f"{year}-01-01")) & (df['Date'] <= pd.Timestamp(f"{year}-12-31"))]
-        print(f"Data for year {year}: {len(year_data)} rows")
-        
-        store = Store(df, companies, companies_jcsev, companies_jgind,
-                      params.margin_of_safety, params.beta, year, False)
-        investable_shares[str(year)] = []
-        prices_initial[str(year)] = []
-        prices_current[str(year)] = []
-        betas[str(year)] = []
-        df_future_performance = pd.DataFrame()
-        
-        print(f"Number of companies being evaluated: {len(companies_dict[index_code])}")
-        
-        for company in companies_dict[index_code]:
-            if store.get_acceptable_stock(company):
-                print(f"Company {company} is acceptable")
-                if not df_future_performance.empty:
-                    future_performance = df_future_performance[company][0]
-                else:
-                    future_performance = None
-                if investment_decision(store, company, value_net, quality_net, invest_net, future_performance, 
-                                       params.extension, params.ablation, params.network) == "Yes":
-                    print(f"Company {company} selected for investment")
-                    mask = (df_['Date'] >= f"{year}-01-01") & (
-                            df_['Date'] <= f"{year}-12-31") & (df_['Name'] == company)
-                    df_year = df_[mask]
-
-                    if not df_year.empty:
-                        investable_shares[str(year)].append(company)
-                        prices_initial[str(year)].append(df_year.iloc[0]['Price'])
-                        prices_current[str(year)].append(df_year.iloc[params.holding_period]['Price'])
-                        betas[str(year)].append(df_year.iloc[params.holding_period]["ShareBeta"])
-                    else:
-                        print(f"Warning: No data found for {company} in year {year}")
-                else:
-                    print(f"Company {company} not selected for investment")
-            else:
-                print(f"Company {company} is not acceptable")
-
-        print(f"Number of investable shares for year {year}: {len(investable_shares[str(year)])}")
+    investable_shares = select_investable_shares(df, df_, params, index_code, value_net, quality_net, invest_net)
+    prices_initial, prices_current, betas = holding_prices(df_, investable_shares, params.start, params.end,
+                                                           params.holding_period)
 
     if verbose:
         print("\n{} {} - {}".format(index_code, params.start, params.end))
@@ -137,7 +139,10 @@ def investment_portfolio(df_, params, index_code, value_net, quality_net, invest
                                                                              params.end,
                                                                              index_code)
     benchmark_ar, benchmark_cr, benchmark_aar, benchmark_treynor, benchmark_sharpe = \
-        validation.process_benchmark_metrics(params.start, params.end, index_code, params.holding_period)
+        validation.process_benchmark_metrics(params.start, params.end, benchmark_code(index_code),
+                                             params.holding_period)
+
+    risk, significance = portfolio_risk(df_, params, index_code, investable_shares, params.holding_period, verbose)
 
     portfolio = {
         "ip": {
@@ -147,6 +152,7 @@ def investment_portfolio(df_, params, index_code, value_net, quality_net, invest
             "averageAnnualReturn": ip_aar,
             "treynor": ip_treynor,
             "sharpe": ip_sharpe,
+            **risk,
         },
         "benchmark": {
             "annualReturns": benchmark_ar,
@@ -154,11 +160,484 @@ def investment_portfolio(df_, params, index_code, value_net, quality_net, invest
             "averageAnnualReturn": benchmark_aar,
             "treynor": benchmark_treynor,
             "sharpe": benchmark_sharpe,
-        }
+        },
+        "significance": significance
     }
     return portfolio
 
 
+def portfolio_risk(df_, params, index_code, investable_shares, holding_period, verbose=False):
+    """
+    Returns the per-year backtest risk metrics of the investable shares held to the holding period, and the
+    block bootstrap test of the portfolio against its benchmark when params.significance_resamples is set
+
+    Parameters
+    ----------
+    df_ : pandas.DataFrame
+        Clean company data
+    params : argparse.Namespace
+        Experiment parameters
+    index_code : str
+        Sector index code
+    investable_shares : dict
+        Selected companies keyed by year string
+    holding_period : int
+        Row offset into each year to exit at
+    verbose : bool, optional
+        Print the significance test
+
+    Returns
+    -------
+    tuple
+        Max drawdown, volatility and downside deviation per year, and the significance test or None
+    """
+    matrix = load_price_matrix(params.price_matrix) if params.price_matrix else None
+    max_drawdowns, volatilities, downside_deviations = \
+        process_backtest_metrics(df_, investable_shares, params.start, params.end, holding_period, matrix)
+    risk = {"maxDrawdown": max_drawdowns, "volatility": volatilities, "downsideDeviation": downside_deviations}
+
+    significance = None
+    if params.significance_resamples > 0:
+        # The portfolio is marked to market on the benchmark's dates, so both curves have the same periods
+        benchmark_returns, dates, benchmark_entries = validation.benchmark_period_returns(
+            params.start, params.end, benchmark_code(index_code), holding_period)
+        returns, entries = portfolio_period_returns(df_, investable_shares, params.start, dates, matrix)
+        significance = bootstrap_significance(returns, benchmark_returns, [len(d) - 1 for d in dates], entries,
+                                              benchmark_entries,
+                                              validation.risk_free_rates(df_, params.start, params.end),
+                                              validation.risk_free_rates(load_clean_data(), params.start,
+                                                                         params.end),
+                                              params.significance_resamples, params.significance_block_size,
+                                              seed=params.significance_seed)
+        if verbose:
+            print("\nIP.{} vs {} ({} block bootstrap resamples)".format(index_code, benchmark_code(index_code),
+                                                                       params.significance_resamples))
+            for key in ["compoundReturn", "averageAnnualReturn", "sharpe"]:
+                lower, upper = significance[key]["confidenceInterval"]
+                print('{} difference {:5.4f} | {:.0%} CI [{:5.4f}, {:5.4f}] | p-value {:5.4f}'.format(
+                    key, significance[key]["difference"], significance["confidence"], lower, upper,
+                    significance[key]["pValue"]))
+    return risk, significance
+
+
+def select_investable_shares(df, df_, params, index_code, value_net, quality_net, invest_net):
+    """
+    Runs the investment decision for every company of the sector in every year
+
+    Parameters
+    ----------
+    df : pandas.DataFrame
+        Company data the decisions are made on, possibly with simulated noise
+    df_ : pandas.DataFrame
+        Clean company data; selected companies without prices in a year are skipped
+    params : argparse.Namespace
+        Experiment parameters
+    index_code : str
+        Sector index code
+
+    Returns
+    -------
+    dict
+        Selected companies keyed by year string
+    """
+    investable_shares = {}
+
+    for year in range(params.start, params.end):
+        print(f"\nProcessing year {year}")
+        year_data = df[(df['Date'] >= pd.Timestamp(f"{year}-01-01")) & (df['Date'] <= pd.Timestamp(f"{year}-12-31"))]
+        print(f"Data for year {year}: {len(year_data)} rows")
+
+        store = year_store(df, params, year)
+        investable_shares[str(year)] = []
+        df_future_performance = pd.DataFrame()
+
+        print(f"Number of companies being evaluated: {len(companies_dict[index_code])}")
+
+        for company in companies_dict[index_code]:
+            if store.get_acceptable_stock(company):
+                print(f"Company {company} is acceptable")
+                if not df_future_performance.empty:
+                    future_performance = df_future_performance[company][0]
+                else:
+                    future_performance = None
+                if investment_decision(store, company, value_net, quality_net, invest_net, future_performance,
+                                       params.extension, params.ablation, params.network) == "Yes":
+                    print(f"Company {company} selected for investment")
+                    mask = (df_['Date'] >= f"{year}-01-01") & (
+                            df_['Date'] <= f"{year}-12-31") & (df_['Name'] == company)
+
+                    if mask.any():
+                        investable_shares[str(year)].append(company)
+                    else:
+                        print(f"Warning: No data found for {company} in year {year}")
+                else:
+                    print(f"Company {company} not selected for investment")
+            else:
+                print(f"Company {company} is not acceptable")
+
+        print(f"Number of investable shares for year {year}: {len(investable_shares[str(year)])}")
+
+    return investable_shares
+
+
+def holding_prices(df, investable_shares, start_year, end_year, holding_period=-1):
+    """
+    Returns the entry prices, exit prices at the holding period and exit betas of the selected shares,
+    keyed by year string
+    """
+    prices_initial = {}
+    prices_current = {}
+    betas = {}
+
+    for year in range(start_year, end_year):
+        prices_initial[str(year)] = []
+        prices_current[str(year)] = []
+        betas[str(year)] = []
+        for company in investable_shares.get(str(year), []):
+            mask = (df['Date'] >= f"{year}-01-01") & (df['Date'] <= f"{year}-12-31") & (df['Name'] == company)
+            df_year = df[mask]
+            prices_initial[str(year)].append(df_year.iloc[0]['Price'])
+            prices_current[str(year)].append(df_year.iloc[holding_period]['Price'])
+            betas[str(year)].append(df_year.iloc[holding_period]["ShareBeta"])
+
+    return prices_initial, prices_current, betas
+
+
+def holding_period_sweep(df_, params, index_code, value_net, quality_net, invest_net, holding_periods,
+                         verbose=False):
+    """
+    Evaluates the portfolio for several holding periods while making the investment decisions once.
+    Prices and betas are gathered into a (company x year x row offset) tensor, the entry and exit
+    rows of all holding periods are taken from it in one step and the metrics of all holding periods
+    are computed as one batch. A share whose year has no row at a holding period is left out of that
+    holding period's portfolio.
+
+    Parameters
+    ----------
+    df_ : pandas.DataFrame
+        Clean company data
+    params : argparse.Namespace
+        Experiment parameters
+    index_code : str
+        Sector index code
+    holding_periods : list
+        Row offsets into each year to exit at, negative offsets counting back from the year end
+    verbose : bool, optional
+        Print the investable shares and metrics per holding period
+
+    Returns
+    -------
+    dict
+        Investable shares and the portfolio and benchmark metrics keyed by holding period
+    """
+    print(f"Processing sector: {index_code}")
+    holding_periods = list(dict.fromkeys(holding_periods))
+
+    if params.noise:
+        df = simulate(df_, seed=params.noise_seed)
+    else:
+        df = df_
+
+    investable_shares = select_investable_shares(df, df_, params, index_code, value_net, quality_net, invest_net)
+
+    sector = companies_dict[index_code]
+    metrics, held = selection_metrics(df_, sector, held_shares(investable_shares, sector, params.start, params.end),
+                                      params.start, params.end, holding_periods)
+
+    sweep = {"shares": investable_shares, "holdingPeriods": {}}
+    for h, holding_period in enumerate(holding_periods):
+        ip = {key: (metrics[key][h].tolist() if key == "annualReturns" else float(metrics[key][h]))
+              for key in metrics}
+        ip["shares"] = {str(year): [company for c, company in enumerate(sector) if held[h, c, y]]
+                        for y, year in enumerate(range(params.start, params.end))}
+        try:
+            benchmark = dict(zip(["annualReturns", "compoundReturn", "averageAnnualReturn", "treynor", "sharpe"],
+                                 validation.process_benchmark_metrics(params.start, params.end,
+                                                                      benchmark_code(index_code), holding_period)))
+        except IndexError as e:
+            print(f"Warning: {str(e)}")
+            benchmark = None
+        sweep["holdingPeriods"][holding_period] = {"ip": ip, "benchmark": benchmark}
+
+        if verbose:
+            print('IP.{} | HP {:3d} | CR {:5.2f}% | AAR {:5.2f}% | Treynor Ratio {:5.2f} | Sharpe Ratio: {:5.2f}'
+                  .format(index_code, holding_period, ip["compoundReturn"] * 100, ip["averageAnnualReturn"] * 100,
+                          ip["treynor"], ip["sharpe"]))
+
+    # The holding period of the experiment gets the same risk metrics and test as investment_portfolio()
+    if params.holding_period in sweep["holdingPeriods"]:
+        portfolio = sweep["holdingPeriods"][params.holding_period]
+        risk, portfolio["significance"] = portfolio_risk(df_, params, index_code, portfolio["ip"]["shares"],
+                                                         params.holding_period, verbose)
+        portfolio["ip"].update(risk)
+
+    return sweep
+
+
+def noise_replica_portfolios(df_, params, index_code, value_net, quality_net, invest_net, n_replicas, seed=None,
+                             verbose=False):
+    """
+    Evaluates the portfolio over n noisy replicas of the data. The replicas are generated in one batch
+    with a seeded generator, decisions are made on each replica and the metrics of all replicas are
+    computed as one batch on the clean prices.
+
+    Parameters
+    ----------
+    df_ : pandas.DataFrame
+        Clean company data
+    params : argparse.Namespace
+        Experiment parameters
+    index_code : str
+        Sector index code
+    n_replicas : int
+        Number of noisy replicas
+    seed : int, optional
+        Seed of the noise generator
+    verbose : bool, optional
+        Print the distribution of the metrics over the replicas
+
+    Returns
+    -------
+    dict
+        Investable shares per replica and each metric as an array over the replicas
+    """
+    print(f"Processing sector: {index_code}")
+    stats = column_statistics(df_)
+    replicas = simulate_replicas(df_, n_replicas, seed=seed, stats=stats)
+
+    sector = companies_dict[index_code]
+    shares = [select_investable_shares(df, df_, params, index_code, value_net, quality_net, invest_net)
+              for df in replica_frames(df_, replicas, stats["columns"])]
+    held = np.stack([held_shares(investable_shares, sector, params.start, params.end) for investable_shares in shares])
+    metrics, _ = selection_metrics(df_, sector, held, params.start, params.end, [params.holding_period])
+
+    replica_portfolios = {"shares": shares}
+    replica_portfolios.update({key: value[0] for key, value in metrics.items()})
+
+    if verbose:
+        print("\n{} {} - {} | {} noisy replicas".format(index_code, params.start, params.end, n_replicas))
+        for key in ["compoundReturn", "averageAnnualReturn", "treynor", "sharpe"]:
+            values = replica_portfolios[key]
+            print('IP.{} | {} mean {:5.4f} | std {:5.4f} | min {:5.4f} | max {:5.4f}'
+                  .format(index_code, key, np.mean(values), np.std(values), np.min(values), np.max(values)))
+
+    return replica_portfolios
+
+
+def threshold_grid_sweep(df_, params, index_code, value_net, quality_net, invest_net, margins_of_safety, betas,
+                         verbose=False):
+    """
+    Evaluates the portfolio for every (margin of safety, beta) pair of a grid. The continuous ratios are
+    computed once per year and re-discretized for the whole grid at once, decisions are made once per
+    distinct combination of evidence and the metrics of all grid points are computed as one batch.
+
+    Parameters
+    ----------
+    df_ : pandas.DataFrame
+        Clean company data
+    params : argparse.Namespace
+        Experiment parameters
+    index_code : str
+        Sector index code
+    margins_of_safety : list
+        Margins of safety of the grid
+    betas : list
+        Beta thresholds of the grid
+    verbose : bool, optional
+        Print the metrics of every grid point
+
+    Returns
+    -------
+    dict
+        Selection masks of shape (margins of safety, betas, companies, years) and each metric as a
+        (margins of safety, betas) array
+    """
+    print(f"Processing sector: {index_code}")
+    if params.noise:
+        df = simulate(df_, seed=params.noise_seed)
+    else:
+        df = df_
+
+    sector = companies_dict[index_code]
+    years = range(params.start, params.end)
+    held = np.zeros((len(margins_of_safety), len(betas), len(sector), len(years)), dtype=bool)
+    decisions = {}
+
+    for y, year in enumerate(years):
+        print(f"\nProcessing year {year}")
+        store = year_store(df, params, year)
+        grid = store.discretize_grid(sector, margins_of_safety, betas)
+
+        value_columns = ["current_PE_relative_share_market_to_historical",
+                         "current_PE_relative_share_sector_to_historical", "forward_PE_current_to_historical"]
+        quality_columns = ["roe_vs_coe", "relative_debt_to_equity", "growth_cagr_vs_inflation"]
+        if params.extension:
+            quality_columns.append("systematic_risk")
+        evidence = np.stack([grid[column] for column in value_columns + quality_columns], axis=-1)
+
+        for m, b, c in zip(*np.nonzero(grid["acceptable_stock"])):
+            key = tuple(evidence[m, b, c])
+            if key not in decisions:
+                value_evidence = dict(zip(['PERelative_ShareMarket', 'PERelative_ShareSector',
+                                           'ForwardPE_CurrentVsHistory'], key[:3]))
+                quality_evidence = dict(zip(['ROEvsCOE', 'RelDE', 'CAGRvsInflation', 'SystematicRisk'], key[3:]))
+                decisions[key] = evidence_decision(sector[c], value_evidence, quality_evidence, value_net,
+                                                   quality_net, invest_net, params.ablation, params.network)
+            held[m, b, c, y] = decisions[key] == "Yes"
+
+    print(f"Distinct evidence combinations evaluated: {len(decisions)}")
+    metrics, held = selection_metrics(df_, sector, held.reshape((-1,) + held.shape[2:]), params.start, params.end,
+                                      [params.holding_period])
+
+    grid_portfolios = {"marginsOfSafety": list(margins_of_safety), "betas": list(betas),
+                       "held": held[0].reshape((len(margins_of_safety), len(betas)) + held.shape[2:])}
+    grid_portfolios.update({key: value[0].reshape((len(margins_of_safety), len(betas)) + value.shape[2:])
+                            for key, value in metrics.items()})
+
+    if verbose:
+        for m, margin_of_safety in enumerate(margins_of_safety):
+            for b, beta in enumerate(betas):
+                print('IP.{} | MoS {:5.2f} | Beta {:5.2f} | CR {:5.2f}% | AAR {:5.2f}% | Treynor Ratio {:5.2f} | '
+                      'Sharpe Ratio: {:5.2f}'.format(index_code, margin_of_safety, beta,
+                                                     grid_portfolios["compoundReturn"][m, b] * 100,
+                                                     grid_portfolios["averageAnnualReturn"][m, b] * 100,
+                                                     grid_portfolios["treynor"][m, b], grid_portfolios["sharpe"][m, b]))
+
+    return grid_portfolios
+
+
+def held_shares(investable_shares, sector, start_year, end_year):
+    """
+    Returns a (company x year) mask of the investable shares of a sector
+    """
+    held = np.zeros((len(sector), end_year - start_year), dtype=bool)
+    for y, year in enumerate(range(start_year, end_year)):
+        for company in investable_shares.get(str(year), []):
+            held[sector.index(company), y] = True
+    return held
+
+
+def selection_metrics(df, sector, held, start_year, end_year, holding_periods):
+    """
+    Returns the metrics of one or many selections of shares for several holding periods at once. Prices
+    and betas are gathered into a (company x year x row offset) tensor and the entry and exit rows of all
+    holding periods are taken from it in one step. A share whose year has no row at a holding period is
+    left out of that holding period's portfolio.
+
+    Parameters
+    ----------
+    df : pandas.DataFrame
+        Clean company data
+    sector : list
+        Companies of the sector
+    held : numpy.ndarray
+        Selection masks of shape (..., companies, years)
+    start_year : int
+        First year
+    end_year : int
+        Year after the last year
+    holding_periods : list
+        Row offsets into each year to exit at
+
+    Returns
+    -------
+    tuple
+        Metrics of shape (holding periods, ...) and the masks of shares held, of shape
+        (holding periods, ..., companies, years)
+    """
+    tensors, counts = backtest.price_tensor(df, sector, start_year, end_year)
+    shape = (len(holding_periods),) + (1,) * (held.ndim - 2) + counts.shape
+    entry = backtest.gather_offsets(tensors['Price'], counts, [0])[0]
+    exit_ = backtest.gather_offsets(tensors['Price'], counts, holding_periods).reshape(shape)
+    betas = backtest.gather_offsets(tensors['ShareBeta'], counts, holding_periods).reshape(shape)
+    held = held[None] & ~np.isnan(exit_)
+
+    # Holdings along the last axis, NaN for shares not held
+    metrics = portfolio_metrics.portfolio_metrics(np.swapaxes(np.where(held, entry, np.nan), -1, -2),
+                                                  np.swapaxes(np.where(held, exit_, np.nan), -1, -2),
+                                                  np.swapaxes(np.where(held, betas, np.nan), -1, -2),
+                                                  validation.risk_free_rates(df, start_year, end_year))
+    return metrics, held
+
+
+def process_backtest_metrics(df, investable_shares, start_year, end_year, holding_period=-1, matrix=None):
+    """
+    Returns the per-year max drawdown, realised volatility and downside deviation of the mark-to-market portfolio
+    of investable shares, held from the first price of the year to the holding period. One share of each holding
+    is held, i.e. weights in proportion to the entry prices, as in portfolio_metrics(). The prices are sliced from
+    the wide price matrix when given, else pivoted from the long data
+    """
+    companies_held = sorted({c for year in range(start_year, end_year) for c in investable_shares[str(year)]})
+    if matrix is not None:
+        prices = backtest.matrix_prices(matrix, companies_held, f"{start_year}-01-01", f"{end_year - 1}-12-31")
+    else:
+        prices = backtest.price_matrix(df, companies_held, f"{start_year}-01-01", f"{end_year - 1}-12-31")
+    max_drawdowns, volatilities, downside_deviations = [], [], []
+    for year in range(start_year, end_year):
+        year_prices = prices.loc[prices.index.year == year, investable_shares[str(year)]]
+        rows = len(year_prices) + holding_period + 1 if holding_period < 0 else holding_period + 1
+        year_prices = year_prices.iloc[:rows]
+        if year_prices.empty or year_prices.shape[1] == 0:
+            max_drawdowns.append(0)
+            volatilities.append(0)
+            downside_deviations.append(0)
+            continue
+        values = year_prices.to_numpy()
+        entry = np.nansum(values[0])
+        weights = np.nan_to_num(values[0]) / entry if entry != 0 else None
+        metrics = backtest.backtest(values, weights, periods=backtest.periods_per_year(year_prices.index))
+        max_drawdowns.append(float(metrics["maxDrawdown"]))
+        volatilities.append(float(metrics["volatility"]))
+        downside_deviations.append(float(metrics["downsideDeviation"]))
+    return max_drawdowns, volatilities, downside_deviations
+
+
+def portfolio_period_returns(df, investable_shares, start_year, dates, matrix=None):
+    """
+    Returns the period returns over the given dates of each year of the mark-to-market portfolio of investable
+    shares, and its value at the entry of each year. The shares are held in proportion to their entry prices, so
+    the portfolio value is the sum of their prices as in portfolio_metrics(). Years without shares have zero
+    returns and value
+
+    Parameters
+    ----------
+    df : pandas.DataFrame
+        Clean company data
+    investable_shares : dict
+        Selected companies keyed by year string
+    start_year : int
+        First year
+    dates : list
+        Dates of each year from the entry to the exit at the holding period
+    matrix : tuple, optional
+        Wide price matrix from dataloader.load_price_matrix() to slice the prices from
+
+    Returns
+    -------
+    tuple
+        Period returns of all years in order and the entry value of each year
+    """
+    years = [str(year) for year in range(start_year, start_year + len(dates))]
+    companies_held = sorted({c for year in years for c in investable_shares[year]})
+    start_date, end_date = dates[0][0].strftime("%Y-%m-%d"), dates[-1][-1].strftime("%Y-%m-%d")
+    if matrix is not None:
+        prices = backtest.matrix_prices(matrix, companies_held, start_date, end_date)
+    else:
+        prices = backtest.price_matrix(df, companies_held, start_date, end_date)
+    returns, entries = [], []
+    for year, year_dates in zip(years, dates):
+        year_prices = prices.reindex(columns=investable_shares[year]).reindex(year_dates, method="ffill").to_numpy()
+        entry = float(np.nansum(year_prices[0])) if year_prices.size else 0.0
+        if entry == 0:
+            returns.append(np.zeros(len(year_dates) - 1))
+            entries.append(0.0)
+            continue
+        equity = backtest.equity_curve(year_prices, np.nan_to_num(year_prices[0]) / entry)
+        returns.append(backtest.period_returns(equity))
+        entries.append(entry)
+    return np.concatenate(returns), np.array(entries)
+
+
 def investment_decision(store, company, value_net, quality_net, invest_net, future_performance=None, 
                         extension=False, ablation=False, network='v'):
     # Prepare evidence for Value Network
@@ -170,12 +649,6 @@ def investment_decision(store, company, value_net, quality_net, invest_net, futu
     
     if future_performance is not None:
         value_evidence['FutureSharePerformance'] = future_performance
-    
-    print(f"Value evidence for {company}: {value_evidence}")
-    
-    # Make Value decision
-    value_decision = value_net.make_decision(value_evidence)
-    print(f"Value decision for {company}: {value_decision}")
 
     # Prepare evidence for Quality Network
     quality_evidence = {
@@ -186,6 +659,21 @@ def investment_decision(store, company, value_net, quality_net, invest_net, futu
     if extension:
         quality_evidence['SystematicRisk'] = store.get_systematic_risk(company)
 
+    return evidence_decision(company, value_evidence, quality_evidence, value_net, quality_net, invest_net,
+                             ablation, network)
+
+
+def evidence_decision(company, value_evidence, quality_evidence, value_net, quality_net, invest_net, ablation=False,
+                      network='v'):
+    """
+    Returns the investment decision for the given Value and Quality network evidence
+    """
+    print(f"Value evidence for {company}: {value_evidence}")
+
+    # Make Value decision
+    value_decision = value_net.make_decision(value_evidence)
+    print(f"Value decision for {company}: {value_decision}")
+
     print(f"Quality evidence for {company}: {quality_evidence}")
 
     # Make Quality decision
@@ -0,0 +1,260 @@
+import numpy as np
+import pandas as pd
+
+from invest.preprocessing.dataloader import date_rows
+
+
+def price_matrix(df, companies, start_date, end_date, value='Price'):
+    """
+    Returns a dense (date x company) price matrix for the given companies between two dates,
+    forward filled over days a company does not trade
+
+    Parameters
+    ----------
+    df : pandas.DataFrame
+        Long company data with Date, Name and price columns
+    companies : list
+        Companies to include as columns
+    start_date : str
+        First date (inclusive)
+    end_date : str
+        Last date (inclusive)
+    value : str, optional
+        Price column
+
+    Returns
+    -------
+    pandas.DataFrame
+    """
+    dates = pd.to_datetime(df['Date'])
+    mask = (dates >= pd.Timestamp(start_date)) & (dates <= pd.Timestamp(end_date)) & df['Name'].isin(companies)
+    wide = pd.DataFrame({'Date': dates[mask], 'Name': df.loc[mask, 'Name'], value: df.loc[mask, value]}) \
+        .pivot_table(index='Date', columns='Name', values=value, aggfunc='last')
+    return wide.reindex(columns=companies).sort_index().ffill()
+
+
+def matrix_prices(matrix, companies, start_date, end_date):
+    """
+    Returns the same dense (date x company) price matrix as price_matrix(), sliced from a wide price matrix
+    from dataloader.load_price_matrix() instead of pivoting the long data. Only the rows between the two
+    dates are read
+
+    Parameters
+    ----------
+    matrix : tuple
+        Prices of shape (dates, companies), their ascending dates and their company names
+    companies : list
+        Companies to include as columns
+    start_date : str
+        First date (inclusive)
+    end_date : str
+        Last date (inclusive)
+
+    Returns
+    -------
+    pandas.DataFrame
+    """
+    values, dates, names = matrix
+    rows = date_rows(dates, start_date, end_date)
+    columns = pd.Index(names).get_indexer(companies)
+    prices = np.where(columns >= 0, values[rows][:, np.maximum(columns, 0)], np.nan)
+    wide = pd.DataFrame(prices, index=pd.DatetimeIndex(dates[rows], name='Date'), columns=companies)
+    # As in the pivot, only dates with a price of one of the companies are kept
+    return wide[wide.notna().any(axis=1)].ffill()
+
+
+def price_tensor(df, companies, start_year, end_year, values=('Price', 'ShareBeta')):
+    """
+    Returns NaN padded (company x year x row offset) tensors of the given columns, where offset k is the
+    k-th row of a company in a year in frame order, i.e. what df_year.iloc[k] selects
+
+    Parameters
+    ----------
+    df : pandas.DataFrame
+        Long company data with Date, Name and value columns
+    companies : list
+        Companies along the first axis
+    start_year : int
+        First year
+    end_year : int
+        Year after the last year
+    values : tuple, optional
+        Columns to gather
+
+    Returns
+    -------
+    tuple
+        Dict of tensors keyed by column and the (company x year) row counts
+    """
+    dates = pd.to_datetime(df['Date'])
+    company = pd.Categorical(df['Name'], categories=companies).codes
+    year = dates.dt.year.to_numpy() - start_year
+    mask = (company >= 0) & (year >= 0) & (year < end_year - start_year)
+    company, year = company[mask], year[mask]
+    offset = pd.DataFrame({'c': company, 'y': year}).groupby(['c', 'y']).cumcount().to_numpy()
+
+    counts = np.zeros((len(companies), end_year - start_year), dtype=np.int64)
+    np.add.at(counts, (company, year), 1)
+    tensors = {}
+    for value in values:
+        tensor = np.full(counts.shape + (max(int(counts.max(initial=0)), 1),), np.nan)
+        tensor[company, year, offset] = df[value].to_numpy(dtype=np.float64)[mask]
+        tensors[value] = tensor
+    return tensors, counts
+
+
+def gather_offsets(tensor, counts, offsets):
+    """
+    Gathers one row offset per company and year for each of several offsets at once; negative offsets
+    count back from the last row of the year as in iloc. Offsets past the rows of a year give NaN
+
+    Parameters
+    ----------
+    tensor : numpy.ndarray
+        Values of shape (companies, years, offsets) from price_tensor()
+    counts : numpy.ndarray
+        Row counts of shape (companies, years)
+    offsets : list
+        Row offsets
+
+    Returns
+    -------
+    numpy.ndarray
+        Values of shape (len(offsets), companies, years)
+    """
+    offsets = np.asarray(offsets, dtype=np.int64)[:, None, None]
+    rows = np.where(offsets >= 0, offsets, counts + offsets)
+    valid = (rows >= 0) & (rows < counts)
+    index = np.clip(rows, 0, tensor.shape[-1] - 1)
+    gathered = np.take_along_axis(tensor[None], index[..., None], axis=-1)[..., 0]
+    return np.where(valid, gathered, np.nan)
+
+
+def periods_per_year(dates):
+    """
+    Returns the number of observations per year implied by the median spacing of the dates
+    """
+    dates = pd.DatetimeIndex(dates)
+    if len(dates) < 2:
+        return 1
+    spacing = np.median(np.diff(dates.values).astype('timedelta64[D]').astype(np.float64))
+    return max(int(round(365.25 / spacing)), 1) if spacing > 0 else 1
+
+
+def forward_fill(prices):
+    """
+    Forward fills NaN prices along the date axis of a (..., dates, holdings) array
+    """
+    prices = np.asarray(prices, dtype=np.float64)
+    index = np.where(np.isnan(prices), 0, np.arange(prices.shape[-2])[:, None])
+    index = np.maximum.accumulate(index, axis=-2)
+    return np.take_along_axis(prices, index, axis=-2)
+
+
+def equity_curve(prices, weights=None):
+    """
+    Returns the buy-and-hold equity curve, starting at 1, of portfolios held from the first date
+
+    Parameters
+    ----------
+    prices : numpy.ndarray
+        Prices of shape (..., dates, holdings); a holding is held as cash until its first price
+    weights : numpy.ndarray, optional
+        Initial weights of shape (..., holdings), equal weights by default
+
+    Returns
+    -------
+    numpy.ndarray
+        Equity of shape (..., dates)
+    """
+    prices = forward_fill(prices)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        gross = prices[..., 1:, :] / prices[..., :-1, :]
+    gross = np.where(np.isfinite(gross), gross, 1.0)
+    growth = np.concatenate([np.ones_like(prices[..., :1, :]), np.cumprod(gross, axis=-2)], axis=-2)
+    if weights is None:
+        weights = np.full(prices.shape[-1], 1 / max(prices.shape[-1], 1))
+    return np.sum(growth * np.asarray(weights)[..., None, :], axis=-1)
+
+
+def period_returns(equity):
+    """
+    Returns the period returns of an equity curve of shape (..., dates)
+    """
+    equity = np.asarray(equity, dtype=np.float64)
+    return equity[..., 1:] / equity[..., :-1] - 1
+
+
+def drawdown(equity):
+    """
+    Returns the drawdown from the running peak of an equity curve of shape (..., dates)
+    """
+    equity = np.asarray(equity, dtype=np.float64)
+    return equity / np.maximum.accumulate(equity, axis=-1) - 1
+
+
+def realized_volatility(equity, periods=252):
+    """
+    Returns the annualised volatility of the period returns of an equity curve
+    """
+    returns = period_returns(equity)
+    if returns.shape[-1] < 2:
+        return np.zeros(returns.shape[:-1])
+    return np.std(returns, axis=-1, ddof=1) * np.sqrt(periods)
+
+
+def downside_deviation(equity, periods=252, minimum_acceptable_return=0.0):
+    """
+    Returns the annualised downside deviation of the period returns of an equity curve
+    """
+    returns = period_returns(equity)
+    if returns.shape[-1] == 0:
+        return np.zeros(returns.shape[:-1])
+    shortfall = np.minimum(returns - minimum_acceptable_return, 0)
+    return np.sqrt(np.mean(shortfall ** 2, axis=-1)) * np.sqrt(periods)
+
+
+def rolling_volatility(equity, window, periods=252):
+    """
+    Returns the annualised volatility over every trailing window of period returns, computed from
+    cumulative sums, with NaN where fewer than window returns are available
+    """
+    returns = period_returns(equity)
+    zeros = np.zeros(returns.shape[:-1] + (1,))
+    s1 = np.concatenate([zeros, np.cumsum(returns, axis=-1)], axis=-1)
+    s2 = np.concatenate([zeros, np.cumsum(returns ** 2, axis=-1)], axis=-1)
+    total = s1[..., window:] - s1[..., :-window]
+    squares = s2[..., window:] - s2[..., :-window]
+    variance = np.maximum((squares - total ** 2 / window) / max(window - 1, 1), 0)
+    rolling = np.full(returns.shape, np.nan)
+    rolling[..., window - 1:] = np.sqrt(variance) * np.sqrt(periods)
+    return rolling
+
+
+def backtest(prices, weights=None, periods=252):
+    """
+    Returns the mark-to-market equity curve, drawdown, max drawdown, realised volatility and downside
+    deviation of one or many buy-and-hold portfolios, e.g. one per walk-forward step or noise replica
+
+    Parameters
+    ----------
+    prices : numpy.ndarray
+        Prices of shape (..., dates, holdings)
+    weights : numpy.ndarray, optional
+        Initial weights of shape (..., holdings), equal weights by default
+    periods : int, optional
+        Observations per year used to annualise
+
+    Returns
+    -------
+    dict
+    """
+    equity = equity_curve(prices, weights)
+    drawdowns = drawdown(equity)
+    return {
+        "equity": equity,
+        "drawdown": drawdowns,
+        "maxDrawdown": drawdowns.min(axis=-1),
+        "volatility": realized_volatility(equity, periods),
+        "downsideDeviation": downside_deviation(equity, periods),
+    }
@@ -0,0 +1,133 @@
+import hashlib
+import json
+import os
+
+import numpy as np
+import pandas as pd
+
+# Task results are appended as CSV rows, one per (configuration, method, train_end, sector) task and fsynced as
+# they are written, instead of a columnar file: a Parquet or Feather file cannot be appended to row by row without
+# rewriting it, and would add pyarrow as a dependency. The rows are few, so reading them back is cheap
+RESULTS_FILE = os.path.join('data', 'experiment_results.csv')
+
+RESULT_COLUMNS = ["config", "method", "trainEnd", "sector", "CR", "AAR", "TR", "SR"]
+
+# Arguments that only control where and whether results are stored and how they are computed, not the results
+OUTPUT_ARGUMENTS = ["results_file", "resume", "summarize_only", "workers", "price_matrix", "structure_export"]
+
+
+def config_key(args):
+    """
+    Returns a short hash of the experiment configuration identifying its results
+
+    Parameters
+    ----------
+    args : argparse.Namespace
+        Experiment parameters
+
+    Returns
+    -------
+    str
+    """
+    config = {k: v for k, v in sorted(vars(args).items()) if k not in OUTPUT_ARGUMENTS}
+    return hashlib.sha1(json.dumps(config, sort_keys=True, default=str).encode()).hexdigest()[:12]
+
+
+def load_result_rows(results_file=RESULTS_FILE, config=None):
+    """
+    Returns the stored task results, the latest row per task, optionally only those of one configuration.
+    A partly written last row left by an interrupted run is skipped
+
+    Parameters
+    ----------
+    results_file : str
+        Results file
+    config : str, optional
+        Configuration key from config_key()
+
+    Returns
+    -------
+    pandas.DataFrame
+    """
+    if results_file is None or not os.path.isfile(results_file) or os.path.getsize(results_file) == 0:
+        return pd.DataFrame(columns=RESULT_COLUMNS)
+    rows = pd.read_csv(results_file, dtype=str, keep_default_na=False, on_bad_lines='skip')
+    if not ends_with_newline(results_file) and len(rows) > 0:
+        rows = rows.iloc[:-1]
+    # Missing values are written as nan, so an empty field can only come from a partly written row
+    rows = rows[~(rows[RESULT_COLUMNS] == '').any(axis=1)]
+    numeric = rows[["trainEnd", "CR", "AAR", "TR", "SR"]].apply(pd.to_numeric, errors='coerce')
+    rows = pd.concat([rows[["config", "method", "sector"]], numeric], axis=1)[RESULT_COLUMNS]
+    rows = rows[rows["trainEnd"].notna()].astype({"trainEnd": np.int64})
+    if config is not None:
+        rows = rows[rows["config"] == config]
+    return rows.drop_duplicates(subset=RESULT_COLUMNS[:4], keep='last').reset_index(drop=True)
+
+
+def append_result(row, results_file=RESULTS_FILE):
+    """
+    Appends one task result to the results file and flushes it to disk before returning
+
+    Parameters
+    ----------
+    row : dict
+        Task result with the RESULT_COLUMNS keys
+    results_file : str
+        Results file
+    """
+    if results_file is None:
+        return
+    directory = os.path.dirname(results_file)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    new_file = not os.path.isfile(results_file) or os.path.getsize(results_file) == 0
+    torn = not new_file and not ends_with_newline(results_file)
+    with open(results_file, 'a') as f:
+        if torn:
+            # Terminates the partly written row of an interrupted run so it stays a single bad row
+            f.write('\n')
+        pd.DataFrame([row], columns=RESULT_COLUMNS).to_csv(f, header=new_file, index=False, na_rep='nan')
+        f.flush()
+        os.fsync(f.fileno())
+
+
+def ends_with_newline(path):
+    """
+    Returns whether the last row of a file was completely written
+    """
+    with open(path, 'rb') as f:
+        f.seek(-1, os.SEEK_END)
+        return f.read(1) == b'\n'
+
+
+def completed_tasks(rows, method):
+    """
+    Returns the stored metrics of the completed (train end, sector) tasks of a method
+    """
+    rows = rows[rows["method"] == method]
+    return {(int(r.trainEnd), r.sector): {"CR": r.CR, "AAR": r.AAR, "TR": r.TR, "SR": r.SR}
+            for r in rows.itertuples(index=False)}
+
+
+def results_from_rows(rows, sectors):
+    """
+    Returns stored task results in the structure returned by run_experiments, ordered by train end, for use
+    with summarize_results and print_results_table
+
+    Parameters
+    ----------
+    rows : pandas.DataFrame
+        Task results from load_result_rows()
+    sectors : list
+        Sectors to include
+
+    Returns
+    -------
+    dict
+    """
+    results = {}
+    for method, method_rows in rows.sort_values("trainEnd", kind="stable").groupby("method", sort=False):
+        results[method] = {sector: {key: method_rows.loc[method_rows["sector"] == sector, key].tolist()
+                                    for key in ["CR", "AAR", "TR", "SR"]}
+                           for sector in sectors}
+    return results
@@ -1,166 +1,206 @@
-import math
+import json
+import os
 
 import numpy as np
 import pandas as pd
 
-import invest.metrics.return_ as return_metrics
-from invest.preprocessing.dataloader import load_benchmark_data
+import invest.metrics.portfolio as portfolio_metrics
+from invest.preprocessing.dataloader import load_benchmark_series, load_clean_data
+
+BENCHMARK_CACHE_FILE = os.path.join('data', 'benchmark_cache.json')
+
+_benchmark_caches = {}
 
 
 def process_metrics(df, prices_initial_dict, prices_current_dict, share_betas_dict, start_year,
                     end_year, index_code):
-    annual_returns = []
-    total_return = 0
-    for year in range(start_year, end_year):
-        return_ = sum(prices_current_dict[str(year)]) - sum(prices_initial_dict[str(year)])
-        total_return += return_
-        if np.abs(return_) > 0:
-            annual_return = return_metrics.annual_return(np.array(prices_initial_dict[str(year)]),
-                                                         np.array(prices_current_dict[str(year)]))
-        else:
-            annual_return = 0
-        annual_returns.append(annual_return)
+    metrics = portfolio_metrics.portfolio_metrics(
+        portfolio_metrics.pack_holdings(prices_initial_dict, start_year, end_year),
+        portfolio_metrics.pack_holdings(prices_current_dict, start_year, end_year),
+        portfolio_metrics.pack_holdings(share_betas_dict, start_year, end_year),
+        risk_free_rates(df, start_year, end_year))
+    annual_returns = metrics["annualReturns"].tolist()
     print("\nAnnual Returns")
     print("IP." + index_code, ["{}%".format(round(v * 100, 2)) for v in annual_returns])
 
-    pv = sum(prices_initial_dict[str(start_year)])
-    y = start_year
-    while pv == 0 and y != (end_year - 1):
-        y += 1
-        pv = sum(prices_initial_dict[str(y)])
-    pv_ = pv + total_return
-    n = end_year - start_year
-    if np.abs(pv_ - pv) > 0:
-        compound_return = return_metrics.compound_return(pv, pv_, n)
-    else:
-        compound_return = 0
-    average_annual_return = return_metrics.average_annual_return(annual_returns)
+    compound_return = float(metrics["compoundReturn"])
+    average_annual_return = float(metrics["averageAnnualReturn"])
     print("Performance Metrics")
     print('IP.{} | CR {:5.2f}% | AAR {:5.2f}%'.format(index_code, compound_return * 100,
                                                       average_annual_return * 100))
-    treynor_ratio, sharpe_ratio = process_risk_adjusted_return_metrics(df, share_betas_dict, start_year, end_year,
-                                                                       compound_return,
-                                                                       average_annual_return, annual_returns,
-                                                                       index_code)
+    treynor_ratio, sharpe_ratio = float(metrics["treynor"]), float(metrics["sharpe"])
+    print('IP.{} | Treynor Ratio {:5.2f} | Sharpe Ratio: {:5.2f}'.format(index_code, treynor_ratio, sharpe_ratio))
 
     return annual_returns, compound_return, average_annual_return, treynor_ratio, sharpe_ratio
 
 
+def risk_free_rates(df, start_year, end_year):
+    """
+    Returns the risk free rate of return on the last row of each year as a fraction
+    """
+    years = pd.DatetimeIndex(df['Date']).year
+    last = ~years.duplicated(keep='last')
+    rates = pd.Series(df['RiskFreeRateOfReturn'].to_numpy()[last] / 100, index=years[last])
+    missing = [year for year in range(start_year, end_year) if year not in rates.index]
+    for year in missing:
+        print(f"Warning: No data found for year {year}")
+    return rates.reindex(range(start_year, end_year), fill_value=0).to_numpy(dtype=np.float64)
+
+
 def process_risk_adjusted_return_metrics(df, share_betas_dict,
                                          start_year, end_year, compound_return, average_annual_return,
                                          annual_returns, index_code):
     """
     Processes risk adjusted return metrics (Treynor Ratio, Sharpe Ratio) for selected portfolio
     """
-    portfolio_return = compound_return * 100
-    betas = []
-    rf = []
-    for year in range(start_year, end_year):
-        betas += share_betas_dict[str(year)]
-        mask = (df['Date'] >= f"{year}-01-01") & (df['Date'] <= f"{year}-12-31")
-        year_data = df[mask]
-        if not year_data.empty:
-            rf.append(year_data.iloc[-1]['RiskFreeRateOfReturn'] / 100)
-        else:
-            print(f"Warning: No data found for year {year}")
-            rf.append(0)  # or some default value
-
-    beta_portfolio = np.mean(betas) if betas else 0
-    risk_free_rate = np.mean(rf) if rf else 0
-
-    if beta_portfolio > 0:
-        treynor_ratio = return_metrics.treynor_ratio(portfolio_return, risk_free_rate, beta_portfolio)
-    else:
-        treynor_ratio = 0
-
-    delta = average_annual_return - np.mean(rf)
-    excess_returns = []
-    for i, annual_return in enumerate(annual_returns):
-        excess_returns.append(annual_return - rf[i])
-
-    v = 0
-    for e in excess_returns:
-        v += (e - delta) ** 2
-    standard_deviation_excess_return = math.sqrt(v) if v > 0 else 0
-    sharpe_ratio = return_metrics.sharpe_ratio(portfolio_return, risk_free_rate, standard_deviation_excess_return)
+    treynor_ratio, sharpe_ratio = portfolio_metrics.risk_adjusted_metrics(
+        compound_return, average_annual_return, annual_returns,
+        portfolio_metrics.pack_holdings(share_betas_dict, start_year, end_year),
+        risk_free_rates(df, start_year, end_year))
+    treynor_ratio, sharpe_ratio = float(treynor_ratio), float(sharpe_ratio)
     print('IP.{} | Treynor Ratio {:5.2f} | Sharpe Ratio: {:5.2f}'.format(index_code, treynor_ratio, sharpe_ratio))
 
     return treynor_ratio, sharpe_ratio
 
 
-def process_benchmark_metrics(start_year, end_year, index_code, holding_period=-1):
-    """
-    Processes risk return metrics (Annual Return, Compound Return, Annual Average Return) for selected benchmark
-    """
-    df = load_benchmark_data(index_code)
-    annual_returns = []
-    total_return = 0
-    for year in range(start_year, end_year):
-        mask = (df['Date'] >= str(year) + '/01/01') & (df['Date'] <= str(year) + '/12/31')
-        pv = float(df.loc[mask, 'Close'].iloc[0].replace(',', '.'))
-        pv_ = float(df.loc[mask, 'Close'].iloc[holding_period].replace(',', '.'))
-        return_ = pv_ - pv
-        total_return += return_
-        if np.abs(return_) > 0:
-            annual_return = return_metrics.annual_return(pv, pv_)
-        else:
-            annual_return = 0
-        annual_returns.append(annual_return)
+def process_benchmark_metrics(start_year, end_year, index_code, holding_period=-1, cache_file=BENCHMARK_CACHE_FILE):
+    """
+    Processes risk return metrics (Annual Return, Compound Return, Annual Average Return) for selected benchmark.
+    Results are memoized per (index_code, start_year, end_year, holding_period) and persisted to cache_file until
+    the benchmark or clean data files change
+    """
+    key = "{}|{}|{}|{}".format(index_code, start_year, end_year, holding_period)
+    sources = benchmark_sources(index_code)
+    cache = load_benchmark_cache(cache_file)
+    entry = cache.get(key)
+    if entry is None or entry["sources"] != sources:
+        entry = {"sources": sources,
+                 "metrics": compute_benchmark_metrics(start_year, end_year, index_code, holding_period)}
+        cache[key] = entry
+        save_benchmark_cache(cache, cache_file)
+    annual_returns, compound_return, average_annual_return, treynor_ratio, sharpe_ratio = entry["metrics"]
+
     print("\nAnnual Returns")
     print("Benchmark." + index_code, ["{}%".format(round(v * 100, 2)) for v in annual_returns])
-
-    mask = (df['Date'] >= str(start_year) + '/01/01') & (df['Date'] <= str(start_year) + '/12/31')
-    pv = float(df.loc[mask, 'Close'].iloc[0].replace(',', '.'))
-    y = start_year
-    while pv == 0 and y != end_year:
-        y += 1
-        mask = (df['Date'] >= str(y) + '-01-01') & (df['Date'] <= str(y) + '-12-31')
-        pv = float(df.loc[mask, 'Close'].iloc[0].replace(',', '.'))
-    pv_ = pv + total_return
-    n = end_year - start_year
-    compound_return = return_metrics.compound_return(pv, pv_, n)
-    average_annual_return = return_metrics.average_annual_return(annual_returns)
-
     print("Performance Measures")
     print('Benchmark.{} | CR {:5.2f}% | AAR {:5.2f}%'.format(index_code, compound_return * 100,
                                                              average_annual_return * 100))
-    treynor_ratio, sharpe_ratio = process_benchmark_risk_adjusted_return_metrics(df, start_year, end_year, index_code,
-                                                                                 compound_return,
-                                                                                 average_annual_return, annual_returns)
+    print(
+        'Benchmark.{} | Treynor Ratio {:5.2f} | Sharpe Ratio: {:5.2f}'.format(index_code, treynor_ratio, sharpe_ratio))
 
-    return annual_returns, compound_return, average_annual_return, treynor_ratio, sharpe_ratio
+    return list(annual_returns), compound_return, average_annual_return, treynor_ratio, sharpe_ratio
 
 
-def process_benchmark_risk_adjusted_return_metrics(df, start_year, end_year, index_code, compound_return,
-                                                   average_annual_return, annual_returns):
+def compute_benchmark_metrics(start_year, end_year, index_code, holding_period=-1):
     """
-    Processes risk adjusted return metrics (Treynor Ratio, Sharpe Ratio) for selected benchmark
+    Computes Annual Returns, Compound Return, Annual Average Return, Treynor Ratio and Sharpe Ratio for selected
+    benchmark
     """
-    df_ = pd.read_csv('data/INVEST_clean.csv')
-    portfolio_return = compound_return * 100
-    rf = []
-    for year in range(start_year, end_year):
-        mask = (df_['Date'] >= str(year) + '-01-01') & (df_['Date'] <= str(year) + '-12-31')
-        rf.append(df_[mask].iloc[-1]['RiskFreeRateOfReturn'] / 100)
+    entry_prices, exit_prices, start_betas = benchmark_prices(start_year, end_year, index_code, holding_period)
+    betas = np.full((len(start_betas), 1), np.nan)
+    betas[0, 0] = start_betas[0]
+    metrics = portfolio_metrics.portfolio_metrics(entry_prices[:, None], exit_prices[:, None], betas,
+                                                  risk_free_rates(load_clean_data(), start_year, end_year))
+    return (metrics["annualReturns"].tolist(), float(metrics["compoundReturn"]),
+            float(metrics["averageAnnualReturn"]), float(metrics["treynor"]), float(metrics["sharpe"]))
 
-    mask = (df['Date'] >= str(start_year) + '/01/01') & (df['Date'] <= str(start_year) + '/12/31')
-    df.loc[mask, 'Beta Weekly Leveraged'] = [x.replace(',', '.') for x in df.loc[mask, 'Beta Weekly Leveraged']]
-    beta_portfolio = np.mean(df.loc[mask, 'Beta Weekly Leveraged'].values.astype(np.float32))
-    risk_free_rate = np.mean(rf)
 
-    treynor_ratio = return_metrics.treynor_ratio(portfolio_return, risk_free_rate, beta_portfolio)
+def benchmark_prices(start_year, end_year, index_code, holding_period=-1):
+    """
+    Returns the per-year entry prices, exit prices at the holding period and mean weekly leveraged beta of the
+    selected benchmark
+    """
+    df = load_benchmark_series(index_code)
+    lo, hi, exit_rows = benchmark_rows(df, start_year, end_year, index_code, holding_period)
+    close = df['Close'].to_numpy(dtype=np.float64)
+    beta = df['Beta Weekly Leveraged'].to_numpy()
+    start_betas = np.array([np.mean(beta[i:j].astype(np.float32)) for i, j in zip(lo, hi)], dtype=np.float64)
+    return close[lo], close[exit_rows], start_betas
 
-    delta = average_annual_return - np.mean(rf)
-    excess_returns = []
-    for i, annual_return in enumerate(annual_returns):
-        excess_returns.append(annual_return - rf[i])
 
-    v = 0
-    for e in excess_returns:
-        v += (e - delta) ** 2
-    standard_deviation_excess_return = math.sqrt(v)
-    sharpe_ratio = return_metrics.sharpe_ratio(portfolio_return, risk_free_rate, standard_deviation_excess_return)
-    print(
-        'Benchmark.{} | Treynor Ratio {:5.2f} | Sharpe Ratio: {:5.2f}'.format(index_code, treynor_ratio, sharpe_ratio))
+def benchmark_rows(df, start_year, end_year, index_code, holding_period=-1):
+    """
+    Returns the first row, the row after the last and the exit row at the holding period of each year of a
+    benchmark series
+    """
+    years = np.arange(start_year, end_year)
+    year_of = df['Date'].dt.year.to_numpy()
+    lo = np.searchsorted(year_of, years, side='left')
+    hi = np.searchsorted(year_of, years, side='right')
+    exit_rows = lo + holding_period if holding_period >= 0 else hi + holding_period
+    if np.any(hi <= lo) or np.any(exit_rows < lo) or np.any(exit_rows >= hi):
+        raise IndexError("Benchmark {} has no row for holding period {} in every year from {} to {}".format(
+            index_code, holding_period, start_year, end_year - 1))
+    return lo, hi, exit_rows
+
+
+def benchmark_period_returns(start_year, end_year, index_code, holding_period=-1):
+    """
+    Returns the period returns of the selected benchmark from the entry to the exit row of each year, the dates
+    of the rows of each year they span and the entry prices
+    """
+    df = load_benchmark_series(index_code)
+    lo, hi, exit_rows = benchmark_rows(df, start_year, end_year, index_code, holding_period)
+    close = df['Close'].to_numpy(dtype=np.float64)
+    returns = [close[i + 1:j + 1] / close[i:j] - 1 for i, j in zip(lo, exit_rows)]
+    dates = [pd.DatetimeIndex(df['Date'].iloc[i:j + 1]) for i, j in zip(lo, exit_rows)]
+    return np.concatenate(returns), dates, close[lo]
+
+
+def process_window_metrics(df, prices_initial_dict, prices_current_dict, share_betas_dict, start_year, end_year):
+    """
+    Processes CR, AAR, Treynor Ratio and Sharpe Ratio of the selected portfolio over every contiguous window of
+    years in a single pass. Entry [i, j] covers start_year + i to start_year + j inclusive
+    """
+    return portfolio_metrics.window_metrics(
+        portfolio_metrics.pack_holdings(prices_initial_dict, start_year, end_year),
+        portfolio_metrics.pack_holdings(prices_current_dict, start_year, end_year),
+        portfolio_metrics.pack_holdings(share_betas_dict, start_year, end_year),
+        risk_free_rates(df, start_year, end_year))
+
+
+def process_benchmark_window_metrics(start_year, end_year, index_code, holding_period=-1):
+    """
+    Processes CR, AAR, Treynor Ratio and Sharpe Ratio of the selected benchmark over every contiguous window of
+    years in a single pass. Entry [i, j] covers start_year + i to start_year + j inclusive
+    """
+    entry_prices, exit_prices, start_betas = benchmark_prices(start_year, end_year, index_code, holding_period)
+    return portfolio_metrics.window_metrics(entry_prices[:, None], exit_prices[:, None],
+                                            np.full((len(start_betas), 1), np.nan),
+                                            risk_free_rates(load_clean_data(), start_year, end_year),
+                                            start_betas=start_betas)
+
 
-    return treynor_ratio, sharpe_ratio
\ No newline at end of file
+def benchmark_sources(index_code, directory='data/INVEST_IRESS', clean_file='data/INVEST_clean.csv'):
+    """
+    Returns the modification time and size of the files benchmark metrics are computed from
+    """
+    sources = {}
+    for path in [os.path.join(directory, index_code + '.csv'), clean_file]:
+        stat = os.stat(path)
+        sources[path] = [stat.st_mtime_ns, stat.st_size]
+    return sources
+
+
+def load_benchmark_cache(cache_file):
+    """
+    Returns the benchmark metrics cache for cache_file, reading it from disk on first use
+    """
+    if cache_file not in _benchmark_caches:
+        _benchmark_caches[cache_file] = {}
+        if cache_file is not None and os.path.isfile(cache_file):
+            with open(cache_file, 'r') as f:
+                _benchmark_caches[cache_file] = json.load(f)
+    return _benchmark_caches[cache_file]
+
+
+def save_benchmark_cache(cache, cache_file):
+    """
+    Writes the benchmark metrics cache to disk
+    """
+    if cache_file is None:
+        return
+    tmp_file = cache_file + '.tmp'
+    with open(tmp_file, 'w') as f:
+        json.dump(cache, f)
+    os.replace(tmp_file, cache_file)
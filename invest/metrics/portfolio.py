@@ -0,0 +1,202 @@
+import numpy as np
+
+import invest.metrics.return_ as return_metrics
+
+
+def pack_holdings(values_dict, start_year, end_year):
+    """
+    Returns per-year holding values as a NaN padded (years x holdings) array
+
+    Parameters
+    ----------
+    values_dict : dict
+        Lists of holding values keyed by year string
+    start_year : int
+        First year
+    end_year : int
+        Year after the last year
+
+    Returns
+    -------
+    numpy.ndarray
+    """
+    rows = [values_dict.get(str(year), []) for year in range(start_year, end_year)]
+    packed = np.full((len(rows), max([len(r) for r in rows] + [0])), np.nan)
+    for i, row in enumerate(rows):
+        packed[i, :len(row)] = row
+    return packed
+
+
+def portfolio_metrics(prices_initial, prices_current, betas, risk_free_rates):
+    """
+    Returns annual returns, Compound Return, Average Annual Return, Treynor Ratio and Sharpe Ratio
+    for one or many portfolios at once
+
+    Parameters
+    ----------
+    prices_initial : numpy.ndarray
+        Entry prices of shape (..., years, holdings), NaN where a year holds fewer shares
+    prices_current : numpy.ndarray
+        Exit prices of shape (..., years, holdings)
+    betas : numpy.ndarray
+        Share betas of shape (..., years, holdings)
+    risk_free_rates : numpy.ndarray
+        Risk free rate of return of shape (..., years) as a fraction
+
+    Returns
+    -------
+    dict
+    """
+    prices_initial = np.asarray(prices_initial, dtype=np.float64)
+    prices_current = np.asarray(prices_current, dtype=np.float64)
+    betas = np.asarray(betas, dtype=np.float64)
+    risk_free_rates = np.asarray(risk_free_rates, dtype=np.float64)
+    n = prices_initial.shape[-2]
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        pv_initial = np.nansum(prices_initial, axis=-1)
+        pv_current = np.nansum(prices_current, axis=-1)
+        returns = pv_current - pv_initial
+        # Ratio of sums equals the ratio of mean prices over the same holdings
+        annual_returns = np.where(np.abs(returns) > 0, np.abs(pv_current / pv_initial) - 1, 0.0)
+
+        # The portfolio starts in the first year with a non-zero value
+        first = np.argmax(pv_initial != 0, axis=-1)
+        pv = np.take_along_axis(pv_initial, first[..., None], axis=-1)[..., 0]
+        total_return = returns.sum(axis=-1)
+        compound_return = np.where(np.abs(total_return) > 0, np.abs((pv + total_return) / pv) ** (1 / n) - 1, 0.0)
+        average_annual_return = return_metrics.average_annual_return(annual_returns, axis=-1)
+
+    treynor, sharpe = risk_adjusted_metrics(compound_return, average_annual_return, annual_returns, betas,
+                                            risk_free_rates)
+
+    return {
+        "annualReturns": annual_returns,
+        "compoundReturn": compound_return,
+        "averageAnnualReturn": average_annual_return,
+        "treynor": treynor,
+        "sharpe": sharpe,
+    }
+
+
+def risk_adjusted_metrics(compound_return, average_annual_return, annual_returns, betas, risk_free_rates):
+    """
+    Returns the Treynor Ratio and Sharpe Ratio for one or many portfolios at once
+
+    Parameters
+    ----------
+    compound_return : Union[float, numpy.ndarray]
+        Compound Return of shape (...)
+    average_annual_return : Union[float, numpy.ndarray]
+        Average Annual Return of shape (...)
+    annual_returns : numpy.ndarray
+        Annual returns of shape (..., years)
+    betas : numpy.ndarray
+        Share betas of shape (..., years, holdings), NaN padded
+    risk_free_rates : numpy.ndarray
+        Risk free rate of return of shape (..., years) as a fraction
+
+    Returns
+    -------
+    tuple
+    """
+    betas = np.asarray(betas, dtype=np.float64)
+    annual_returns = np.asarray(annual_returns, dtype=np.float64)
+    risk_free_rates = np.asarray(risk_free_rates, dtype=np.float64)
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        held = (~np.isnan(betas)).sum(axis=(-2, -1))
+        beta_portfolio = np.where(held > 0, np.nansum(betas, axis=(-2, -1)) / np.maximum(held, 1), 0.0)
+        risk_free_rate = np.mean(risk_free_rates, axis=-1)
+        portfolio_return = np.asarray(compound_return) * 100
+        treynor = np.where(beta_portfolio > 0,
+                           return_metrics.treynor_ratio(portfolio_return, risk_free_rate, beta_portfolio), 0.0)
+
+        delta = average_annual_return - risk_free_rate
+        excess_returns = annual_returns - risk_free_rates
+        standard_deviation_excess_return = np.sqrt(np.sum((excess_returns - np.expand_dims(delta, -1)) ** 2,
+                                                          axis=-1))
+        sharpe = return_metrics.sharpe_ratio(portfolio_return, risk_free_rate, standard_deviation_excess_return)
+    return treynor, sharpe
+
+
+def window_metrics(prices_initial, prices_current, betas, risk_free_rates, start_betas=None):
+    """
+    Returns annual returns and the Compound Return, Average Annual Return, Treynor Ratio and Sharpe Ratio of
+    every contiguous window of years at once. Window sums come from prefix sums over the years, so entry [i, j]
+    equals portfolio_metrics() over years i to j inclusive; entries with j < i are NaN
+
+    Parameters
+    ----------
+    prices_initial : numpy.ndarray
+        Entry prices of shape (..., years, holdings), NaN where a year holds fewer shares
+    prices_current : numpy.ndarray
+        Exit prices of shape (..., years, holdings)
+    betas : numpy.ndarray
+        Share betas of shape (..., years, holdings)
+    risk_free_rates : numpy.ndarray
+        Risk free rate of return of shape (..., years) as a fraction
+    start_betas : numpy.ndarray, optional
+        Portfolio beta of shape (..., years) to use for windows starting in each year instead of the mean share beta
+
+    Returns
+    -------
+    dict
+    """
+    prices_initial = np.asarray(prices_initial, dtype=np.float64)
+    prices_current = np.asarray(prices_current, dtype=np.float64)
+    betas = np.asarray(betas, dtype=np.float64)
+    risk_free_rates = np.broadcast_to(np.asarray(risk_free_rates, dtype=np.float64), prices_initial.shape[:-1])
+    n_years = prices_initial.shape[-2]
+    start = np.arange(n_years)[:, None]
+    end = np.arange(n_years)[None, :]
+    valid = end >= start
+    n = np.where(valid, end - start + 1, 1)
+
+    def window_sum(values):
+        # prefix[..., k] is the sum of the first k years, so a window is a difference of two prefixes
+        prefix = np.concatenate([np.zeros(values.shape[:-1] + (1,)), np.cumsum(values, axis=-1)], axis=-1)
+        return prefix[..., None, 1:] - prefix[..., :-1, None]
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        pv_initial = np.nansum(prices_initial, axis=-1)
+        pv_current = np.nansum(prices_current, axis=-1)
+        returns = pv_current - pv_initial
+        annual_returns = np.where(np.abs(returns) > 0, np.abs(pv_current / pv_initial) - 1, 0.0)
+
+        # Value of the first year from each start year onwards with a non-zero value
+        years = np.broadcast_to(np.arange(n_years), pv_initial.shape)
+        next_nonzero = np.where(pv_initial != 0, years, n_years)
+        next_nonzero = np.flip(np.minimum.accumulate(np.flip(next_nonzero, axis=-1), axis=-1), axis=-1)
+        pv = np.take_along_axis(pv_initial, np.minimum(next_nonzero, n_years - 1), axis=-1)[..., :, None]
+
+        total_return = window_sum(returns)
+        compound_return = np.where(np.abs(total_return) > 0, np.abs((pv + total_return) / pv) ** (1 / n) - 1, 0.0)
+        average_annual_return = window_sum(annual_returns) / n
+
+        if start_betas is None:
+            held = window_sum((~np.isnan(betas)).sum(axis=-1).astype(np.float64))
+            beta_portfolio = np.where(held > 0, window_sum(np.nansum(betas, axis=-1)) / np.maximum(held, 1), 0.0)
+        else:
+            beta_portfolio = np.broadcast_to(np.asarray(start_betas, dtype=np.float64)[..., :, None],
+                                             compound_return.shape)
+        risk_free_rate = window_sum(risk_free_rates) / n
+        portfolio_return = compound_return * 100
+        treynor = np.where(beta_portfolio > 0,
+                           return_metrics.treynor_ratio(portfolio_return, risk_free_rate, beta_portfolio), 0.0)
+
+        # Sum of squared deviations of the excess returns from their window mean
+        excess_returns = annual_returns - risk_free_rates
+        s1 = window_sum(excess_returns)
+        s2 = window_sum(excess_returns ** 2)
+        # A single year deviates from its own mean by exactly zero, which prefix differences only approximate
+        standard_deviation_excess_return = np.where(n > 1, np.sqrt(np.maximum(s2 - s1 ** 2 / n, 0)), 0.0)
+        sharpe = return_metrics.sharpe_ratio(portfolio_return, risk_free_rate, standard_deviation_excess_return)
+
+    return {
+        "annualReturns": annual_returns,
+        "compoundReturn": np.where(valid, compound_return, np.nan),
+        "averageAnnualReturn": np.where(valid, average_annual_return, np.nan),
+        "treynor": np.where(valid, treynor, np.nan),
+        "sharpe": np.where(valid, sharpe, np.nan),
+    }
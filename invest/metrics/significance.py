@@ -0,0 +1,168 @@
+import numpy as np
+
+from invest.metrics.portfolio import portfolio_metrics
+
+
+def default_block_size(n):
+    """
+    Returns the default block length of a series of length n, n ** (1 / 3) rounded up
+    """
+    return max(int(np.ceil(n ** (1 / 3))), 1)
+
+
+def block_bootstrap_indices(n, n_resamples, block_size=None, seed=None):
+    """
+    Returns the indices of circular moving block bootstrap resamples of a series
+
+    Parameters
+    ----------
+    n : int
+        Length of the series
+    n_resamples : int
+        Number of resamples
+    block_size : int, optional
+        Length of the blocks, default_block_size(n) by default
+    seed : int or numpy.random.Generator, optional
+        Seed of the random generator
+
+    Returns
+    -------
+    numpy.ndarray
+        Indices of shape (resamples, n)
+    """
+    rng = np.random.default_rng(seed)
+    block_size = block_size if block_size is not None else default_block_size(n)
+    block_size = min(max(block_size, 1), max(n, 1))
+    n_blocks = -(-n // block_size)
+    starts = rng.integers(0, max(n, 1), size=(n_resamples, n_blocks))
+    indices = (starts[:, :, None] + np.arange(block_size)) % max(n, 1)
+    return indices.reshape(n_resamples, -1)[:, :n]
+
+
+def segment_exits(returns, counts, entries):
+    """
+    Returns the exit value of each year of one or many period return series, compounding the returns of
+    each year's segment of periods from its entry value
+
+    Parameters
+    ----------
+    returns : numpy.ndarray
+        Period returns of shape (..., periods) as fractions, the periods of all years in order
+    counts : numpy.ndarray
+        Number of periods of each year, summing to the periods
+    entries : numpy.ndarray
+        Entry value of each year of shape (years,)
+
+    Returns
+    -------
+    numpy.ndarray
+        Exit values of shape (..., years)
+    """
+    growth = np.cumprod(1 + np.asarray(returns, dtype=np.float64), axis=-1)
+    growth = np.concatenate([np.ones(growth.shape[:-1] + (1,)), growth], axis=-1)
+    ends = np.cumsum(counts)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        return entries * growth[..., ends] / growth[..., ends - np.asarray(counts)]
+
+
+def return_metrics_of(returns, counts, entries, risk_free_rates):
+    """
+    Returns the Compound Return, Average Annual Return and Sharpe Ratio of one or many period return series,
+    as portfolio_metrics() computes them from the entry and exit value of each year
+
+    Parameters
+    ----------
+    returns : numpy.ndarray
+        Period returns of shape (..., periods) as fractions
+    counts : numpy.ndarray
+        Number of periods of each year
+    entries : numpy.ndarray
+        Entry value of each year
+    risk_free_rates : numpy.ndarray
+        Risk free rate of each year as a fraction
+
+    Returns
+    -------
+    dict
+    """
+    exits = segment_exits(returns, counts, entries)
+    entries = np.broadcast_to(np.asarray(entries, dtype=np.float64), exits.shape)
+    # Treynor is not tested, so no betas are needed
+    metrics = portfolio_metrics(entries[..., None], exits[..., None], np.full(exits.shape + (1,), np.nan),
+                                np.broadcast_to(risk_free_rates, exits.shape))
+    return {key: metrics[key] for key in ["compoundReturn", "averageAnnualReturn", "sharpe"]}
+
+
+def bootstrap_significance(returns, benchmark_returns, counts, entries, benchmark_entries, risk_free_rates,
+                           benchmark_risk_free_rates, n_resamples=1000, block_size=None, confidence=0.95, seed=None):
+    """
+    Tests whether a portfolio beats its benchmark with a paired block bootstrap of the period returns of
+    their equity curves. Both series are resampled with the same blocks, so their dependence is kept, and
+    every resample is split back into the periods of each year and compounded from the year's entry value.
+    The metrics are those of portfolio_metrics(), so the observed differences are those of the reported
+    metrics
+
+    Parameters
+    ----------
+    returns : numpy.ndarray
+        Portfolio returns per period as fractions, the periods of all years in order
+    benchmark_returns : numpy.ndarray
+        Benchmark returns over the same periods as fractions
+    counts : numpy.ndarray
+        Number of periods of each year
+    entries : numpy.ndarray
+        Portfolio value at the entry of each year
+    benchmark_entries : numpy.ndarray
+        Benchmark value at the entry of each year
+    risk_free_rates : numpy.ndarray
+        Risk free rate of each year as a fraction, as the portfolio metrics are reported with
+    benchmark_risk_free_rates : numpy.ndarray
+        Risk free rate of each year as a fraction, as the benchmark metrics are reported with
+    n_resamples : int, optional
+        Number of bootstrap resamples
+    block_size : int, optional
+        Length of the resampled blocks
+    confidence : float, optional
+        Level of the confidence intervals
+    seed : int, optional
+        Seed of the random generator
+
+    Returns
+    -------
+    dict
+        Observed difference (portfolio minus benchmark), percentile confidence interval and one-sided
+        p-value of the portfolio not beating the benchmark, for each metric
+    """
+    returns = np.asarray(returns, dtype=np.float64)
+    benchmark_returns = np.asarray(benchmark_returns, dtype=np.float64)
+    counts = np.asarray(counts, dtype=np.int64)
+    entries = np.asarray(entries, dtype=np.float64)
+    benchmark_entries = np.asarray(benchmark_entries, dtype=np.float64)
+    risk_free_rates = np.asarray(risk_free_rates, dtype=np.float64)
+    benchmark_risk_free_rates = np.asarray(benchmark_risk_free_rates, dtype=np.float64)
+
+    block_size = block_size if block_size is not None else default_block_size(len(returns))
+    indices = block_bootstrap_indices(len(returns), n_resamples, block_size, seed)
+    observed_ip = return_metrics_of(returns, counts, entries, risk_free_rates)
+    observed_benchmark = return_metrics_of(benchmark_returns, counts, benchmark_entries, benchmark_risk_free_rates)
+    resampled_ip = return_metrics_of(returns[indices], counts, entries, risk_free_rates)
+    resampled_benchmark = return_metrics_of(benchmark_returns[indices], counts, benchmark_entries,
+                                            benchmark_risk_free_rates)
+
+    alpha = (1 - confidence) / 2
+    significance = {"resamples": n_resamples, "blockSize": block_size, "periods": len(returns),
+                    "confidence": confidence}
+    for key in ["compoundReturn", "averageAnnualReturn", "sharpe"]:
+        with np.errstate(invalid="ignore"):
+            observed = float(observed_ip[key] - observed_benchmark[key])
+            differences = resampled_ip[key] - resampled_benchmark[key]
+        differences = differences[np.isfinite(differences)]
+        if not np.isfinite(observed) or len(differences) == 0:
+            significance[key] = {"difference": observed, "confidenceInterval": [np.nan, np.nan], "pValue": np.nan}
+            continue
+        # Centring the bootstrap distribution on zero imposes the null hypothesis of no difference
+        p_value = (1 + np.sum(differences - observed >= observed)) / (1 + len(differences))
+        significance[key] = {"difference": observed,
+                             "confidenceInterval": np.quantile(differences, [alpha, 1 - alpha]).tolist(),
+                             "pValue": float(p_value)}
+    return significance
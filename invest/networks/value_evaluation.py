@@ -1,5 +1,6 @@
 import os
 import numpy as np
+import pandas as pd
 import pyAgrum as gum
 
 class ValueNetwork:
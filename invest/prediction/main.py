@@ -1,54 +1,170 @@
+import functools
 import json
 import os
 
 import numpy as np
 import pandas as pd
-import torch
-import torch.utils.data
 
-from gnn.evaluation.validation import inference as inference_, custom_inference as custom_inference_
-from gnn.preprocessing.loader import CustomStandardScaler, ForecastDataset, CustomSimpleDataLoader
-from gnn.preprocessing.utils import process_data
-from gnn.utils import load_model, inverse_transform_
+from invest.preprocessing.dataloader import date_rows, load_price_matrix
 
 
-def future_share_price_performance(year, model_name="GWN", dataset="INVEST_GNN_clean", horizon=10):
+# Checkpoints kept loaded, least recently used evicted first
+MODEL_CACHE_SIZE = 4
+
+# Models fitted with NumPy at prediction time, without torch or the gnn package, and their parameters
+STATISTICAL_MODELS = {"AR": {"lags": 5, "alpha": 0.0}, "Ridge": {"lags": 5, "alpha": 1.0}}
+
+
+@functools.lru_cache(maxsize=MODEL_CACHE_SIZE)
+def load_checkpoint(model_name, dataset, window_size=40, horizon=10):
+    """
+    Loads a trained model and its normalization statistics once and keeps them for later calls. The result is
+    cached and shared, so it must not be modified
+
+    Parameters
+    ----------
+    model_name : str
+        Graph neural network model
+    dataset : str
+        Dataset name the model was trained on
+    window_size : int, optional
+        Model window size
+    horizon : int, optional
+        Prediction horizon length
+
+    Returns
+    -------
+    tuple
+        Model and normalization statistics
+    """
+    from gnn.utils import load_model
+
+    result_file = os.path.join('output', model_name, dataset, str(window_size), str(horizon), 'train')
+    with open(os.path.join(result_file, 'norm_stat.json'), 'r') as f:
+        normalize_statistic = json.load(f)
+    return load_model(result_file), normalize_statistic
+
+
+@functools.lru_cache(maxsize=None)
+def load_prices(dataset):
     """
-    Estimates the future share price performance using a graph neural network model to
-    conduct short-term price inference
+    Loads the prices of a dataset once: its wide price matrix built by clean.py when there is one, else its
+    undated csv file. The result is cached and shared, so it must not be modified
+
+    Parameters
+    ----------
+    dataset : str
+        Dataset name
+
+    Returns
+    -------
+    tuple
+        Prices of shape (dates, companies), their dates, None for a csv file, and their company names
+    """
+    name = os.path.join('data', dataset)
+    if os.path.isfile(name + '.npy'):
+        return load_price_matrix(name)
+    df = pd.read_csv(name + '.csv')
+    return df.values, None, df.columns.tolist()
+
+
+def future_share_price_performance(year, model_name="GWN", dataset="INVEST_GNN_clean", horizon=10, window_size=40,
+                                   lower=0.98, upper=1.02):
+    """
+    Estimates the future share price performance using a graph neural network model, or a statistical model
+    of STATISTICAL_MODELS, to conduct short-term price inference. The prices up to the end of the previous
+    year are sliced from the wide price matrix of the dataset built by clean.py, e.g. INVEST_prices. A
+    dataset without a matrix is read from its undated csv file, taking (year - 2009) * 365 rows. The model
+    and prices are loaded once and shared by the calls of all years
 
     Parameters
     ----------
     year : int
         Calendar year to predict performance
     model_name : str, optional
-        Graph neural network model
+        Graph neural network model, or AR or Ridge
     dataset : str, optional
         Dataset name
     horizon : int, optional
         Prediction horizon length
+    window_size : int, optional
+        Model window size
+    lower : float, optional
+        Ratio of predicted to current price at or below which the performance is negative
+    upper : float, optional
+        Ratio of predicted to current price at or above which the performance is positive
 
     Returns
     -------
     pandas.DataFrame
     """
-    result_file = os.path.join('output', model_name, dataset, str(40), str(horizon), 'train')
-    ub = ((year - 2009) * 365)
-    df = pd.read_csv(os.path.join('data', dataset + '.csv'))
-    data = df.values
-    y = data[ub - 1, :]
+    performances = future_performances([year], model_name, dataset, horizon, window_size, lower, upper)
+    return pd.DataFrame([performances["performance"].to_numpy()], columns=list(performances["company"]))
+
+
+def future_performances(years, model_name="GWN", dataset="INVEST_GNN_clean", horizon=10, window_size=40,
+                        lower=0.98, upper=1.02):
+    """
+    Estimates the future share price performance of every share for several years at once. The last forecast
+    window of every year is taken from one pass over the prices and all of them are run through the model in
+    batches, giving the same forecasts as future_share_price_performance() year by year
+
+    Parameters
+    ----------
+    years : list
+        Calendar years to predict performance
+    model_name : str, optional
+        Graph neural network model, or AR or Ridge
+    dataset : str, optional
+        Dataset name
+    horizon : int, optional
+        Prediction horizon length
+    window_size : int, optional
+        Model window size
+    lower : float, optional
+        Ratio of predicted to current price at or below which the performance is negative
+    upper : float, optional
+        Ratio of predicted to current price at or above which the performance is positive
 
-    forecast = inference(data[0:ub, :], model_name, result_file, horizon=horizon)
-    y_hat = forecast.mean(axis=1)
-    classification = classify(y, y_hat)
+    Returns
+    -------
+    pandas.DataFrame
+        One row per year and company with the current price, the mean predicted price over the horizon and
+        the performance class
+    """
+    values, dates, companies = load_prices(dataset)
+    if dates is not None:
+        ends = np.array([date_rows(dates, end=f"{year - 1}-12-31").stop for year in years], dtype=np.int64)
+    else:
+        ends = np.array([(year - 2009) * 365 for year in years], dtype=np.int64)
+        for year, end in zip(years, ends):
+            if end > len(values):
+                raise ValueError("{}: {} prices before the year, the {} dataset has {}"
+                                 .format(year, end, dataset, len(values)))
+    data = values[:ends.max()]
+    if dates is not None:
+        # Prices a company does not have are 0, as in the csv datasets
+        data = np.nan_to_num(data)
 
-    d = {}
-    for i, c in enumerate(df.columns):
-        d[c] = [classification[i]]
-    return pd.DataFrame(d, columns=df.columns)
+    if model_name in STATISTICAL_MODELS:
+        forecasts = autoregressive_inference(data, ends, horizon, **STATISTICAL_MODELS[model_name])
+    else:
+        for year, end in zip(years, ends):
+            if end < window_size + horizon:
+                raise ValueError("{}: {} prices before the year, fewer than the window size and horizon"
+                                 .format(year, end))
+        checkpoint = load_checkpoint(model_name, dataset, window_size, horizon)
+        forecasts = batch_inference(data, ends, model_name, checkpoint, window_size=window_size, horizon=horizon)
+    y = data[ends - 1]
+    y_hat = forecasts.mean(axis=-1)
+    return pd.DataFrame({"year": np.repeat(years, len(companies)),
+                         "company": np.tile(companies, len(years)),
+                         "price": y.ravel(),
+                         "forecast": y_hat.ravel(),
+                         "performance": classify(y, y_hat, lower, upper).ravel()})
 
 
-def inference(data, model_name, result_file, window_size=40, horizon=10):
+def inference(data, model_name, checkpoint, window_size=40, horizon=10):
     """
     Performs inference and returns a set of model predictions
 
@@ -58,8 +174,8 @@ def inference(data, model_name, result_file, window_size=40, horizon=10):
         Price data
     model_name : str
         Graph neural network model
-    result_file : str
-        Directory to load trained model parameter files
+    checkpoint : tuple
+        Model and normalization statistics from load_checkpoint()
     window_size : int, optional
         Model window size
     horizon : int, optional
@@ -69,51 +185,150 @@ def inference(data, model_name, result_file, window_size=40, horizon=10):
     -------
     numpy.ndarray
     """
-    with open(os.path.join(result_file, 'norm_stat.json'), 'r') as f:
-        normalize_statistic = json.load(f)
-    model = load_model(result_file)
+    # N x H
+    return batch_inference(data, [len(data)], model_name, checkpoint, window_size, horizon)[0]
+
+
+def batch_inference(data, ends, model_name, checkpoint, window_size=40, horizon=10, batch_size=256):
+    """
+    Returns the model predictions of the last window of the prices up to each end, as inference() of each
+    data[:end] would. The windows are built once from the longest prices, the window of each end being the
+    one its later rows would add, and are run through the model in batches
+
+    Parameters
+    ----------
+    data : numpy.ndarray
+        Price data up to the latest end
+    ends : list
+        Row bounds of the prices of each prediction
+    model_name : str
+        Graph neural network model
+    checkpoint : tuple
+        Model and normalization statistics from load_checkpoint()
+    window_size : int, optional
+        Model window size
+    horizon : int, optional
+        Prediction horizon length
+    batch_size : int, optional
+        Windows per model batch
+
+    Returns
+    -------
+    numpy.ndarray
+        Predictions of shape (ends, N, H)
+    """
+    import torch
+    import torch.utils.data
+    from gnn.evaluation.validation import inference as inference_, custom_inference as custom_inference_
+    from gnn.preprocessing.loader import CustomStandardScaler, ForecastDataset, CustomSimpleDataLoader
+    from gnn.preprocessing.utils import process_data
+    from gnn.utils import inverse_transform_
+
+    model, normalize_statistic = checkpoint
+    # Every row after an end adds one window
+    offsets = len(data) - np.asarray(ends, dtype=np.int64)
     if model_name == 'StemGNN':
+        # The z-score statistics are fixed, so a window is normalized the same whatever the prices after it
         data_set = ForecastDataset(data, window_size=window_size, horizon=horizon,
                                    normalize_method='z_score',
                                    norm_statistic=normalize_statistic)
-        data_loader = torch.utils.data.DataLoader(data_set, batch_size=32, drop_last=False,
-                                                  shuffle=False, num_workers=0)
+        indices = (len(data_set) - 1 - offsets).tolist()
+        data_loader = torch.utils.data.DataLoader(torch.utils.data.Subset(data_set, indices), batch_size=batch_size,
+                                                  drop_last=False, shuffle=False, num_workers=0)
         forecast_norm, target_norm = inference_(model, data_loader, 'cpu',
                                                 data.shape[1], window_size, horizon)
         forecast = inverse_transform_(forecast_norm, 'z_score', normalize_statistic)
-        # N x H
-        return np.swapaxes(forecast[-1, :], 0, 1)
+        return np.swapaxes(forecast, 1, 2)
     else:
         x, y = process_data(data, window_size, horizon)
-        scaler = CustomStandardScaler(mean=x.mean(), std=x.std())
-        data_loader = CustomSimpleDataLoader(scaler.transform(x), scaler.transform(y), 32)
-        forecast_norm, target_norm = custom_inference_(model, data_loader)
-        # N x H
-        return scaler.inverse_transform(forecast_norm[-1, :, :])
+        indices = len(x) - 1 - offsets
+        # Each prediction is scaled with the statistics of the windows of its own prices
+        scalers = [CustomStandardScaler(mean=x[:i + 1].mean(), std=x[:i + 1].std()) for i in indices]
+        x_ = np.stack([scaler.transform(x[i]) for scaler, i in zip(scalers, indices)])
+        y_ = np.stack([scaler.transform(y[i]) for scaler, i in zip(scalers, indices)])
+        forecast_norm, target_norm = custom_inference_(model, CustomSimpleDataLoader(x_, y_, batch_size))
+        return np.stack([scaler.inverse_transform(f) for scaler, f in zip(scalers, forecast_norm)])
 
 
-def classify(y, y_hat):
+def autoregressive_inference(data, ends, horizon=10, lags=5, alpha=0.0):
+    """
+    Returns the predictions of an autoregressive model of the price returns of each share, fitted with NumPy on
+    the prices up to each end, for all shares at once. The coefficients of the lagged returns are ridge
+    penalised by alpha times their mean squared value, and the horizon is forecast recursively
+
+    Parameters
+    ----------
+    data : numpy.ndarray
+        Price data up to the latest end, 0 where a share has no price
+    ends : list
+        Row bounds of the prices of each prediction
+    horizon : int, optional
+        Prediction horizon length
+    lags : int, optional
+        Lagged returns of the model
+    alpha : float, optional
+        Ridge penalty, 0 for least squares
+
+    Returns
+    -------
+    numpy.ndarray
+        Predictions of shape (ends, N, H)
+    """
+    data = np.asarray(data, dtype=np.float64)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        # Returns from or to a missing price are 0
+        returns = np.where((data[:-1] > 0) & (data[1:] > 0), data[1:] / data[:-1] - 1, 0.0)
+
+    forecasts = []
+    for end in ends:
+        if end < lags + 2:
+            raise ValueError("{} prices, fewer than the {} lags and two".format(end, lags))
+        # Samples of shape (samples, N, lags + 1): the returns of each share, the latest last
+        samples = np.lib.stride_tricks.sliding_window_view(returns[:end - 1], lags + 1, axis=0)
+        x = np.concatenate([np.ones(samples.shape[:2] + (1,)), samples[..., :-1]], axis=-1)
+        y = samples[..., -1]
+        xtx = np.einsum('snk,snl->nkl', x, x)
+        xty = np.einsum('snk,sn->nk', x, y)
+        # A small penalty keeps the shares without returns solvable
+        scale = np.trace(xtx[:, 1:, 1:], axis1=1, axis2=2) / lags
+        penalty = np.eye(lags + 1)
+        penalty[0, 0] = 0
+        coefficients = np.linalg.solve(xtx + (alpha * scale + 1e-8 * (scale + 1))[:, None, None] * penalty,
+                                       xty[..., None])[..., 0]
+
+        history = returns[end - 1 - lags:end - 1].T
+        price = data[end - 1]
+        predictions = []
+        for _ in range(horizon):
+            forecast_return = coefficients[:, 0] + np.sum(coefficients[:, 1:] * history, axis=-1)
+            history = np.concatenate([history[:, 1:], forecast_return[:, None]], axis=-1)
+            price = price * (1 + forecast_return)
+            predictions.append(price)
+        forecasts.append(np.stack(predictions, axis=-1))
+    return np.stack(forecasts)
+
+
+def classify(y, y_hat, lower=0.98, upper=1.02):
     """
     Classifies a set of predicted share prices into positive, stagnant or negative performance
     encoded by the appropriate integers
 
     Parameters
     ----------
-    y : list
+    y : numpy.ndarray
         True value
-    y_hat : list
-        Predicted value
+    y_hat : numpy.ndarray
+        Predicted value, of the same shape
+    lower : float, optional
+        Ratio of predicted to true value at or below which the performance is negative
+    upper : float, optional
+        Ratio of predicted to true value at or above which the performance is positive
 
     Returns
     -------
-    list
-    """
-    classification = []
-    for i in range(len(y)):
-        if (y_hat[i] / y[i]) >= 1.02:
-            classification.append(1)
-        elif 0.98 < (y_hat[i] / y[i]) < 1.02:
-            classification.append(0)
-        else:
-            classification.append(-1)
-    return classification
\ No newline at end of file
+    numpy.ndarray
+    """
+    with np.errstate(divide="ignore", invalid="ignore"):
+        ratio = np.asarray(y_hat, dtype=np.float64) / np.asarray(y, dtype=np.float64)
+    # A NaN ratio is negative, as it fails both comparisons
+    return np.where(ratio >= upper, 1, np.where(ratio > lower, 0, -1))
@@ -1,24 +1,157 @@
 import argparse
+import hashlib
+import json
 import os
+import re
+import shutil
 import time
-from datetime import date
+from concurrent.futures import ProcessPoolExecutor
 
 import numpy as np
 import pandas as pd
 
-from dataloader import load_data
+from dataloader import iter_iress, load_data, load_iress, load_universe
 
-companies_jcsev = ["ADVTECH", "CITY LODGE HOTELS", "CLICKS GROUP", "CURRO HOLDINGS", "CASHBUILD",
-                   "FAMOUS BRANDS", "ITALTILE",
-                   "LEWIS GROUP", "MR PRICE GROUP", "MASSMART", "PICK N PAY STORES", "SHOPRITE",
-                   "SPAR GROUP",
-                   "SUN INTERNATIONAL", "SPUR", "THE FOSCHINI GROUP", "TRUWORTHS INTL", "TSOGO SUN",
-                   "WOOLWORTHS HDG"]
-companies_jgind = ["AFRIMAT", "BARLOWORLD", "BIDVEST GROUP", "GRINDROD", "HUDACO", "IMPERIAL",
-                   "INVICTA",
-                   "KAP INDUSTRIAL", "MPACT", "MURRAY & ROBERTS",
-                   "NAMPAK", "PPC", "RAUBEX GROUP", "REUNERT", "SUPER GROUP", "TRENCOR",
-                   "WLSN.BAYLY HOLMES-OVCON"]
+def interval_join(dates, starts, values, ends=None):
+    """
+    Returns the value of the interval [start, end) containing each date in a single sorted pass, NaN where no
+    interval does. Without ends each interval runs until the next start and the last one is open, i.e. an as-of
+    join on the latest start on or before each date. Of intervals with equal starts the last one applies, as
+    when assigning the intervals one after another
+
+    Parameters
+    ----------
+    dates : numpy.ndarray
+        Dates to look up, comparable with the starts
+    starts : list
+        Interval starts
+    values : numpy.ndarray
+        Interval values
+    ends : list, optional
+        Interval ends (exclusive)
+
+    Returns
+    -------
+    numpy.ndarray
+    """
+    starts = np.asarray(starts)
+    order = np.argsort(starts, kind='stable')
+    starts = starts[order]
+    values = np.asarray(values, dtype=np.float64)[order]
+    position = np.searchsorted(starts, dates, side='right') - 1
+    found = position >= 0
+    if ends is not None:
+        ends = np.asarray(ends)[order]
+        found &= dates < ends[np.maximum(position, 0)]
+    return np.where(found, values[np.maximum(position, 0)], np.nan)
+
+
+def year_bounds(years):
+    """
+    Returns the first days of the given years and of the years after them, the intervals of annual values
+    """
+    years = np.asarray(years, dtype=np.int64)
+    return (pd.to_datetime({'year': years, 'month': 1, 'day': 1}).to_numpy(),
+            pd.to_datetime({'year': years + 1, 'month': 1, 'day': 1}).to_numpy())
+
+
+RAW_FILES = ['CompanyHistoricData', 'DebtEquity', 'InflationRate', 'MarketRateOfReturn', 'RiskFreeRateOfReturn']
+
+
+def raw_files(universe):
+    """
+    Returns the named raw IRESS files of a universe: the fixed files, the market index and the sector
+    benchmark indices
+    """
+    indices = [universe['market']] + [sector['benchmark'] for sector in universe['sectors'].values()]
+    return RAW_FILES + [name for name in dict.fromkeys(indices) if name not in RAW_FILES]
+
+
+def read_iress(path):
+    """
+    Returns one raw IRESS file parsed and validated against its schema
+    """
+    return load_iress(path)
+
+
+def read_company(path):
+    """
+    Returns the long fundamentals table of one raw IRESS company file
+    """
+    return company_fundamentals(load_iress(path, 'Company'))
+
+
+def company_files(raw_folder):
+    """
+    Returns the file names of the IRESS company files in sorted order
+    """
+    return [path for path in sorted(os.listdir(os.path.join(raw_folder, 'Company'))) if path != ".DS_Store"]
+
+
+def ingest(raw_folder, workers=None, raw_files=RAW_FILES, company_paths=None):
+    """
+    Parses the raw IRESS files concurrently on a pool of worker processes. Results are collected in a fixed
+    order, the named files by name and the company files sorted by file name, so the output does not depend
+    on which worker finishes first
+
+    Parameters
+    ----------
+    raw_folder : str
+        Folder with the raw IRESS files and the Company folder
+    workers : int, optional
+        Number of worker processes, the number of CPUs by default; 1 parses in this process
+    raw_files : list, optional
+        Named files to parse, RAW_FILES by default
+    company_paths : list, optional
+        Company file names to parse, all of them by default
+
+    Returns
+    -------
+    tuple
+        Raw frames keyed by file name and the list of company fundamentals tables
+    """
+    paths = [os.path.join(raw_folder, name + '.csv') for name in raw_files]
+    company_paths = [os.path.join(raw_folder, 'Company', path)
+                     for path in (company_files(raw_folder) if company_paths is None else company_paths)]
+
+    workers = workers or os.cpu_count() or 1
+    if workers == 1:
+        frames = [read_iress(path) for path in paths]
+        fundamentals = [read_company(path) for path in company_paths]
+    else:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            frame_futures = [executor.submit(read_iress, path) for path in paths]
+            company_futures = [executor.submit(read_company, path) for path in company_paths]
+            frames = [future.result() for future in frame_futures]
+            fundamentals = [future.result() for future in company_futures]
+    return dict(zip(raw_files, frames)), fundamentals
+
+
+def company_fundamentals(df_):
+    """
+    Returns the annual fundamentals of one IRESS company file as a long (Name, year, field, value) table,
+    in the order the fields and years appear in the file
+
+    Parameters
+    ----------
+    df_ : pandas.DataFrame
+        IRESS company file from load_iress() with one row per field and one column per year
+
+    Returns
+    -------
+    pandas.DataFrame
+    """
+    name = pd.unique(df_['Company'].values)[0]
+    df_ = df_.drop(columns=['Company']).T.rename(
+        columns={'Debt / Equity': 'Debt/Equity', 'Earnings / Share (c)': 'EPS',
+                 'Price / Earnings': 'PEYear', 'Return On Average Equity %': 'ROAE',
+                 'Return On Equity %': 'ROE', 'Ordinary Shareholders Equity at End of Year'
+                 : 'ShareholdersEquity'})
+    df_.index = [int(index) for index in df_.index]
+    df_ = df_.rename_axis('year').reset_index().melt(id_vars='year', var_name='field', value_name='value')
+    df_['value'] = df_['value'].astype(np.float64)
+    df_.insert(0, 'Name', name)
+    return df_
 
 
 def clean():
@@ -26,42 +159,40 @@ def clean():
         start_time = time.time()
         df = load_data()
 
-        df_ = pd.read_csv(os.path.join(args.raw_folder, 'DebtEquity.csv'), delimiter=';')
-        df['Debt/EquityIndustry'] = df_['Debt/Equity Industry'].loc[0]
-        df['Debt/EquityIndustry'] = [x.replace(',', '.') for x in df['Debt/EquityIndustry']]
+        df['Date'] = pd.to_datetime(df['Date'])
+        df_ = load_iress(os.path.join(args.raw_folder, 'DebtEquity.csv'))
+        df['Debt/EquityIndustry'] = df_['Debt/EquityIndustry'].loc[0]
 
-        df_ = pd.read_csv(os.path.join(args.raw_folder, 'EPS_SE.csv'), delimiter=';')
+        df_ = load_iress(os.path.join(args.raw_folder, 'EPS_SE.csv'))
         df['EPS'] = np.nan
         df['ShareholdersEquity'] = np.nan
         for index, row in df_.iterrows():
             name = row['Company']
-            start_year = str(date(int(row['Year']), 1, 1))
-            end_year = str(date(int(row['Year']) + 1, 1, 1))
+            start_year = pd.Timestamp(int(row['Year']), 1, 1)
+            end_year = pd.Timestamp(int(row['Year']) + 1, 1, 1)
             mask = (df['Date'] >= start_year) & (df['Date'] < end_year) & (df['Name'] == name)
             df.loc[mask, 'EPS'] = row['EPS']
-            df.loc[mask, 'EPS'] = [x.replace(',', '.') for x in df.loc[mask, 'EPS']]
             df.loc[mask, 'ShareholdersEquity'] = row['ShareholdersEquity']
 
         rate_files = ['InflationRate', 'MarketRateOfReturn', 'RiskFreeRateOfReturn']
         for rate in rate_files:
-            df_ = pd.read_csv(os.path.join(args.raw_folder, rate + '.csv'), delimiter=';')
+            df_ = load_iress(os.path.join(args.raw_folder, rate + '.csv'))
             df[rate] = np.nan
             for index, row in df_.iterrows():
-                start_year = str(date(int(row['Year']), 1, 1))
-                end_year = str(date(int(row['Year']) + 1, 1, 1))
+                start_year = pd.Timestamp(int(row['Year']), 1, 1)
+                end_year = pd.Timestamp(int(row['Year']) + 1, 1, 1)
                 mask = (df['Date'] >= start_year) & (df['Date'] < end_year)
                 df.loc[mask, rate] = row[rate]
-                df.loc[mask, rate] = [x.replace(',', '.') for x in df.loc[mask, rate]]
 
-        df_ = pd.read_csv(os.path.join(args.raw_folder, 'ShareBeta.csv'), delimiter=';')
+        df_ = load_iress(os.path.join(args.raw_folder, 'ShareBeta.csv'))
         df_ = df_.reindex(index=df_.index[::-1])
         df_ = df_.reset_index()
         df['ShareBeta'] = np.nan
         for index, row in df_.iterrows():
             name = row['Company']
-            start = row['Date'].replace("/", "-")
+            start = row['Date']
             try:
-                end = df_['Date'].iloc[index + 1].replace("/", "-")
+                end = df_['Date'].iloc[index + 1]
                 if start > end:
                     mask = (df['Date'] >= start) & (df['Name'] == name)
                 else:
@@ -69,16 +200,15 @@ def clean():
             except IndexError:
                 mask = (df['Date'] >= start) & (df['Name'] == name)
             df.loc[mask, 'ShareBeta'] = row['Beta Monthly Leveraged']
-            df.loc[mask, 'ShareBeta'] = [x.replace(',', '.') for x in df.loc[mask, 'ShareBeta']]
 
-        df_ = pd.read_csv(os.path.join(args.raw_folder, 'PEMarket.csv'), delimiter=';')
+        df_ = load_iress(os.path.join(args.raw_folder, 'PEMarket.csv'))
         df_ = df_.reindex(index=df_.index[::-1])
         df_ = df_.reset_index()
         df['PEMarket'] = np.nan
         for index, row in df_.iterrows():
-            start = str(row['Date']).replace("/", "-")
+            start = row['Date']
             try:
-                end = str(df_['Date'].iloc[index + 1]).replace("/", "-")
+                end = df_['Date'].iloc[index + 1]
                 if start > end:
                     mask = (df['Date'] >= start)
                 else:
@@ -86,19 +216,19 @@ def clean():
             except IndexError:
                 mask = (df['Date'] >= start)
             df.loc[mask, 'PEMarket'] = row['PE']
-            df.loc[mask, 'PEMarket'] = [x.replace(',', '.') for x in df.loc[mask, 'PEMarket']]
 
         df['PESector'] = np.nan
-        sectors = [('PESectorJCSEV.csv', companies_jcsev), ('PESectorJGIND.csv', companies_jgind)]
+        sectors = [('PESector' + code + '.csv', sector['names'])
+                   for code, sector in load_universe(args.universe)['sectors'].items()]
 
         for sector in sectors:
-            df_ = pd.read_csv(os.path.join(args.raw_folder, sector[0]), delimiter=';')
+            df_ = load_iress(os.path.join(args.raw_folder, sector[0]))
             df_ = df_.reindex(index=df_.index[::-1])
             df_ = df_.reset_index()
             for index, row in df_.iterrows():
-                start = str(row['Date']).replace("/", "-")
+                start = row['Date']
                 try:
-                    end = str(df_['Date'].iloc[index + 1]).replace("/", "-")
+                    end = df_['Date'].iloc[index + 1]
                     if start > end:
                         mask = (df['Date'] >= start) & (df['Name'].isin(sector[1]))
                     else:
@@ -106,114 +236,459 @@ def clean():
                 except IndexError:
                     mask = (df['Date'] >= start)
                 df.loc[mask, 'PESector'] = row['PE']
-                df.loc[mask, 'PESector'] = [x.replace(',', '.') for x in df.loc[mask, 'PESector']]
 
         output_file = args.output + "_clean.csv"
-        df.to_csv(output_file, index=False)
+        as_text(df).to_csv(output_file, index=False)
         print("Processing Time: {:5.2f}s".format(time.time() - start_time))
 
 
-def merge():
-    if True:
-        start_time = time.time()
-        df = pd.read_csv(os.path.join(args.raw_folder, 'CompanyHistoricData.csv'), delimiter=';')
-        df = df.rename(columns={'Close': 'Price', 'Company': 'Name', 'Beta Weekly Unleveraged': 'ShareBeta'})
-        for c in df.columns:
-            if c == "Name" or c == "Date":
-                continue
-            if df[c].dtype == np.int64 or df[c].dtype == np.float64:
-                continue
-            df[c] = [x.replace(',', '.') for x in df[c].values]
+MANIFEST_VERSION = 2
 
-        df_ = pd.read_csv(os.path.join(args.raw_folder, 'DebtEquity.csv'), delimiter=';')
-        df['Debt/EquityIndustry'] = df_['Debt/EquityIndustry'].loc[0]
-        df['Debt/EquityIndustry'] = [x.replace(',', '.') for x in df['Debt/EquityIndustry']]
+RATE_FILES = ['InflationRate', 'MarketRateOfReturn', 'RiskFreeRateOfReturn']
 
-        rate_files = ['InflationRate', 'MarketRateOfReturn', 'RiskFreeRateOfReturn']
-        for rate in rate_files:
-            df_ = pd.read_csv(os.path.join(args.raw_folder, rate + '.csv'), delimiter=';')
-            df[rate] = np.nan
-            for index, row in df_.iterrows():
-                start_year = str(date(int(row['Year']), 1, 1))
-                end_year = str(date(int(row['Year']) + 1, 1, 1))
-                mask = (df['Date'] >= start_year) & (df['Date'] < end_year)
-                df.loc[mask, rate] = row[rate]
-                df.loc[mask, rate] = [x.replace(',', '.') for x in df.loc[mask, rate]]
+# Derived column groups in output column order. Every group also depends on the history rows it is joined onto
+COLUMN_GROUPS = ['industry'] + RATE_FILES + ['market', 'sector', 'fundamentals']
 
-        df_ = pd.read_csv(os.path.join(args.raw_folder, 'ALSI.csv'), delimiter=';')
-        df_ = df_.reindex(index=df_.index[::-1])
-        df_ = df_.reset_index()
-        df['PEMarket'] = np.nan
-        for index, row in df_.iterrows():
-            start = str(row['Date'])
-            try:
-                end = str(df_['Date'].iloc[index + 1])
-                if start > end:
-                    mask = (df['Date'] >= start)
-                else:
-                    mask = (df['Date'] >= start) & (df['Date'] < end)
-            except IndexError:
-                mask = (df['Date'] >= start)
-            df.loc[mask, 'PEMarket'] = row['PE']
-            df.loc[mask, 'PEMarket'] = [x.replace(',', '.') for x in df.loc[mask, 'PEMarket']]
 
-        df['PESector'] = np.nan
-        sectors = [('JCSEV.csv', companies_jcsev), ('JGIND.csv', companies_jgind)]
+def source_groups(universe):
+    """
+    Returns the derived column groups computed from each raw file of a universe, and from the universe itself
+    """
+    groups = {'DebtEquity': ['industry'], 'universe': ['market', 'sector']}
+    groups.update({rate: [rate] for rate in RATE_FILES})
+    groups.setdefault(universe['market'], []).append('market')
+    for sector in universe['sectors'].values():
+        if 'sector' not in groups.setdefault(sector['benchmark'], []):
+            groups[sector['benchmark']].append('sector')
+    return groups
+
+
+def file_hash(path):
+    """
+    Returns the SHA-1 digest of the contents of a file
+    """
+    digest = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def source_hashes(raw_folder, universe_file):
+    """
+    Returns the content hash of the universe file and of every raw IRESS file, keyed by its path relative to
+    the raw folder
+    """
+    universe = load_universe(universe_file)
+    hashes = {'universe': file_hash(universe_file)}
+    hashes.update({name: file_hash(os.path.join(raw_folder, name + '.csv')) for name in raw_files(universe)})
+    for path in company_files(raw_folder):
+        hashes[os.path.join('Company', path)] = file_hash(os.path.join(raw_folder, 'Company', path))
+    return hashes
+
+
+def partition_hashes(df, keys):
+    """
+    Returns the content hash of the rows of each (company, year) partition of a dataframe
+    """
+    rows = pd.util.hash_pandas_object(df, index=False).to_numpy()
+    return {key: hashlib.sha1(rows[index].tobytes()).hexdigest() for key, index in partition_rows(keys).items()}
+
+
+def partition_rows(keys):
+    """
+    Returns the row positions of each (company, year) partition key
+    """
+    return pd.Series(keys).groupby(keys, sort=False).indices
 
+
+def partition_path(partition_folder, key):
+    """
+    Returns the output file of a (company, year) partition
+    """
+    name, year = key.rsplit('|', 1)
+    return os.path.join(partition_folder, re.sub(r'[^0-9A-Za-z]+', '_', name), year + '.csv')
+
+
+def as_text(df, nan_columns=()):
+    """
+    Returns a copy of a dataframe with its float columns written the way the raw IRESS values were: integer
+    valued numbers without a decimal point, and missing values as 'nan' in nan_columns and empty elsewhere
+
+    Parameters
+    ----------
+    df : pandas.DataFrame
+        Rows to write
+    nan_columns : list, optional
+        Columns whose missing values are written as 'nan', the fundamentals fields of the company files
+
+    Returns
+    -------
+    pandas.DataFrame
+        Copy of the rows with the float columns as strings
+    """
+    df = df.copy()
+    for column in df.columns[[dtype.kind == 'f' for dtype in df.dtypes]]:
+        values = df[column].to_numpy()
+        text = np.array([repr(value) for value in values.tolist()], dtype=object)
+        integral = np.isfinite(values) & (values == np.round(values)) & (np.abs(values) < 2 ** 53)
+        text[integral] = values[integral].astype(np.int64).astype(str)
+        text[np.isnan(values)] = 'nan' if column in nan_columns else ''
+        df[column] = text
+    return df
+
+
+def derive(df, group, frames, universe, fundamentals=None):
+    """
+    Adds the columns of one derived column group to history rows in place. Every group is computed row by
+    row, so any subset of the history can be derived on its own
+
+    Parameters
+    ----------
+    df : pandas.DataFrame
+        History rows with parsed dates
+    group : str
+        Column group in COLUMN_GROUPS
+    frames : dict
+        Raw frames keyed by file name
+    universe : dict
+        Market index and sectors from load_universe()
+    fundamentals : pandas.DataFrame, optional
+        Fundamentals indexed by (Name, year) with one column per field, for the fundamentals group
+
+    Returns
+    -------
+    list
+        Columns of the group
+    """
+    dates = df['Date'].to_numpy()
+    if group == 'industry':
+        df['Debt/EquityIndustry'] = frames['DebtEquity']['Debt/EquityIndustry'].loc[0]
+        return ['Debt/EquityIndustry']
+    if group in RATE_FILES:
+        df_ = frames[group]
+        starts, ends = year_bounds(df_['Year'])
+        df[group] = interval_join(dates, starts, df_[group], ends)
+        return [group]
+    if group == 'market':
+        df_ = frames[universe['market']]
+        df_ = df_.reindex(index=df_.index[::-1])
+        df['PEMarket'] = interval_join(dates, df_['Date'], df_['PE'])
+        return ['PEMarket']
+    if group == 'sector':
+        df['PESector'] = np.nan
+        sectors = [(sector['benchmark'], sector['names']) for sector in universe['sectors'].values()]
         for sector in sectors:
-            df_ = pd.read_csv(os.path.join(args.raw_folder, sector[0]), delimiter=';')
+            df_ = frames[sector[0]]
             df_ = df_.reindex(index=df_.index[::-1])
-            df_ = df_.reset_index()
-            for index, row in df_.iterrows():
-                start = str(row['Date'])
-                try:
-                    end = str(df_['Date'].iloc[index + 1])
-                    if start > end:
-                        mask = (df['Date'] >= start) & (df['Name'].isin(sector[1]))
-                    else:
-                        mask = (df['Date'] >= start) & (df['Date'] < end) & (df['Name'].isin(sector[1]))
-                except IndexError:
-                    mask = (df['Date'] >= start)
-                df.loc[mask, 'PESector'] = row['PE']
-                df.loc[mask, 'PESector'] = [x.replace(',', '.') for x in df.loc[mask, 'PESector']]
+            pe_sector = interval_join(dates, df_['Date'], df_['PE'])
+            mask = df['Name'].isin(sector[1]).to_numpy() & pd.notna(pe_sector)
+            df.loc[mask, 'PESector'] = pe_sector[mask]
+            # The latest sector PE has always been applied to every company from its date on
+            df.loc[dates >= df_['Date'].iloc[-1], 'PESector'] = df_['PE'].iloc[-1]
+        return ['PESector']
+
+    # Fundamentals are looked up by (Name, year) and overwrite existing columns only for the companies and
+    # years they cover
+    index = pd.MultiIndex.from_arrays([df['Name'], df['Date'].dt.year])
+    covered = index.isin(fundamentals.index)
+    values = fundamentals.reindex(index)
+    for field in fundamentals.columns:
+        if field in df:
+            df[field] = np.where(covered, values[field].to_numpy(), df[field].to_numpy())
+        else:
+            df[field] = values[field].to_numpy()
+    return fundamentals.columns.tolist()
+
+
+def group_columns_of(group, fields):
+    """
+    Returns the output columns of a derived column group
+    """
+    columns = {'industry': ['Debt/EquityIndustry'], 'market': ['PEMarket'], 'sector': ['PESector'],
+               'fundamentals': fields}
+    return columns.get(group, [group])
+
+
+def fundamentals_table(fundamentals):
+    """
+    Returns the long fundamentals tables of the company files as one table indexed by (Name, year) with one
+    column per field, in the order the fields first appear
+    """
+    fundamentals = pd.concat(fundamentals, ignore_index=True) if fundamentals else \
+        pd.DataFrame(columns=['Name', 'year', 'field', 'value'])
+    fundamentals = fundamentals.drop_duplicates(subset=['Name', 'year', 'field'], keep='last')
+    fields = fundamentals['field'].unique().tolist()
+    return fundamentals.pivot(index=['Name', 'year'], columns='field', values='value')[fields]
+
+
+def history_blocks(chunks, block_size, column='Company'):
+    """
+    Regroups chunks of history rows into blocks of whole companies of about block_size rows, so a company
+    split across chunks is processed as a whole while only one block and one chunk are held in memory. A
+    company with more rows than block_size makes a block of its own
 
-        cols = []
-        for path in sorted(os.listdir(args.raw_folder + '/Company')):
-            if path == ".DS_Store":
+    Parameters
+    ----------
+    chunks : iterable
+        Chunks of history rows in file order, grouped by company
+    block_size : int
+        Rows per block
+    column : str, optional
+        Company column
+
+    Yields
+    ------
+    pandas.DataFrame
+        The rows of one or more whole companies in file order
+    """
+    block, company = [], []
+    block_rows = 0
+    done = set()
+    for chunk in chunks:
+        names = chunk[column].to_numpy()
+        starts = np.concatenate([[0], np.flatnonzero(names[1:] != names[:-1]) + 1, [len(names)]])
+        for start, stop in zip(starts[:-1], starts[1:]):
+            name = names[start]
+            if company and company[0][column].iloc[0] != name:
+                # The previous company is complete
+                done.add(company[0][column].iloc[0])
+                company_rows = sum(len(rows) for rows in company)
+                if block and block_rows + company_rows > block_size:
+                    yield pd.concat(block)
+                    block, block_rows = [], 0
+                block += company
+                block_rows += company_rows
+                company = []
+            if name in done:
+                raise ValueError("The history rows of {} are not contiguous".format(name))
+            company.append(chunk.iloc[start:stop])
+    block += company
+    if block:
+        yield pd.concat(block)
+
+
+def merge(output, raw_folder, universe_file, workers=None, chunk_size=None, full=False):
+    """
+    Builds the clean dataset incrementally. The content hash of every raw file, and of the history rows and
+    each derived column group of every (company, year) partition, are recorded in a manifest next to the
+    output. On a re-run only the column groups whose raw files changed are recomputed, only for the companies
+    they affect, and only the partitions whose content changed are rewritten before the output is assembled
+    from the partition files.
+
+    With a chunk size the history is streamed in chunks of rows and processed in blocks of whole companies of
+    about that many rows, so peak memory is bounded by the chunk size and the largest company rather than the
+    whole history
+
+    Parameters
+    ----------
+    output : str
+        Output prefix of the clean dataset, manifest and partition folder
+    raw_folder : str
+        Folder of the raw IRESS files
+    universe_file : str
+        Universe file from load_universe()
+    workers : int, optional
+        Processes parsing the raw files
+    chunk_size : int, optional
+        Rows per chunk when streaming the history
+    full : bool, optional
+        Rebuild every partition regardless of the manifest
+    """
+    start_time = time.time()
+    output_file = output + "_clean.csv"
+    manifest_file = output + "_manifest.json"
+    partition_folder = output + "_partitions"
+
+    manifest = {}
+    if not full and os.path.isfile(output_file) and os.path.isfile(manifest_file):
+        with open(manifest_file) as f:
+            manifest = json.load(f)
+        if manifest.get('version') != MANIFEST_VERSION:
+            manifest = {}
+    universe = load_universe(universe_file)
+    sources = source_hashes(raw_folder, universe_file)
+    if sources == manifest.get('sources'):
+        print("Up to date: {}".format(output_file))
+        return
+    changed = {source for source, digest in sources.items() if manifest.get('sources', {}).get(source) != digest}
+
+    names = {path: name for path, name in manifest.get('companyFiles', {}).items()
+             if os.path.join('Company', path) in sources}
+    if len(names) < len(manifest.get('companyFiles', {})):
+        # The order of the fundamentals columns follows the first company file, so removing one is a rebuild
+        print("Company files removed, rebuilding {}".format(output_file))
+        return merge(output, raw_folder, universe_file, workers, chunk_size, full=True)
+
+    # The changed company files are parsed up front, those of companies with changed history when they come up
+    named_files = raw_files(universe)
+    if chunk_size is not None:
+        named_files.remove('CompanyHistoricData')
+    paths = [path for path in company_files(raw_folder) if os.path.join('Company', path) in changed]
+    frames, tables = ingest(raw_folder, workers, raw_files=named_files, company_paths=paths)
+    tables = dict(zip(paths, tables))
+    names.update({path: table['Name'].iloc[0] for path, table in tables.items() if len(table)})
+    changed_names = {names[path] for path in paths if path in names}
+    fundamentals = fundamentals_table([tables[path] for path in sorted(tables)])
+
+    fields = manifest.get('fields', [])
+    if manifest and [field for field in fundamentals.columns if field not in fields]:
+        # A new fundamentals field changes the layout of every partition
+        print("New fundamentals fields, rebuilding {}".format(output_file))
+        return merge(output, raw_folder, universe_file, workers, chunk_size, full=True)
+    fields += [field for field in fundamentals.columns if field not in fields]
+
+    if chunk_size is None:
+        blocks = [frames['CompanyHistoricData']]
+    else:
+        blocks = history_blocks(iter_iress(os.path.join(raw_folder, 'CompanyHistoricData.csv'),
+                                           chunksize=chunk_size), chunk_size)
+
+    partitions = manifest.get('partitions', {})
+    orders = []
+    columns = None
+    written = 0
+    for df in blocks:
+        df = df.rename(columns={'Close': 'Price', 'Company': 'Name', 'Beta Weekly Unleveraged': 'ShareBeta'})
+        df = df.reindex(index=df.index[::-1]).reset_index(drop=True)
+        history_columns = df.columns.tolist()
+        if columns is None:
+            columns = history_columns + [c for c in ['Debt/EquityIndustry'] + RATE_FILES + ['PEMarket', 'PESector']
+                                         if c not in history_columns]
+            columns += [field for field in fields if field not in columns]
+        keys = (df['Name'] + '|' + df['Date'].dt.year.astype(str)).to_numpy()
+        orders.append(pd.unique(keys).tolist())
+        history = partition_hashes(df, keys)
+
+        # Partitions with new or changed history rows are rebuilt with every column group
+        rebuilt = {key for key in orders[-1] if partitions.get(key, {}).get('history') != history[key]}
+        rebuilt_names = {key.rsplit('|', 1)[0] for key in rebuilt}
+        paths = [path for path in company_files(raw_folder)
+                 if path not in tables and names.get(path) in rebuilt_names]
+        if paths:
+            tables.update({path: read_company(os.path.join(raw_folder, 'Company', path)) for path in paths})
+            fundamentals = fundamentals_table([tables[path] for path in sorted(tables)])
+
+        # Derives each column group only for the rows of rebuilt partitions and of companies its changed files
+        # affect, and keeps the values of the partitions whose content changed
+        out = df.reindex(columns=columns)
+        updates = {key: {} for key in orders[-1]}
+        for group in COLUMN_GROUPS:
+            rows = pd.Series(keys).isin(rebuilt).to_numpy()
+            if group == 'fundamentals':
+                rows |= df['Name'].isin(changed_names).to_numpy()
+            elif any(group in source_groups(universe).get(source, []) for source in changed):
+                rows[:] = True
+            if not rows.any():
                 continue
-            df_ = pd.read_csv(os.path.join(args.raw_folder, 'Company', path), delimiter=';')
-            name = pd.unique(df_['Company'].values)[0]
-
-            df_ = df_.drop(columns=['Company']).T.rename(
-                columns={'Debt / Equity': 'Debt/Equity', 'Earnings / Share (c)': 'EPS',
-                         'Price / Earnings': 'PEYear', 'Return On Average Equity %': 'ROAE',
-                         'Return On Equity %': 'ROE', 'Ordinary Shareholders Equity at End of Year'
-                         : 'ShareholdersEquity'})
-            if len(cols) == 0:
-                cols = df_.columns
-            for column in df_.columns:
-                if column not in df:
-                    df[column] = np.nan
-                for index, row in df_.iterrows():
-                    start_year = str(date(int(index), 1, 1))
-                    end_year = str(date(int(index) + 1, 1, 1))
-                    mask = (df['Date'] >= start_year) & (df['Date'] < end_year) & (df['Name'] == name)
-                    df.loc[mask, column] = row[column]
-
-        for c in cols:
-            df[c] = df[c].astype(str)
-            df[c] = [x.replace(',', '.') for x in df[c].values]
-        df['Date'] = [x.replace('/', '-') for x in df['Date'].values]
-        df = df.reindex(index=df.index[::-1])
+            part = df.loc[rows, history_columns].copy()
+            group_columns = derive(part, group, frames, universe, fundamentals)
+            if group == 'fundamentals':
+                # Fields of companies whose files were not parsed again are missing for the parsed ones
+                group_columns = fields
+                part = part.reindex(columns=columns)
+            digests = {key: digest for key, digest in partition_hashes(part[group_columns], keys[rows]).items()
+                       if key in rebuilt or partitions.get(key, {}).get(group) != digest}
+            for key, digest in digests.items():
+                updates[key][group] = digest
+            update = pd.Series(keys[rows]).isin(digests).to_numpy()
+            out.loc[np.flatnonzero(rows)[update], group_columns] = part.loc[update, group_columns].to_numpy()
+
+        # Rewrites the partitions whose history or derived columns changed
+        for key, index in partition_rows(keys).items():
+            if key not in rebuilt and not updates[key]:
+                continue
+            path = partition_path(partition_folder, key)
+            partition = out.iloc[index]
+            if key not in rebuilt:
+                # Columns of unchanged groups are kept from the partition file
+                stored = pd.read_csv(path, parse_dates=['Date']).reindex(columns=columns)
+                group_columns = [c for group in updates[key] for c in group_columns_of(group, fields)]
+                stored[group_columns] = partition[group_columns].to_numpy()
+                partition = stored
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            as_text(partition, fields).to_csv(path, index=False)
+            partitions[key] = {**partitions.get(key, {}), 'history': history[key], **updates[key]}
+            written += 1
+
+    # The output is in reverse history order, the companies in reverse and the dates of each in ascending order
+    order = [key for keys in reversed(orders) for key in keys]
+    for key in set(partitions) - set(order):
+        del partitions[key]
+        if os.path.isfile(partition_path(partition_folder, key)):
+            os.remove(partition_path(partition_folder, key))
+
+    # The output is the concatenation of the partition files
+    with open(output_file, 'w') as f:
+        pd.DataFrame(columns=columns).to_csv(f, index=False)
+        for key in order:
+            with open(partition_path(partition_folder, key)) as partition:
+                next(partition)
+                shutil.copyfileobj(partition, f)
+
+    with open(manifest_file, 'w') as f:
+        json.dump({'version': MANIFEST_VERSION, 'sources': sources, 'companyFiles': names, 'fields': fields,
+                   'partitions': {key: partitions[key] for key in order}}, f, indent=1)
+    print("Rewrote {} of {} partitions".format(written, len(order)))
+    print("Processing Time: {:5.2f}s".format(time.time() - start_time))
 
-        output_file = args.output + "_clean.csv"
-        df.to_csv(output_file, index=False)
-        print("Processing Time: {:5.2f}s".format(time.time() - start_time))
+
+def price_matrix(clean_file, output, value='Price', chunksize=None):
+    """
+    Builds the wide (date x company) price matrix of the clean dataset as a memory-mapped array, with the
+    ascending dates and the sorted company names of its rows and columns in index files next to it. Prices a
+    company does not have on a date are NaN. With a chunk size the clean dataset is streamed in chunks of rows
+
+    Parameters
+    ----------
+    clean_file : str
+        Clean dataset
+    output : str
+        Matrix path without extension, written to <output>.npy, <output>_dates.json and <output>_companies.json
+    value : str, optional
+        Price column
+    chunksize : int, optional
+        Rows read at a time
+    """
+    def chunks(columns):
+        reader = pd.read_csv(clean_file, usecols=columns, chunksize=chunksize)
+        return [reader] if chunksize is None else reader
+
+    dates, companies = set(), set()
+    for chunk in chunks(['Date', 'Name']):
+        dates.update(chunk['Date'].unique())
+        companies.update(chunk['Name'].unique())
+    dates, companies = pd.Index(sorted(dates)), pd.Index(sorted(companies))
+
+    values = np.lib.format.open_memmap(output + '.npy', mode='w+', dtype=np.float64,
+                                       shape=(len(dates), len(companies)))
+    values[:] = np.nan
+    # Of duplicate (date, company) rows the last one applies
+    for chunk in chunks(['Date', 'Name', value]):
+        values[dates.get_indexer(chunk['Date']), companies.get_indexer(chunk['Name'])] = \
+            chunk[value].to_numpy(dtype=np.float64)
+    values.flush()
+    del values
+
+    with open(output + '_dates.json', 'w') as f:
+        json.dump(dates.tolist(), f)
+    with open(output + '_companies.json', 'w') as f:
+        json.dump(companies.tolist(), f)
+    print("Price matrix of {} dates and {} companies: {}.npy".format(len(dates), len(companies), output))
 
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
     parser.add_argument('--raw_folder', type=str, default='data/INVEST_IRESS')
     parser.add_argument('--output', type=str, default='data/INVEST')
+    parser.add_argument('--universe', type=str, default='data/universe.json')
+    parser.add_argument('--workers', type=int, default=None)
+    parser.add_argument('--full', action='store_true', help='Rebuild every partition of the output')
+    parser.add_argument('--chunk_size', type=int, default=None,
+                        help='Stream the history in blocks of whole companies of about this many rows')
     args = parser.parse_args()
-    merge()
\ No newline at end of file
+    merge(args.output, args.raw_folder, args.universe, args.workers, args.chunk_size, args.full)
+
+    clean_file, matrix_file = args.output + "_clean.csv", args.output + "_prices.npy"
+    if not os.path.isfile(matrix_file) or os.path.getmtime(matrix_file) < os.path.getmtime(clean_file):
+        price_matrix(clean_file, args.output + "_prices", chunksize=args.chunk_size)
\ No newline at end of file
@@ -1,7 +1,130 @@
+import functools
+import json
 import os
+import re
 
+import numpy as np
 import pandas as pd
 
+# Every IRESS export is semicolon separated with decimal commas and a byte order mark
+IRESS_FORMAT = {"sep": ';', "decimal": ',', "encoding": 'utf-8-sig'}
+
+INDEX_COLUMNS = {"Date": "date", "Beta Monthly Leveraged": "float64", "Beta Monthly Unleveraged": "float64",
+                 "Beta Weekly Leveraged": "float64", "Beta Weekly Unleveraged": "float64", "Close": "float64",
+                 "Open": "float64", "PE": "float64"}
+
+# Columns and dtypes, date format and row order of each IRESS file. Files named after an index, such as ALSI
+# or a sector index, share the Index schema. Company files have one row per field, indexed by field name, and
+# one column per year
+IRESS_SCHEMAS = {
+    "CompanyHistoricData": {"columns": {**INDEX_COLUMNS, "Close": "int64", "Open": "int64", "Company": "str"},
+                            "date_format": "%Y/%m/%d", "order": ("Date", "descending", "Company")},
+    "DebtEquity": {"columns": {"Year": "int64", "Debt/EquityIndustry": "float64"}},
+    "InflationRate": {"columns": {"Year": "int64", "InflationRate": "float64"}},
+    "MarketRateOfReturn": {"columns": {"Year": "int64", "MarketRateOfReturn": "float64"}},
+    "RiskFreeRateOfReturn": {"columns": {"Year": "int64", "RiskFreeRateOfReturn": "float64"}},
+    "Index": {"columns": INDEX_COLUMNS, "date_format": "%Y/%m/%d", "order": ("Date", "descending", None)},
+    "Company": {"columns": {"Company": "str"}, "year_columns": "float64", "index": True},
+    # Files of the earlier IRESS export read by clean.clean()
+    "EPS_SE": {"columns": {"Company": "str", "Year": "int64", "EPS": "float64", "ShareholdersEquity": "float64"}},
+    "ShareBeta": {"columns": {"Date": "date", "Company": "str", "Beta Monthly Leveraged": "float64"},
+                  "date_format": "%Y/%m/%d"},
+    "PEMarket": {"columns": {"Date": "date", "PE": "float64"}, "date_format": "%Y/%m/%d"},
+    "PESectorJCSEV": {"columns": {"Date": "date", "PE": "float64"}, "date_format": "%Y/%m/%d"},
+    "PESectorJGIND": {"columns": {"Date": "date", "PE": "float64"}, "date_format": "%Y/%m/%d"},
+}
+
+
+def load_iress(path, schema=None):
+    """
+    Loads an IRESS file with numbers and dates parsed at read time and validates it against its schema
+
+    Parameters
+    ----------
+    path : str
+        IRESS file
+    schema : str, optional
+        Name of the schema in IRESS_SCHEMAS, the file name without extension by default and Index for files
+        not named after a schema
+
+    Returns
+    -------
+    pandas.DataFrame
+        The rows in file order
+    """
+    return next(iter_iress(path, schema))
+
+
+def iter_iress(path, schema=None, chunksize=None):
+    """
+    Reads an IRESS file in chunks of rows with numbers and dates parsed at read time, validating every chunk
+    against the schema and the row order across chunks
+
+    Parameters
+    ----------
+    path : str
+        IRESS file
+    schema : str, optional
+        Name of the schema in IRESS_SCHEMAS, the file name without extension by default and Index for files
+        not named after a schema
+    chunksize : int, optional
+        Rows per chunk, the whole file in one chunk by default
+
+    Yields
+    ------
+    pandas.DataFrame
+        The rows of each chunk in file order
+    """
+    name = schema if schema is not None else os.path.splitext(os.path.basename(path))[0]
+    if schema is None and name not in IRESS_SCHEMAS:
+        name = "Index"
+    if name not in IRESS_SCHEMAS:
+        raise ValueError("{}: no IRESS schema named {}".format(path, name))
+    schema = IRESS_SCHEMAS[name]
+    index_col = 0 if schema.get("index") else None
+
+    header = pd.read_csv(path, nrows=0, index_col=index_col, **IRESS_FORMAT).columns.tolist()
+    columns = dict(schema["columns"])
+    if "year_columns" in schema:
+        columns.update({c: schema["year_columns"] for c in header if re.fullmatch(r"\d{4}", str(c))})
+    missing = [c for c in columns if c not in header]
+    unexpected = [c for c in header if c not in columns]
+    if missing or unexpected:
+        raise ValueError("{}: does not match the {} schema, missing columns {}, unexpected columns {}".format(
+            path, name, missing, unexpected))
+
+    dtypes = {c: ("str" if dtype == "date" else dtype) for c, dtype in columns.items()}
+    # Last value of the order column in each group, to check the order across chunks
+    last = {}
+    mismatch = "{}: does not match the {} schema, {}"
+    try:
+        chunks = iter([pd.read_csv(path, index_col=index_col, dtype=dtypes, **IRESS_FORMAT)] if chunksize is None
+                      else pd.read_csv(path, index_col=index_col, dtype=dtypes, chunksize=chunksize, **IRESS_FORMAT))
+    except ValueError as e:
+        raise ValueError(mismatch.format(path, name, e))
+    while True:
+        try:
+            df = next(chunks, None)
+            if df is None:
+                return
+            for c in [c for c, dtype in columns.items() if dtype == "date"]:
+                df[c] = pd.to_datetime(df[c], format=schema["date_format"])
+        except ValueError as e:
+            raise ValueError(mismatch.format(path, name, e))
+
+        if "order" in schema:
+            column, direction, group = schema["order"]
+            groups = [(None, df[column])] if group is None else df.groupby(group, sort=False)[column]
+            for key, values in groups:
+                if key in last:
+                    values = pd.concat([pd.Series([last[key]]), values], ignore_index=True)
+                ordered = values.is_monotonic_decreasing if direction == "descending" else \
+                    values.is_monotonic_increasing
+                if not ordered:
+                    raise ValueError("{}: {} is not in {} order".format(path, column, direction))
+                last[key] = values.iloc[-1]
+        yield df
+
 
 def load_data(filename='data/INVEST_clean.csv'):
     df = pd.read_csv(filename, sep=',')
@@ -9,9 +132,83 @@ def load_data(filename='data/INVEST_clean.csv'):
     return df
 
 
+def load_universe(filename='data/universe.json'):
+    """
+    Loads the universe of shares: the market index and, for each sector, its benchmark index and companies
+
+    Parameters
+    ----------
+    filename : str, optional
+        Universe file
+
+    Returns
+    -------
+    dict
+        Market index code and the sectors keyed by sector code, each with a benchmark index code, the sector
+        code by default, and a list of company names
+    """
+    with open(filename) as f:
+        universe = json.load(f)
+    for code, sector in universe["sectors"].items():
+        sector.setdefault("benchmark", code)
+    return universe
+
+
 def load_benchmark_data(index_code, directory='data/INVEST_IRESS'):
     """
        Loads and returns a dataframe containing benchmark data
     """
-    df = pd.read_csv(os.path.join(directory, index_code + '.csv'), delimiter=';')
-    return df.reindex(index=df.index[::-1])
\ No newline at end of file
+    df = load_iress(os.path.join(directory, index_code + '.csv'))
+    return df.reindex(index=df.index[::-1])
+
+
+@functools.lru_cache(maxsize=None)
+def load_benchmark_series(index_code, directory='data/INVEST_IRESS'):
+    """
+       Loads and returns a dataframe containing benchmark data in ascending date order. The result is cached
+       and shared, so it must not be modified
+    """
+    df = load_iress(os.path.join(directory, index_code + '.csv'))
+    return df.iloc[::-1].reset_index(drop=True)
+
+
+@functools.lru_cache(maxsize=None)
+def load_price_matrix(name='data/INVEST_prices'):
+    """
+    Loads the wide (date x company) price matrix built by clean.py. The prices are memory-mapped read-only,
+    so slices of their rows are views that read only the dates they cover. The result is cached and shared
+
+    Parameters
+    ----------
+    name : str, optional
+        Matrix path without extension
+
+    Returns
+    -------
+    tuple
+        Prices of shape (dates, companies), their ascending dates and their company names
+    """
+    values = np.load(name + '.npy', mmap_mode='r')
+    with open(name + '_dates.json') as f:
+        dates = pd.DatetimeIndex(json.load(f))
+    with open(name + '_companies.json') as f:
+        companies = json.load(f)
+    return values, dates, companies
+
+
+def date_rows(dates, start=None, end=None):
+    """
+    Returns the slice of the rows of ascending dates between two dates (inclusive)
+    """
+    first = dates.searchsorted(pd.Timestamp(start), side='left') if start is not None else 0
+    last = dates.searchsorted(pd.Timestamp(end), side='right') if end is not None else len(dates)
+    return slice(first, last)
+
+
+@functools.lru_cache(maxsize=None)
+def load_clean_data(filename='data/INVEST_clean.csv'):
+    """
+       Loads and returns the clean dataset as read by load_data(). The result is cached and shared, so it
+       must not be modified
+    """
+    return load_data(filename)
@@ -1,7 +1,107 @@
-import random
+import numpy as np
 
 
-def simulate(df_, frac=0.3, scale=1, method='std'):
+def noise_columns(df):
+    """
+    Returns the columns of a dataframe that noise is applied to
+    """
+    return [col for col in df.columns if col != "Name" and col != "Date"]
+
+
+def column_statistics(df, columns=None):
+    """
+    Returns the mean and standard deviation of each noisy column, computed once on the clean data
+
+    Parameters
+    ----------
+    df : pandas.DataFrame
+        Data frame containing company data
+    columns : list, optional
+        Columns to describe, all columns except Name and Date by default
+
+    Returns
+    -------
+    dict
+    """
+    columns = noise_columns(df) if columns is None else columns
+    values = df[columns].to_numpy(dtype=np.float64)
+    return {
+        "columns": columns,
+        "mean": np.nanmean(values, axis=0),
+        "std": np.nanstd(values, axis=0, ddof=1),
+    }
+
+
+def simulate_replicas(df_, n_replicas, frac=0.3, scale=1, method='std', seed=None, stats=None):
+    """
+    Returns the values of n noisy replicas of the data, generated in one batch
+
+    Parameters
+    ----------
+    df_ : pandas.DataFrame
+        Data frame containing company data
+    n_replicas : int
+        Number of replicas
+    frac : float
+        Fraction of rows to be replaced with noise in each replica
+    scale: float
+        Magnitude of noise
+    method: str
+        Method to create noisy data, one of std, zero or mean
+    seed : int or numpy.random.Generator, optional
+        Seed of the random generator
+    stats : dict, optional
+        Column statistics from column_statistics(), computed from df_ when not given
+
+    Returns
+    -------
+    numpy.ndarray
+        Noisy values of shape (replicas, rows, columns) for the columns in stats["columns"]
+    """
+    rng = np.random.default_rng(seed)
+    stats = column_statistics(df_) if stats is None else stats
+    values = df_[stats["columns"]].to_numpy(dtype=np.float64)
+    n_rows, n_columns = values.shape
+
+    # The same rows are replaced in every column of a replica, as with df.sample(frac=frac)
+    n_noisy = int(round(frac * n_rows))
+    ranks = np.argsort(rng.random((n_replicas, n_rows)), axis=1)
+    rows = np.zeros((n_replicas, n_rows), dtype=bool)
+    np.put_along_axis(rows, ranks[:, :n_noisy], True, axis=1)
+    rows = rows[:, :, None]
+
+    if method == 'std':
+        # Each column of a replica is shifted up or down with equal probability
+        signs = np.where(rng.random((n_replicas, 1, n_columns)) >= 0.5, 1.0, -1.0)
+        return values + rows * signs * stats["std"] * scale
+    if method == 'zero':
+        return np.where(rows, 0.001, values)
+    if method == 'mean':
+        return np.where(rows, stats["mean"] * scale, values)
+    return np.broadcast_to(values, (n_replicas, n_rows, n_columns)).copy()
+
+
+def replica_frames(df_, replicas, columns=None):
+    """
+    Yields each replica as a data frame with the Name and Date columns of the clean data
+
+    Parameters
+    ----------
+    df_ : pandas.DataFrame
+        Data frame containing company data
+    replicas : numpy.ndarray
+        Noisy values of shape (replicas, rows, columns) from simulate_replicas()
+    columns : list, optional
+        Columns of the replica values, all columns except Name and Date by default
+    """
+    columns = noise_columns(df_) if columns is None else columns
+    for values in replicas:
+        df = df_.copy()
+        df[columns] = values
+        yield df
+
+
+def simulate(df_, frac=0.3, scale=1, method='std', seed=None):
     """
     Returns a dataframe containing noisy data
 
@@ -15,29 +115,11 @@ def simulate(df_, frac=0.3, scale=1, method='std'):
         Magnitude of noise
     method: str
         Method to create noisy data
+    seed : int or numpy.random.Generator, optional
+        Seed of the random generator
     Returns
     -------
     df_ : pandas.DataFrame
     """
-    df = df_.copy(deep=True)
-    idx = df.sample(frac=frac).index
-    if method == 'std':
-        for col in df.columns:
-            if col == "Name" or col == "Date":
-                continue
-            uniform = random.uniform(0, 1)
-            if uniform >= 0.5:
-                df.loc[idx, col] += df[col].std() * scale
-            else:
-                df.loc[idx, col] -= df[col].std() * scale
-    if method == 'zero':
-        for col in df.columns:
-            if col == "Name" or col == "Date":
-                continue
-            df.loc[idx, col] = 0.001
-    if method == 'mean':
-        for col in df.columns:
-            if col == "Name" or col == "Date":
-                continue
-            df.loc[idx, col] = df[col].mean() * scale
-    return df
\ No newline at end of file
+    stats = column_statistics(df_)
+    return next(replica_frames(df_, simulate_replicas(df_, 1, frac, scale, method, seed, stats), stats["columns"]))
@@ -1,20 +1,307 @@
+from concurrent.futures import ProcessPoolExecutor
+
 import numpy as np
 import pandas as pd
 
 import invest.calculator.ratios as ratios
 import invest.calculator.threshold as threshold
 
+# Reasons a company-year is skipped, in the order they are checked
+SKIP_REASONS = ["no data", "no current year data", "no EPS history", "no previous year data",
+                "no PE sector history", "no PE market history"]
+
+
+def coverage(df, companies, years):
+    """
+    Returns which company-years have the inputs needed to compute their ratios, for all companies and years at
+    once: rows in the year, in one of the four years before it for the EPS history and in the year before it
+    for the current values, and PE sector and PE market values in the three years before it
+
+    Parameters
+    ----------
+    df : pandas.DataFrame
+        Company data with Date, Name, PESector and PEMarket columns
+    companies : list
+        Companies along the rows
+    years : list
+        Years to evaluate along the columns
+
+    Returns
+    -------
+    tuple
+        Coverage matrix of eligible company-years and the reason each other company-year is skipped, None
+        where it is eligible, both (company x year) data frames
+    """
+    years = list(years)
+    first = min(years) - 4
+    n_years = max(years) - first + 1
+    company = pd.Categorical(df['Name'], categories=companies).codes
+    year = pd.to_datetime(df['Date']).dt.year.to_numpy() - first
+    mask = (company >= 0) & (year >= 0) & (year < n_years)
+
+    def window_counts(values):
+        # Counts per (company, year) with a leading zero year, so sums over years are differences of cumsums
+        counts = np.zeros((len(companies), n_years + 1), dtype=np.int64)
+        np.add.at(counts, (company[mask & values], year[mask & values] + 1), 1)
+        return np.cumsum(counts, axis=1)
+
+    def in_years(cumulative, before, n):
+        # Whether there is a value in the n years starting the given number of years before each year
+        end = np.asarray(years) - first - before + n
+        return cumulative[:, end] - cumulative[:, end - n] > 0
+
+    rows = window_counts(np.ones(len(df), dtype=bool))
+    sector = window_counts(df['PESector'].notna().to_numpy())
+    market = window_counts(df['PEMarket'].notna().to_numpy())
+    present = np.zeros(len(companies), dtype=bool)
+    present[company[company >= 0]] = True
+
+    checks = [np.broadcast_to(present[:, None], (len(companies), len(years))), in_years(rows, 0, 1),
+              in_years(rows, 4, 4), in_years(rows, 1, 1), in_years(sector, 3, 3), in_years(market, 3, 3)]
+    reasons = np.select([~check for check in checks], SKIP_REASONS, default=None)
+    eligible = np.logical_and.reduce(checks)
+    return (pd.DataFrame(eligible, index=companies, columns=years),
+            pd.DataFrame(reasons, index=companies, columns=years))
+
+
+def coverage_report(reasons):
+    """
+    Returns a summary of the company-years processed and the number skipped for each reason
+
+    Parameters
+    ----------
+    reasons : pandas.Series or pandas.DataFrame
+        Skip reason of each company-year, None where it is eligible
+
+    Returns
+    -------
+    str
+    """
+    values = pd.Series(np.asarray(reasons, dtype=object).ravel())
+    counts = values.value_counts()
+    lines = ["Coverage: {} of {} company-years processed".format(values.isna().sum(), len(values))]
+    lines += ["  {}: {}".format(reason, count) for reason, count in counts.items()]
+    return "\n".join(lines)
+
+
+def process_companies(df, companies, margin_of_safety, beta, years, extension):
+    """
+    Computes the ratios and discrete states of the given companies for a year. The companies are expected to
+    have the inputs of the year, as screened by coverage()
+
+    Parameters
+    ----------
+    df : pandas.DataFrame
+        Company data containing at least the rows of the given companies
+    companies : list
+        Companies to process
+    margin_of_safety : float
+        Margin of safety of the thresholds
+    beta : float
+        Beta threshold
+    years : int
+        Year to evaluate
+    extension : bool
+        Classify the systematic risk
+
+    Returns
+    -------
+    tuple
+        Rows of discrete states and rows of continuous ratios of the processed companies, and the reason each
+        company whose ratios could not be computed is skipped
+    """
+    share_rows = []
+    ratio_rows = []
+    skipped = {}
+    for company in companies:
+        try:
+            company_data = df[df['Name'] == company]
+            eps_year_list = []
+            pe_sector_list = []
+            pe_market_list = []
+
+            start_year = years - 4
+            end_year = years
+            df_current_year = None
+            current_price = None
+
+                          
+            for i in range(start_year, end_year):                    
+                mask_eps = (company_data['Date'] >= f"{i}-01-01") & (company_data['Date'] <= f"{i}-12-31")
+
+                company_df_by_year = company_data.loc[mask_eps]
+
+                if not company_df_by_year.empty:
+                    eps = company_df_by_year.iloc[-1]['EPS']
+                    eps_year_list.append(eps)
+
+                mask_current_price = (company_data['Date'] >= f"{end_year - 1}-01-01") & (company_data['Date'] < f"{end_year}-01-01")
+                df_current_year = company_data.loc[mask_current_price]
+                if not df_current_year.empty:
+                    current_price = df_current_year.iloc[-1]['Price']
+
+                mask_pe_sector_market = (company_data['Date'] >= f"{end_year - 3}-01-01") & (company_data['Date'] < f"{end_year}-01-01")
+                pe_sector_3_years = company_data.loc[mask_pe_sector_market, 'PESector']
+                pe_market_3_years = company_data.loc[mask_pe_sector_market, 'PEMarket']
+                
+                pe_sector_list.extend(pe_sector_3_years[~np.isnan(pe_sector_3_years)].tolist())
+                pe_market_list.extend(pe_market_3_years[~np.isnan(pe_market_3_years)].tolist())
+
+            # historic_earnings_growth_rate
+            growth_years_n = end_year - start_year
+            historic_earnings_growth_rate = ratios.historic_earnings_growth_rate(eps_year_list, growth_years_n)
+
+            # historic_earnings_cagr
+            if len(eps_year_list) >= 4:
+                historic_earnings_cagr = ratios.historic_earnings_cagr(eps_year_list[-1], eps_year_list[-4], 3)
+            else:
+                historic_earnings_cagr = 0
+
+            # historic_price_to_earnings_share
+            mask_pe = (df['Date'] >= f"{end_year - 1}-01-01") & (
+                    df['Date'] < f"{end_year}-01-01") & (df['Name'] == company)
+            df_company_3_years = df.loc[mask_pe]
+            price_list_3_years = df_company_3_years['Price'].to_numpy()
+            eps_list_3_years = df_company_3_years['EPS'].to_numpy()
+            historic_price_to_earnings_share = ratios.historic_price_to_earnings_share(price_list_3_years,
+                                                                                       eps_list_3_years)
+            forward_earnings_current_year = ratios.forward_earnings(eps_year_list[-1], historic_earnings_growth_rate)
+
+            # Skip this company if essential calculations return 0 due to insufficient data
+            if (historic_earnings_growth_rate == 0 or historic_earnings_cagr == 0 or
+                historic_price_to_earnings_share == 0 or forward_earnings_current_year == 0):
+                skipped[company] = "zero earnings ratio"
+                continue
+
+            historic_earnings_growth_rate_past = ratios.historic_earnings_growth_rate(eps_year_list, 3)
+
+            forward_earnings_past = ratios.forward_earnings(eps_year_list[-1],
+                                                            historic_earnings_growth_rate_past)  # intermediate
+            forward_earnings_cagr = ratios.forward_earnings_cagr(forward_earnings_current_year, forward_earnings_past,
+                                                                 3)
+
+            forward_price_to_earnings = ratios.forward_price_to_earnings(current_price, forward_earnings_current_year)
+
+            # PE Relative
+            pe_relative_market = ratios.pe_relative_market(historic_price_to_earnings_share, pe_market_list)
+            pe_relative_sector = ratios.pe_relative_sector(historic_price_to_earnings_share, pe_sector_list)
+
+            # ROE
+            roe_current = df_current_year.iloc[-1]['ROE']
+            # COE
+            market_rate_of_return = df_current_year.iloc[-1]['MarketRateOfReturn']
+            risk_free_rate_of_return = df_current_year.iloc[-1]['RiskFreeRateOfReturn']
+            share_beta = df_current_year.iloc[-1]['ShareBeta']
+            cost_of_equity = ratios.cost_of_equity(float(market_rate_of_return), float(risk_free_rate_of_return),
+                                                   float(share_beta))
+            # Relative Debt/Equity
+            debt_equity = df_current_year.iloc[-1]['Debt/Equity']
+            debt_equity_industry = df_current_year.iloc[-1]['Debt/EquityIndustry']
+            relative_debt_equity = ratios.relative_debt_to_equity(float(debt_equity), float(
+                debt_equity_industry))
+            # Threshold
+            negative_earnings = threshold.negative_earnings(forward_earnings_current_year)
+            shareholders_equity = df_current_year.iloc[-1]['ShareholdersEquity']
+            negative_shareholders_equity = threshold.negative_shareholders_equity(float(shareholders_equity))
+            beta_classify = threshold.beta_classify(float(share_beta), beta)
+            acceptable_stock = threshold.acceptable_stock(negative_earnings, negative_shareholders_equity,
+                                                          beta_classify)
+
+            # Continuous values behind the thresholds, independent of the margin of safety and beta
+            ratio_row = {"company_name": company, "forward_earnings": forward_earnings_current_year,
+                         "shareholders_equity": float(shareholders_equity), "share_beta": float(share_beta),
+                         "error": False}
+            try:
+                share_pe = float(df_current_year.iloc[-1]['PE'])
+                ratio_row.update({
+                    "pe_relative_market": ratios.current_pe_market(
+                        share_pe, float(df_current_year.iloc[-1]['PEMarket'])) / pe_relative_market - 1,
+                    "pe_relative_sector": ratios.current_pe_sector(
+                        share_pe, float(df_current_year.iloc[-1]['PESector'])) / pe_relative_sector - 1,
+                    "forward_pe": forward_price_to_earnings / historic_price_to_earnings_share - 1,
+                    "roe_vs_coe": roe_current / cost_of_equity - 1,
+                    "cagr_vs_inflation": historic_earnings_cagr * 100 / float(
+                        df_current_year.iloc[-1]['InflationRate']) - 1,
+                    "relative_debt_to_equity": relative_debt_equity - 1})
+            except Exception:
+                # The discrete states would fail in the same way, so the share is never acceptable
+                ratio_row["error"] = True
+            ratio_rows.append(ratio_row)
+
+            if acceptable_stock:
+                current_share_pe = df_current_year.iloc[-1]['PE']
+                current_market_pe = df_current_year.iloc[-1]['PEMarket']
+
+                current_sector_pe = df_current_year.iloc[-1]['PESector']
+
+                pe_current_share_market = ratios.current_pe_market(float(current_share_pe),
+                                                                   float(current_market_pe))  # PE value for this year
+
+                pe_current_share_sector = ratios.current_pe_sector(float(current_share_pe),
+                                                                   float(current_sector_pe))  # PE value for this year
+                pe_relative_market_ = threshold.current_pe_relative_share_market(margin_of_safety,
+                                                                                 pe_current_share_market,
+                                                                                 pe_relative_market)
+                pe_relative_sector_ = threshold.current_pe_relative_share_sector(margin_of_safety,
+                                                                                 pe_current_share_sector,
+                                                                                 pe_relative_sector)
+                # Forward PE
+                forward_pe = threshold.forward_pe(margin_of_safety, forward_price_to_earnings,
+                                                  historic_price_to_earnings_share)
+
+                # ROE vs COE
+                roe_coe = threshold.roe_coe(margin_of_safety, roe_current, cost_of_equity)
+
+                # CAGR inflation
+                inflation = df_current_year.iloc[-1]['InflationRate']
+                cagr_inflation = threshold.cagr_inflation(margin_of_safety, historic_earnings_cagr,
+                                                          float(inflation))
+
+                relative_debt_to_equity = threshold.relative_debt_to_equity(margin_of_safety, relative_debt_equity)
+
+                if extension:
+                    systematic_risk = threshold.systematic_risk_classification(float(share_beta))
+                else:
+                    systematic_risk = None
+
+                company_row = {"company_name": company,
+                               "negative_earnings": negative_earnings,
+                               "negative_shareholders_equity": negative_shareholders_equity,
+                               "beta_classify": beta_classify,
+                               "acceptable_stock": acceptable_stock,
+                               "current_PE_relative_share_market_to_historical": pe_relative_market_,
+                               "current_PE_relative_share_sector_to_historical": pe_relative_sector_,
+                               "forward_PE_current_to_historical": forward_pe, "roe_vs_coe": roe_coe,
+                               "growth_cagr_vs_inflation": cagr_inflation,
+                               "relative_debt_to_equity": relative_debt_to_equity,
+                               "systematic_risk": systematic_risk}
+                share_rows.append(company_row)
+                print(f"Company {company} added to investable shares")
+            else:
+                print(f"Company {company} is not acceptable. Reasons: NE={negative_earnings}, NSE={negative_shareholders_equity}, Beta={beta_classify}")
+                company_row = {"company_name": company,
+                               "negative_earnings": negative_earnings,
+                               "negative_shareholders_equity": negative_shareholders_equity,
+                               "beta_classify": beta_classify,
+                               "acceptable_stock": acceptable_stock}
+                share_rows.append(company_row)
+
+        except Exception as e:
+            skipped[company] = f"error: {e}"
+
+    return share_rows, ratio_rows, skipped
+
+
 class Store:
-    def __init__(self, main_data, companies, companies_jcsev, companies_jgind, margin_of_safety,
-                 beta, years, extension):
+    def __init__(self, main_data, sectors, margin_of_safety, beta, years, extension, workers=1):
         self.df_main = main_data
-        self.companies = companies
-        self.companies_jcsev = companies_jcsev
-        self.companies_jgind = companies_jgind
+        self.sectors = sectors
+        self.companies = list(dict.fromkeys(company for names in sectors.values() for company in names))
         self.margin_of_safety = margin_of_safety
         self.beta = beta
         self.years = years
         self.extension = extension
+        self.workers = workers or 1
         self.column_names = ["company_name", "negative_earnings", "negative_shareholders_equity", "beta_classify",
                              "acceptable_stock",
                              "current_PE_relative_share_market_to_historical",
@@ -22,194 +309,111 @@ class Store:
                              "forward_PE_current_to_historical", "roe_vs_coe",
                              "growth_cagr_vs_inflation", "relative_debt_to_equity", "systematic_risk"]
         self.df_shares = pd.DataFrame(columns=self.column_names)
+        self.df_ratios = pd.DataFrame()
+        self.skip_reasons = {}
         self.process()
 
     def process(self):
+        """
+        Computes the ratios and discrete states of every company, one sector at a time. Companies without
+        the inputs of the year are screened out first, for all of them at once, and the reason each company
+        is skipped is kept in skip_reasons. Each sector only sees its own rows, and with more than one worker
+        the sectors are processed in parallel processes
+        """
         print(f"Processing data for year: {self.years}")
         print(f"Total rows in main data: {len(self.df_main)}")
         
         # Print unique company names
         unique_companies = self.df_main['Name'].unique()
         print(f"Unique companies in data: {unique_companies}")
-        print(f"Number of companies in JCSEV: {len(self.companies_jcsev)}")
-        print(f"Number of companies in JGIND: {len(self.companies_jgind)}")
-        
+        for sector, names in self.sectors.items():
+            print(f"Number of companies in {sector}: {len(names)}")
+
+        eligible, reasons = coverage(self.df_main, self.companies, [self.years])
+        self.skip_reasons = reasons[self.years].dropna().to_dict()
+
+        # A company listed in several sectors is processed once, with the first of them
+        partitions = {}
         for company in self.companies:
-            try:
-                company_data = self.df_main[self.df_main['Name'] == company]
-                if company_data.empty:
-                    print(f"No data found for company: {company}")
-                    continue
-                    
-                year_data = company_data[(company_data['Date'] >= f"{self.years}-01-01") & 
-                                        (company_data['Date'] <= f"{self.years}-12-31")]
-                if year_data.empty:
-                    print(f"No data found for company {company} in year {self.years}")
-                    continue
-                    
-                print(f"Processing company: {company}")
-                print(f"Data for {self.years}: {len(year_data)} rows")
-                
-                eps_year_list = []
-                pe_sector_list = []
-                pe_market_list = []
-
-                start_year = self.years - 4
-                end_year = self.years
-                df_current_year = None
-                current_price = None
-
-                              
-                for i in range(start_year, end_year):                    
-                    mask_eps = (company_data['Date'] >= f"{i}-01-01") & (company_data['Date'] <= f"{i}-12-31")
-
-                    company_df_by_year = company_data.loc[mask_eps]
-
-                    if not company_df_by_year.empty:
-                        eps = company_df_by_year.iloc[-1]['EPS']
-                        eps_year_list.append(eps)
-
-                    mask_current_price = (company_data['Date'] >= f"{end_year - 1}-01-01") & (company_data['Date'] < f"{end_year}-01-01")
-                    df_current_year = company_data.loc[mask_current_price]
-                    if not df_current_year.empty:
-                        current_price = df_current_year.iloc[-1]['Price']
-
-                    mask_pe_sector_market = (company_data['Date'] >= f"{end_year - 3}-01-01") & (company_data['Date'] < f"{end_year}-01-01")
-                    pe_sector_3_years = company_data.loc[mask_pe_sector_market, 'PESector']
-                    pe_market_3_years = company_data.loc[mask_pe_sector_market, 'PEMarket']
-                    
-                    pe_sector_list.extend(pe_sector_3_years[~np.isnan(pe_sector_3_years)].tolist())
-                    pe_market_list.extend(pe_market_3_years[~np.isnan(pe_market_3_years)].tolist())
-
-                if not eps_year_list or not pe_sector_list or not pe_market_list or df_current_year is None or df_current_year.empty:
-                    print(f"Insufficient data for company {company}.")
-                    print(f"EPS data: {eps_year_list}")
-                    print(f"PE Sector data: {pe_sector_list}")
-                    print(f"PE Market data: {pe_market_list}")
-                    print(f"Current Year Data: {'Available' if df_current_year is not None and not df_current_year.empty else 'Not Available'}")
-
-                    continue
-
-                # historic_earnings_growth_rate
-                growth_years_n = end_year - start_year
-                historic_earnings_growth_rate = ratios.historic_earnings_growth_rate(eps_year_list, growth_years_n)
-
-                # historic_earnings_cagr
-                if len(eps_year_list) >= 4:
-                    historic_earnings_cagr = ratios.historic_earnings_cagr(eps_year_list[-1], eps_year_list[-4], 3)
-                else:
-                    historic_earnings_cagr = 0
-
-                # historic_price_to_earnings_share
-                mask_pe = (self.df_main['Date'] >= f"{end_year - 1}-01-01") & (
-                        self.df_main['Date'] < f"{end_year}-01-01") & (self.df_main['Name'] == company)
-                df_company_3_years = self.df_main.loc[mask_pe]
-                price_list_3_years = df_company_3_years['Price'].to_numpy()
-                eps_list_3_years = df_company_3_years['EPS'].to_numpy()
-                historic_price_to_earnings_share = ratios.historic_price_to_earnings_share(price_list_3_years,
-                                                                                           eps_list_3_years)
-                forward_earnings_current_year = ratios.forward_earnings(eps_year_list[-1], historic_earnings_growth_rate)
-
-                # Skip this company if essential calculations return 0 due to insufficient data
-                if (historic_earnings_growth_rate == 0 or historic_earnings_cagr == 0 or
-                    historic_price_to_earnings_share == 0 or forward_earnings_current_year == 0):
-                    print(f"Essential calculations returned 0 for company {company}")
-                    continue
-
-                historic_earnings_growth_rate_past = ratios.historic_earnings_growth_rate(eps_year_list, 3)
-
-                forward_earnings_past = ratios.forward_earnings(eps_year_list[-1],
-                                                                historic_earnings_growth_rate_past)  # intermediate
-                forward_earnings_cagr = ratios.forward_earnings_cagr(forward_earnings_current_year, forward_earnings_past,
-                                                                     3)
-
-                forward_price_to_earnings = ratios.forward_price_to_earnings(current_price, forward_earnings_current_year)
-
-                # PE Relative
-                pe_relative_market = ratios.pe_relative_market(historic_price_to_earnings_share, pe_market_list)
-                pe_relative_sector = ratios.pe_relative_sector(historic_price_to_earnings_share, pe_sector_list)
-
-                # ROE
-                roe_current = df_current_year.iloc[-1]['ROE']
-                # COE
-                market_rate_of_return = df_current_year.iloc[-1]['MarketRateOfReturn']
-                risk_free_rate_of_return = df_current_year.iloc[-1]['RiskFreeRateOfReturn']
-                share_beta = df_current_year.iloc[-1]['ShareBeta']
-                cost_of_equity = ratios.cost_of_equity(float(market_rate_of_return), float(risk_free_rate_of_return),
-                                                       float(share_beta))
-                # Relative Debt/Equity
-                debt_equity = df_current_year.iloc[-1]['Debt/Equity']
-                debt_equity_industry = df_current_year.iloc[-1]['Debt/EquityIndustry']
-                relative_debt_equity = ratios.relative_debt_to_equity(float(debt_equity), float(
-                    debt_equity_industry))
-                # Threshold
-                negative_earnings = threshold.negative_earnings(forward_earnings_current_year)
-                shareholders_equity = df_current_year.iloc[-1]['ShareholdersEquity']
-                negative_shareholders_equity = threshold.negative_shareholders_equity(float(shareholders_equity))
-                beta_classify = threshold.beta_classify(float(share_beta), self.beta)
-                acceptable_stock = threshold.acceptable_stock(negative_earnings, negative_shareholders_equity,
-                                                              beta_classify)
-
-                if acceptable_stock:
-                    current_share_pe = df_current_year.iloc[-1]['PE']
-                    current_market_pe = df_current_year.iloc[-1]['PEMarket']
-
-                    current_sector_pe = df_current_year.iloc[-1]['PESector']
-
-                    pe_current_share_market = ratios.current_pe_market(float(current_share_pe),
-                                                                       float(current_market_pe))  # PE value for this year
-
-                    pe_current_share_sector = ratios.current_pe_sector(float(current_share_pe),
-                                                                       float(current_sector_pe))  # PE value for this year
-                    pe_relative_market_ = threshold.current_pe_relative_share_market(self.margin_of_safety,
-                                                                                     pe_current_share_market,
-                                                                                     pe_relative_market)
-                    pe_relative_sector_ = threshold.current_pe_relative_share_sector(self.margin_of_safety,
-                                                                                     pe_current_share_sector,
-                                                                                     pe_relative_sector)
-                    # Forward PE
-                    forward_pe = threshold.forward_pe(self.margin_of_safety, forward_price_to_earnings,
-                                                      historic_price_to_earnings_share)
-
-                    # ROE vs COE
-                    roe_coe = threshold.roe_coe(self.margin_of_safety, roe_current, cost_of_equity)
-
-                    # CAGR inflation
-                    inflation = df_current_year.iloc[-1]['InflationRate']
-                    cagr_inflation = threshold.cagr_inflation(self.margin_of_safety, historic_earnings_cagr,
-                                                              float(inflation))
-
-                    relative_debt_to_equity = threshold.relative_debt_to_equity(self.margin_of_safety, relative_debt_equity)
-
-                    if self.extension:
-                        systematic_risk = threshold.systematic_risk_classification(float(share_beta))
-                    else:
-                        systematic_risk = None
-
-                    company_row = {"company_name": company,
-                                   "negative_earnings": negative_earnings,
-                                   "negative_shareholders_equity": negative_shareholders_equity,
-                                   "beta_classify": beta_classify,
-                                   "acceptable_stock": acceptable_stock,
-                                   "current_PE_relative_share_market_to_historical": pe_relative_market_,
-                                   "current_PE_relative_share_sector_to_historical": pe_relative_sector_,
-                                   "forward_PE_current_to_historical": forward_pe, "roe_vs_coe": roe_coe,
-                                   "growth_cagr_vs_inflation": cagr_inflation,
-                                   "relative_debt_to_equity": relative_debt_to_equity,
-                                   "systematic_risk": systematic_risk}
-                    self.df_shares = pd.concat([self.df_shares, pd.DataFrame([company_row])], ignore_index=True)
-                    print(f"Company {company} added to investable shares")
-                else:
-                    print(f"Company {company} is not acceptable. Reasons: NE={negative_earnings}, NSE={negative_shareholders_equity}, Beta={beta_classify}")
-                    company_row = {"company_name": company,
-                                   "negative_earnings": negative_earnings,
-                                   "negative_shareholders_equity": negative_shareholders_equity,
-                                   "beta_classify": beta_classify,
-                                   "acceptable_stock": acceptable_stock}
-                    self.df_shares = pd.concat([self.df_shares, pd.DataFrame([company_row])], ignore_index=True)
-
-            except Exception as e:
-                print(f"Error processing company {company}: {str(e)}")
+            sector = next(code for code, names in self.sectors.items() if company in names)
+            partitions.setdefault(sector, []).append(company)
+        partitions = {sector: [company for company in names if eligible.at[company, self.years]]
+                      for sector, names in partitions.items()}
+        tasks = [(self.df_main[self.df_main['Name'].isin(names)], names, self.margin_of_safety, self.beta,
+                  self.years, self.extension) for names in partitions.values() if names]
+
+        if self.workers > 1 and len(tasks) > 1:
+            with ProcessPoolExecutor(max_workers=min(self.workers, len(tasks))) as executor:
+                results = list(executor.map(process_companies, *zip(*tasks)))
+        else:
+            results = [process_companies(*task) for task in tasks]
+
+        self.df_shares = pd.DataFrame([row for share_rows, _, _ in results for row in share_rows],
+                                      columns=self.column_names)
+        self.df_ratios = pd.DataFrame([row for _, ratio_rows, _ in results for row in ratio_rows])
+        for _, _, skipped in results:
+            self.skip_reasons.update(skipped)
+        print(coverage_report(pd.Series(self.skip_reasons).reindex(self.companies)))
+
+    def discretize_grid(self, companies, margins_of_safety, betas):
+        """
+        Returns the acceptable stock state and the evidence states of the given companies for every
+        (margin of safety, beta) pair, by re-discretizing the continuous ratios computed in process
+
+        Parameters
+        ----------
+        companies : list
+            Companies along the last axis
+        margins_of_safety : list
+            Margins of safety along the first axis
+        betas : list
+            Beta thresholds along the second axis
+
+        Returns
+        -------
+        dict
+            Arrays of shape (margins of safety, betas, companies) keyed by df_shares column
+        """
+        ratios_ = self.df_ratios.drop_duplicates("company_name", keep="last").set_index("company_name") \
+            if not self.df_ratios.empty else pd.DataFrame(columns=["error"])
+        ratios_ = ratios_.reindex(companies)
+        margin_of_safety = np.asarray(margins_of_safety, dtype=np.float64)[:, None, None]
+        beta = np.asarray(betas, dtype=np.float64)[None, :, None]
+        shape = (len(margins_of_safety), len(betas), len(companies))
+
+        def column(name):
+            if name not in ratios_:
+                return np.full(len(companies), np.nan)
+            return ratios_[name].to_numpy(dtype=np.float64)
+
+        with np.errstate(invalid="ignore"):
+            present = ratios_["error"].eq(False).to_numpy()
+            acceptable = present & ~(column("forward_earnings") < 0) & ~(column("shareholders_equity") < 0) & \
+                (column("share_beta") <= beta)
+
+        valuation = ("cheap", "fairValue", "expensive")
+        comparison = ("below", "EqualTo", "above")
+        grid = {
+            "acceptable_stock": np.broadcast_to(acceptable, shape),
+            "current_PE_relative_share_market_to_historical": threshold.classify_margin(
+                column("pe_relative_market"), margin_of_safety, valuation),
+            "current_PE_relative_share_sector_to_historical": threshold.classify_margin(
+                column("pe_relative_sector"), margin_of_safety, valuation),
+            "forward_PE_current_to_historical": threshold.classify_margin(
+                column("forward_pe"), margin_of_safety, valuation),
+            "roe_vs_coe": threshold.classify_margin(column("roe_vs_coe"), margin_of_safety, comparison, True),
+            "growth_cagr_vs_inflation": threshold.classify_margin(column("cagr_vs_inflation"), margin_of_safety,
+                                                                  comparison, True),
+            "relative_debt_to_equity": threshold.classify_margin(column("relative_debt_to_equity"),
+                                                                 margin_of_safety, comparison, True),
+        }
+        if self.extension:
+            systematic_risk = np.array([threshold.systematic_risk_classification(b) for b in column("share_beta")],
+                                       dtype=object)
+        else:
+            systematic_risk = np.full(len(companies), None, dtype=object)
+        grid["systematic_risk"] = systematic_risk
+        return {name: np.broadcast_to(values, shape) for name, values in grid.items()}
 
     def get_acceptable_stock(self, company):
         """
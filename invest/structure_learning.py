@@ -0,0 +1,238 @@
+import json
+import os
+import time
+
+import numpy as np
+import pyAgrum as gum
+
+
+class FamilyScoreCache:
+    def __init__(self, data):
+        """
+        Caches BIC family scores for one learning dataset so that each (child, parents) family is
+        scored once, however many networks, restarts or search steps ask for it
+
+        Parameters
+        ----------
+        data : pandas.DataFrame
+            Categorical learning data
+        """
+        self.codes = {c: data[c].cat.codes.to_numpy() for c in data.columns}
+        self.cards = {c: len(data[c].cat.categories) for c in data.columns}
+        self.scores = {}
+        self.hits = 0
+        self.misses = 0
+
+    def score(self, child, parents):
+        """
+        Returns the BIC score of a family, computed over the rows where all its variables are observed
+        """
+        key = (child, tuple(sorted(parents)))
+        if key in self.scores:
+            self.hits += 1
+            return self.scores[key]
+        self.misses += 1
+
+        variables = list(key[1]) + [child]
+        codes = np.column_stack([self.codes[v] for v in variables])
+        codes = codes[(codes >= 0).all(axis=1)]
+        shape = [self.cards[v] for v in variables]
+        counts = np.bincount(np.ravel_multi_index(tuple(codes.T), shape),
+                             minlength=int(np.prod(shape))).reshape(-1, shape[-1])
+        parent_counts = counts.sum(axis=1, keepdims=True)
+        nonzero = counts > 0
+        ll = np.sum(counts[nonzero] * np.log((counts / np.where(parent_counts > 0, parent_counts, 1))[nonzero]))
+        penalty = 0.5 * np.log(max(len(codes), 1)) * counts.shape[0] * (shape[-1] - 1)
+        self.scores[key] = float(ll - penalty)
+        return self.scores[key]
+
+
+def learnable_nodes(network, data):
+    """
+    Returns the names of the chance nodes of a network that are present in the data
+    """
+    model = network.model
+    return [model.variable(node).name() for node in model.nodes()
+            if model.isChanceNode(node) and model.variable(node).name() in data.columns]
+
+
+def learn_structure(network, data, method="tabu", max_parents=2, max_time=None, max_iter=None, tabu_size=10,
+                    cache=None):
+    """
+    Learns the arcs between the chance nodes of a network present in the data with a local search
+    over cached family scores. Arcs touching decision or utility nodes are kept as they are and the
+    search never creates a cycle through them.
+
+    Parameters
+    ----------
+    network : ValueNetwork or QualityNetwork or InvestmentRecommendationNetwork
+        Network whose chance-node subgraph is learned
+    data : pandas.DataFrame
+        Categorical learning data
+    method : str, optional
+        Local search, either "hill_climbing" or "tabu"
+    max_parents : int, optional
+        Maximum number of learned parents per node
+    max_time : float, optional
+        Time limit in seconds
+    max_iter : int, optional
+        Maximum number of search steps
+    tabu_size : int, optional
+        Length of the tabu list and number of non-improving steps allowed
+    cache : FamilyScoreCache, optional
+        Score cache shared between searches over the same data
+
+    Returns
+    -------
+    tuple
+        Learned arcs as (tail, head) names and the search report
+    """
+    start_time = time.time()
+    model = network.model
+    cache = cache if cache is not None else FamilyScoreCache(data)
+    nodes = learnable_nodes(network, data)
+    hits, misses = cache.hits, cache.misses
+
+    fixed = set()
+    arcs = set()
+    for tail, head in model.arcs():
+        arc = (model.variable(tail).name(), model.variable(head).name())
+        (arcs if arc[0] in nodes and arc[1] in nodes else fixed).add(arc)
+
+    def parents(node, current):
+        return [t for t, h in current if h == node]
+
+    def acyclic(current):
+        graph = {}
+        for t, h in current | fixed:
+            graph.setdefault(t, []).append(h)
+        state = {}
+
+        def visit(n):
+            state[n] = 1
+            for m in graph.get(n, []):
+                if state.get(m) == 1 or (m not in state and not visit(m)):
+                    return False
+            state[n] = 2
+            return True
+
+        return all(visit(n) for n in list(graph) if n not in state)
+
+    def total(current):
+        return sum(cache.score(n, parents(n, current)) for n in nodes)
+
+    best_arcs, best_score = set(arcs), total(arcs)
+    current_score = best_score
+    tabu = []
+    stale = 0
+    iterations = 0
+    status = "converged"
+    while True:
+        if max_iter is not None and iterations >= max_iter:
+            status = "maxIter"
+            break
+        if max_time is not None and time.time() - start_time >= max_time:
+            status = "maxTime"
+            break
+
+        moves = []
+        for t in nodes:
+            for h in nodes:
+                if t == h:
+                    continue
+                if (t, h) in arcs:
+                    moves.append(("remove", t, h, arcs - {(t, h)}))
+                    if len(parents(t, arcs)) < max_parents:
+                        moves.append(("reverse", t, h, (arcs - {(t, h)}) | {(h, t)}))
+                elif (h, t) not in arcs and len(parents(h, arcs)) < max_parents:
+                    moves.append(("add", t, h, arcs | {(t, h)}))
+
+        best_move = None
+        for move in moves:
+            candidate = move[3]
+            if candidate in tabu or not acyclic(candidate):
+                continue
+            # Only the families of the arc's endpoints change
+            delta = sum(cache.score(n, parents(n, candidate)) - cache.score(n, parents(n, arcs))
+                        for n in (move[1], move[2]))
+            if best_move is None or delta > best_move[0]:
+                best_move = (delta, candidate)
+
+        if best_move is None or (best_move[0] <= 0 and method != "tabu"):
+            break
+        arcs = best_move[1]
+        current_score += best_move[0]
+        iterations += 1
+        tabu = (tabu + [frozenset(arcs)])[-tabu_size:]
+        if current_score > best_score + 1e-9:
+            best_arcs, best_score = set(arcs), current_score
+            stale = 0
+        else:
+            stale += 1
+            if stale >= tabu_size:
+                break
+
+    report = {"method": method, "score": best_score, "iterations": iterations, "status": status,
+              "cacheHits": cache.hits - hits, "cacheMisses": cache.misses - misses,
+              "wallTime": time.time() - start_time}
+    return sorted(best_arcs), report
+
+
+def apply_structure(network, arcs, data_nodes):
+    """
+    Replaces the arcs between the given chance nodes of a network with the learned arcs. CPTs of
+    nodes whose parents change are reset to uniform, ready for parameter learning.
+
+    Parameters
+    ----------
+    network : ValueNetwork or QualityNetwork or InvestmentRecommendationNetwork
+        Network to update
+    arcs : list
+        Learned arcs as (tail, head) names
+    data_nodes : list
+        Chance nodes whose arcs were learned
+    """
+    model = network.model
+    current = {(model.variable(t).name(), model.variable(h).name()) for t, h in model.arcs()}
+    current = {arc for arc in current if arc[0] in data_nodes and arc[1] in data_nodes}
+    changed = set()
+    for tail, head in current - set(arcs):
+        model.eraseArc(model.idFromName(tail), model.idFromName(head))
+        changed.add(head)
+    for tail, head in set(arcs) - current:
+        model.addArc(model.idFromName(tail), model.idFromName(head))
+        changed.add(head)
+    for node in changed:
+        model.cpt(model.idFromName(node)).fillWith(1).normalizeAsCPT()
+
+
+def export_structure(network, arcs, folder, name, info=None):
+    """
+    Writes a network's influence diagram, with its learned arcs and current CPTs, to a BIFXML file that
+    gum.loadID() reads back as a network model, and its learned arcs to a JSON file next to it
+
+    Parameters
+    ----------
+    network : ValueNetwork or QualityNetwork or InvestmentRecommendationNetwork
+        Network with its learned structure applied
+    arcs : list
+        Learned arcs as (tail, head) names
+    folder : str
+        Output folder
+    name : str
+        File name without extension
+    info : dict, optional
+        Fields stored with the arcs, e.g. the train_end year and network name
+
+    Returns
+    -------
+    tuple
+        Paths of the BIFXML and JSON files
+    """
+    os.makedirs(folder, exist_ok=True)
+    model_file = os.path.join(folder, name + ".bifxml")
+    arcs_file = os.path.join(folder, name + ".json")
+    gum.saveID(network.model, model_file)
+    with open(arcs_file, 'w') as f:
+        json.dump({**(info or {}), "arcs": [list(arc) for arc in arcs], "model": os.path.basename(model_file)}, f, indent=1)
+    return model_file, arcs_file